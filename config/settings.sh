@@ -24,6 +24,23 @@ export ENV_NAME="mpra"                                       # name of the conda
 export MEM="64G"                                             # memory per job (e.g., 64G)
 export CORES=24                                              # number of CPU cores per job
 export RUNTIME="24:00:00"                                    # walltime limit for jobs (HH:MM:SS)
+export SCRATCH_DIR=""                                        # node-local scratch for match/count intermediates (e.g. "${TMPDIR:-/tmp}"; empty = work in results dirs)
+export COUNT_WORKERS=1                                       # count.py --workers: replicates, count-table shards and QC plots in parallel (0 = one per granted core: $NSLOTS under SGE)
+export COUNT_WHITELIST=0                                     # 1 = drop barcodes not in the .parsed map while reading count FASTQs (changes .tag/.count: no -9 rows; 0 = keep all)
+export COUNT_RESCUE=0                                        # 1 = count barcodes one mismatch away from a single .parsed barcode under that barcode
+export COUNT_STORE=1                                         # 1 = build the indexed <ID_OUT>.db (count table, .parsed map, tile_proj_map.tsv projects) for scripts/mpra_store.py query
+export COUNT_QC_PDF=0                                        # 1 = count QC plots as pages of one <ID_OUT>_count_QC.pdf (0 = one PDF per plot)
+
+# ─── Per-task resource profiles: "cores memory runtime" (pipeline.py / pipeline.sh)
+export PROFILE_MATCH="${CORES} ${MEM} ${RUNTIME}"            # read matching and alignment (multi-threaded)
+export PROFILE_COUNT_REPLICATE="1 8G 12:00:00"               # make_counts + associate_tags, one array task per replicate
+export PROFILE_COUNT_GATHER="1 ${MEM} ${RUNTIME}"            # compile_bc_cs and count QC (memory-bound; raise cores with COUNT_WORKERS)
+export PROFILE_MODEL_SPLIT="1 8G 02:00:00"                   # attributes and per-cell-type shard inputs
+export PROFILE_MODEL_SHARD="1 16G 12:00:00"                  # MPRAmodel, one array task per cell type
+export PROFILE_MODEL_GATHER="1 8G 02:00:00"                  # merge shards, correlation plots
+export PROFILE_COMPARE_SPLIT="1 8G 01:00:00"                 # cache normalized counts, per-comparison inputs
+export PROFILE_COMPARE_RUN="1 4G 04:00:00"                   # compare.r, one array task per comparison
+export PROFILE_COMPARE_GATHER="1 2G 00:30:00"                # comparison summary
 
 # ─── MPRAmatch inputs
 export READ1="${LIBRARY_DIR}/${PROJECT_NAME}_r1.fastq.gz"    # path to your R1 FASTQ file
@@ -31,6 +48,13 @@ export READ2="${LIBRARY_DIR}/${PROJECT_NAME}_r2.fastq.gz"    # path to your R2 F
 export REFERENCE="${LIBRARY_DIR}/${PROJECT_NAME}_reference.fasta.gz"   # path to the MPRA reference FASTA
 # export ATTRIBUTES_FILE="${BASE_DIR}/data/library/${PROJECT_NAME}_attributes.tsv"  # path to attributes TSV (if used)
 export OLIGO_ALN_MISMATCH_RATE_CUTOFF="0.05"    # maximum allowed oligo alignment mismatch rate (default 0.05)
+export MPRA_REJECTS="counts"                                 # rejected reads: "counts" (metrics only), "sample:1000" (reservoir) or "all" (per-read .reject files)
+export MPRA_INDEX_CACHE="${BASE_DIR}/cache/minimap2"       # prebuilt minimap2 indexes of the reference, reused across runs
+export MPRA_PROFILE=""                                       # profile every helper script: "cprofile" or "sample[:MS]" (empty = off); output next to *.metrics.jsonl
+export MPRA_HEARTBEAT=""                                     # seconds between progress lines from hot loops (empty = 60 while profiling, else off)
+export MATCH_ALIGNER="minimap2"                              # "minimap2" (CLI + SAM) or "mappy" (in-process, no SAM)
+export MATCH_BAM=0                                           # with MATCH_ALIGNER="mappy": 1 = also write the BAM
+export MATCH_INTERN_IDS=0                                    # 1 = oligo IDs as integer codes in the per-read .mapped/.sort intermediates (names restored in .ct; conflicting oligos listed in code order)
 
 # ─── MPRAcount inputs
 export ACC_ID_FILE="${BASE_DIR}/config/acc_id.txt"           # path to accession ID mapping file
@@ -43,7 +67,10 @@ export EXP="exp"                                             # name of your expe
 export EXP_FASTA="${LIBRARY_DIR}/${EXP}.fasta.gz"            # path to experiment FASTA
 export NEG_FASTA="${LIBRARY_DIR}/${NEG_CTRL}.fasta.gz"       # path to negative control FASTA
 export POS_FASTA="${LIBRARY_DIR}/${POS_CTRL}.fasta.gz"       # path to positive control FASTA
+export MODEL_EXECUTOR="local"                                 # run per-cell-type model shards locally ("local") or as an SGE array job ("sge")
+export MODEL_WORKERS=0                                       # concurrent local shards (0 = one per cell type)
 
 # ─── MPRAcompare inputs
 export COMP_FILE="${BASE_DIR}/config/comparisons.tsv"        # path to comparisons definition TSV
-export NORM_COUNTS="${RESULTS_MODEL}/out/results/${ID_OUT}_normalized_counts.tsv"  # path to normalized counts TSV from modeling step
\ No newline at end of file
+export NORM_COUNTS="${RESULTS_MODEL}/out/results/${ID_OUT}_normalized_counts.tsv"  # path to normalized counts TSV from modeling step
+export COMPARE_WORKERS="${CORES}"                             # comparisons run concurrently by compare.py
\ No newline at end of file
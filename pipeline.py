@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+"""
+pipeline.py
+
+Run the match -> count -> model -> compare DAG as fine-grained tasks (one per
+replicate, cell type and comparison, plus split/gather steps), either
+
+  --executor local  on this machine: each task starts as soon as its
+                    dependencies have finished and its cores and memory fit
+                    in the --cores/--mem budget
+  --executor sge    as SGE jobs: per-replicate/cell/comparison tasks become
+                    one array job (-t) each, chained to their split and
+                    gather jobs with -hold_jid
+
+Each task kind has a resource profile "cores memory runtime" (RESOURCES below,
+overridable as PROFILE_<KIND> in settings.sh, e.g. PROFILE_COUNT_REPLICATE).
+
+Usage:
+    ./pipeline.py [--executor local|sge] [--cores N] [--mem 256G] [--qsub CMD] [--dry_run] [match|count|model|compare|all ...]
+
+Every task is a run_*.sh call, so settings come from config/settings.sh as for
+pipeline.sh. Logs go to $LOG_DIR/<task>.log (local) or $LOG_DIR/<job>.<task_id>.out|err (sge).
+"""
+import argparse, os, subprocess, sys, time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+STEPS = ["match", "count", "model", "compare"]
+
+# (cores, memory, runtime) per task kind; CORES/MEM/RUNTIME take the values from settings.sh
+RESOURCES = {
+    "match":           ("CORES", "MEM", "RUNTIME"),
+    "count.replicate": (1, "8G",  "12:00:00"),
+    "count.gather":    (1, "MEM", "RUNTIME"),
+    "model.split":     (1, "8G",  "02:00:00"),
+    "model.shard":     (1, "16G", "12:00:00"),
+    "model.gather":    (1, "8G",  "02:00:00"),
+    "compare.split":   (1, "8G",  "01:00:00"),
+    "compare.run":     (1, "4G",  "04:00:00"),
+    "compare.gather":  (1, "2G",  "00:30:00"),
+}
+# task kinds submitted to SGE as one array job per stage
+ARRAY_KINDS = ("count.replicate", "model.shard", "compare.run")
+
+SGE_JOB = """#!/bin/bash
+#$ -N {name}
+#$ -cwd
+#$ -pe smp {cores}
+#$ -l h_vmem={mem}
+#$ -l h_rt={runtime}
+#$ -o {log_dir}/{name}{task_suffix}.out
+#$ -e {log_dir}/{name}{task_suffix}.err
+{array}
+{env}
+{cmd}
+"""
+
+class Task:
+    def __init__(self, name, kind, cmd, deps=()):
+        self.name = name
+        self.kind = kind
+        self.cmd = cmd
+        self.deps = list(deps)
+        self.cores = 1
+        self.mem = 0.0
+        self.mem_str = "0G"
+        self.runtime = ""
+
+def parse_mem(value):
+    """'64G' / '512M' / '1T' / plain GB -> GB."""
+    value = str(value).strip().upper()
+    units = {"K": 1 / 1024 ** 2, "M": 1 / 1024, "G": 1, "T": 1024}
+    if value and value[-1] in units:
+        return float(value[:-1]) * units[value[-1]]
+    return float(value)
+
+def load_settings(path):
+    """Environment after sourcing settings.sh (exported variables only)."""
+    out = subprocess.run(["bash", "-c", f'source "{path}" && env -0'],
+                         check=True, capture_output=True).stdout.decode()
+    return dict(kv.split("=", 1) for kv in out.split("\0") if "=" in kv)
+
+def read_column(path, col, skip_header=False):
+    values = []
+    with open(path) as fh:
+        if skip_header:
+            fh.readline()
+        for line in fh:
+            if line.strip():
+                v = line.rstrip("\n").split("\t")[col]
+                if v not in values:
+                    values.append(v)
+    return values
+
+def build_tasks(env, steps):
+    src = env["SRC_DIR"]
+    match_sh = f"{src}/01_MPRA_match/run_match.sh"
+    count_sh = f"{src}/02_MPRA_count/run_count.sh"
+    model_sh = f"{src}/03_MPRA_model/run_model.sh"
+    compare_sh = f"{src}/04_MPRA_compare/run_compare.sh"
+
+    tasks = OrderedDict()
+    def add(name, kind, cmd, deps=()):
+        tasks[name] = Task(name, kind, cmd, [d for d in deps if d in tasks])
+
+    if "match" in steps:
+        add("match", "match", match_sh)
+    if "count" in steps:
+        reps = read_column(env["ACC_ID_FILE"], 1)
+        for rep in reps:
+            add(f"count.{rep}", "count.replicate", f"{count_sh} replicate {rep}", ["match"])
+        add("count.gather", "count.gather", f"{count_sh} gather", [f"count.{r}" for r in reps])
+    if "model" in steps:
+        cells = [c for c in read_column(env["ACC_ID_FILE"], 2) if c != "DNA"]
+        add("model.split", "model.split", f"{model_sh} split", ["count.gather"])
+        for cell in cells:
+            add(f"model.{cell}", "model.shard", f"{model_sh} shard {cell}", ["model.split"])
+        add("model.gather", "model.gather", f"{model_sh} gather", [f"model.{c}" for c in cells])
+    if "compare" in steps:
+        comps = read_column(env["COMP_FILE"], 0, skip_header=True)
+        add("compare.split", "compare.split", f"{compare_sh} split", ["model.gather"])
+        for comp in comps:
+            add(f"compare.{comp}", "compare.run", f"{compare_sh} run {comp}", ["compare.split"])
+        add("compare.gather", "compare.gather", f"{compare_sh} gather", [f"compare.{c}" for c in comps])
+
+    for t in tasks.values():
+        profile = env.get("PROFILE_" + t.kind.upper().replace(".", "_"), "").split()
+        cores, mem, runtime = profile if len(profile) == 3 else RESOURCES[t.kind]
+        t.cores = int(env.get(str(cores), cores))
+        t.mem_str = env.get(mem, mem)
+        t.mem = parse_mem(t.mem_str)
+        t.runtime = env.get(runtime, runtime)
+    return tasks
+
+def levels(tasks):
+    """Longest dependency chain to each task (0 = no dependencies)."""
+    depth = {}
+    for t in tasks.values():  # insertion order is topological
+        depth[t.name] = 1 + max((depth[d] for d in t.deps), default=-1)
+    return depth
+
+def print_plan(tasks, cores, mem):
+    depth = levels(tasks)
+    print(f"Budget: {cores} cores, {mem:g}G")
+    print("\t".join(["wave", "task", "cores", "mem", "runtime", "after", "command"]))
+    for t in sorted(tasks.values(), key=lambda t: depth[t.name]):
+        print("\t".join([str(depth[t.name]), t.name, str(t.cores), f"{t.mem:g}G", t.runtime,
+                         ",".join(t.deps) or "-", t.cmd]))
+
+def sge_units(tasks):
+    """Group tasks into SGE jobs: one array job per ARRAY_KINDS kind, one job per other task."""
+    units = OrderedDict()
+    for t in tasks.values():
+        key = t.kind if t.kind in ARRAY_KINDS else t.name
+        units.setdefault(key, []).append(t)
+    owner = {t.name: key for key, members in units.items() for t in members}
+    deps = OrderedDict((key, sorted({owner[d] for t in members for d in t.deps} - {key},
+                                    key=list(units).index))
+                       for key, members in units.items())
+    return units, deps
+
+def submit_sge(tasks, env, log_dir, qsub, dry_run=False):
+    """Submit every unit in dependency order, holding each on the job ids of its dependencies."""
+    units, deps = sge_units(tasks)
+    job_dir = os.path.join(log_dir, "jobs")
+    os.makedirs(job_dir, exist_ok=True)
+    conda = ""
+    if env.get("CONDA_INIT") and env.get("ENV_NAME"):
+        conda = f"source {env['CONDA_INIT']}\nconda activate {env['ENV_NAME']}"
+    job_ids = {}
+    for key, members in units.items():
+        name = "MPRA_" + key.replace(".", "_")
+        lead = members[0]
+        if lead.kind in ARRAY_KINDS:
+            cmd_list = os.path.join(job_dir, f"{name}.cmds")
+            with open(cmd_list, "w") as out:
+                out.write("".join(t.cmd + "\n" for t in members))
+            array = f"#$ -t 1-{len(members)}"
+            cmd = f'eval "$(sed -n "${{SGE_TASK_ID}}p" {cmd_list})"'
+            task_suffix = ".$TASK_ID"
+        else:
+            array, cmd, task_suffix = "", lead.cmd, ""
+        job_f = os.path.join(job_dir, f"{name}.sh")
+        with open(job_f, "w") as out:
+            out.write(SGE_JOB.format(name=name, cores=lead.cores, mem=lead.mem_str,
+                                     runtime=lead.runtime, log_dir=log_dir, task_suffix=task_suffix,
+                                     array=array, env=conda, cmd=cmd))
+        hold = ",".join(job_ids[d] for d in deps[key])
+        argv = [qsub, "-terse"]
+        if env.get("SCC_PROJ"):
+            argv += ["-P", env["SCC_PROJ"]]
+        if hold:
+            argv += ["-hold_jid", hold]
+        argv.append(job_f)
+        if dry_run:
+            job_ids[key] = name
+            print(" ".join(argv))
+            continue
+        out = subprocess.run(argv, check=True, capture_output=True, text=True, env=env).stdout
+        # -terse prints "<id>" or "<id>.<first>-<last>:<step>" for arrays
+        job_ids[key] = out.strip().split(".")[0]
+        print(f"Submitted {name} ({len(members)} task(s)) as job {job_ids[key]}"
+              + (f", after {hold}" if hold else ""), file=sys.stderr)
+    return job_ids
+
+def run_task(task, env, log_dir):
+    log = os.path.join(log_dir, f"{task.name}.log")
+    t0 = time.time()
+    with open(log, "w") as fh:
+        rc = subprocess.run(task.cmd, shell=True, env=env, stdout=fh, stderr=subprocess.STDOUT).returncode
+    return rc, time.time() - t0
+
+def execute(tasks, env, cores, mem, log_dir):
+    """Start every ready task that fits in the free budget; stop launching after a failure."""
+    for t in tasks.values():
+        if t.cores > cores or t.mem > mem:
+            print(f"WARNING: {t.name} asks for {t.cores} cores/{t.mem:g}G, more than the budget; "
+                  f"it will run alone", file=sys.stderr)
+            t.cores, t.mem = min(t.cores, cores), min(t.mem, mem)
+
+    pending = list(tasks.values())
+    running, done, failed = {}, set(), []
+    free_cores, free_mem = cores, mem
+    with ThreadPoolExecutor(max_workers=len(tasks) or 1) as pool:
+        while pending or running:
+            if not failed:
+                for t in list(pending):
+                    if all(d in done for d in t.deps) and t.cores <= free_cores and t.mem <= free_mem:
+                        print(f">> [{t.name}] {t.cmd}", file=sys.stderr)
+                        running[pool.submit(run_task, t, env, log_dir)] = t
+                        free_cores -= t.cores
+                        free_mem -= t.mem
+                        pending.remove(t)
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                t = running.pop(fut)
+                free_cores += t.cores
+                free_mem += t.mem
+                rc, secs = fut.result()
+                if rc == 0:
+                    done.add(t.name)
+                    print(f"<< [{t.name}] done in {secs:.0f}s", file=sys.stderr)
+                else:
+                    failed.append(t.name)
+                    print(f"!! [{t.name}] failed (exit {rc}); see {log_dir}/{t.name}.log", file=sys.stderr)
+    return done, failed, [t.name for t in pending]
+
+def main():
+    here = os.path.dirname(os.path.abspath(__file__))
+    p = argparse.ArgumentParser(description="Run the MPRA pipeline DAG locally against a core/memory budget")
+    p.add_argument("steps", nargs="*",
+                   help="Stages to run: match, count, model, compare or all (default: all)")
+    p.add_argument("--executor", choices=["local", "sge"], default="local",
+                   help="Run tasks on this machine or submit them as SGE (array) jobs")
+    p.add_argument("--qsub", default=os.environ.get("QSUB", "qsub"),
+                   help="qsub command for --executor sge (default: $QSUB or qsub; "
+                        "scripts/qsub_local.py is a local stand-in)")
+    p.add_argument("--cores", type=int, default=os.cpu_count(),
+                   help="Cores available to the pipeline (default: all CPUs)")
+    p.add_argument("--mem", default=None,
+                   help="Memory available to the pipeline, e.g. 256G (default: physical memory)")
+    p.add_argument("--settings", default=os.path.join(here, "config", "settings.sh"),
+                   help="Project settings (default: config/settings.sh)")
+    p.add_argument("--dry_run", action="store_true",
+                   help="Print the task plan and exit")
+    args = p.parse_args()
+
+    unknown = set(args.steps) - set(STEPS + ["all"])
+    if unknown:
+        p.error(f"unknown step(s): {', '.join(sorted(unknown))}")
+    steps = STEPS if not args.steps or "all" in args.steps else [s for s in STEPS if s in args.steps]
+    mem = parse_mem(args.mem) if args.mem else \
+        os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024 ** 3
+    env = load_settings(args.settings)
+    tasks = build_tasks(env, steps)
+
+    log_dir = env.get("LOG_DIR", os.path.join(here, "logs"))
+    if args.executor == "sge":
+        # the dry run still writes the job scripts so they can be inspected
+        submit_sge(tasks, env, log_dir, args.qsub, dry_run=args.dry_run)
+        return
+    if args.dry_run:
+        print_plan(tasks, args.cores, mem)
+        return
+
+    os.makedirs(log_dir, exist_ok=True)
+    t0 = time.time()
+    done, failed, skipped = execute(tasks, env, args.cores, mem, log_dir)
+    print(f"{len(done)}/{len(tasks)} tasks finished in {time.time() - t0:.0f}s", file=sys.stderr)
+    if failed:
+        print(f"Failed: {', '.join(failed)}", file=sys.stderr)
+        if skipped:
+            print(f"Not run: {', '.join(skipped)}", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -6,10 +6,21 @@ Python port of associate_tags.pl:
   - reads matched tag file and parsed mapping file
   - merges counts and mapping info
   - writes a combined tag summary
+
+With --rescue, a barcode that is not in the mapping but differs by one
+substitution (or one N) from exactly one mapped barcode is counted under that
+barcode instead of being written as unmapped (-9); see
+barcode_whitelist.BarcodeWhitelist.rescue. The rescued reads are reported per
+sample in the metrics stream.
 """
 import argparse
 import gzip
+import os
 import sys
+from collections import Counter
+
+from barcode_whitelist import BarcodeWhitelist
+from mpra_metrics import Metrics, profiled
 
 def open_maybe_gz(path):
     if path.endswith(('.gz', '.gzip')):
@@ -18,111 +29,117 @@ def open_maybe_gz(path):
         return open(path, 'r')
 
 
-def main():
-    p = argparse.ArgumentParser(description="Associate matched tags with parsed oligos")
-    p.add_argument('matched', help='Matched tag file (.match)')
-    p.add_argument('parsed', help='Parsed mapping file from MPRAmatch')
-    p.add_argument('out', help='Output tag association file')
-    p.add_argument('orientation', nargs='?', default=None,
-                   help='Barcode orientation (unused)')
-    args = p.parse_args()
+def orient_of(flag):
+    """Orientation code for a parse_map flag (>0: multimapping/failed kinds, else 0)."""
+    if flag > 0:
+        return {1: -4, 2: -5}.get(flag, -6)
+    return 0
 
-    # Step 1: load matched tags
-    # Each line: columns split by tab; key is column 1
-    tags = {}
-    with open(args.matched) as mf:
-        for line in mf:
-            parts = line.rstrip('\n').split('\t')
-            if len(parts) < 2:
-                continue
-            tag = parts[1]
-            # Initialize or increment count
-            entry = tags.setdefault(tag, {
-                'count': 0,
-                'orient': -9,
-                'loc': '-',
-                'flag': '-',
-                'tag': tag,
-                'score': 'NA',
-                'cigar': 'NA',
-                'md': 'NA',
-                'pos': 'NA'
-            })
-            entry['count'] += 1
-
-    # Step 2: overlay parsed mapping info
-    with open_maybe_gz(args.parsed) as pf:
+def parsed_entries(path, wanted=None):
+    """Yield (tag, (loc, flag, score, cigar, md, pos)) from a parsed mapping file.
+
+    Later lines for the same tag win, as when overlaying them in file order.
+    With wanted, only those tags are returned. Oligo IDs are interned, so the
+    barcodes of one oligo share a single string in load_parsed()'s dict.
+    """
+    with open_maybe_gz(path) as pf:
         for raw in pf:
             parts = raw.rstrip('\n').split('\t')
             if len(parts) < 10:
                 continue
-            cur_tag = parts[0]
-            cur_loc = parts[1]
+            if wanted is not None and parts[0] not in wanted:
+                continue
             try:
-                cur_flag = int(parts[4])
+                flag = int(parts[4])
             except ValueError:
-                cur_flag = 0
-            cur_m_flag = parts[5]
-            cur_m_aln  = parts[6]
-            cur_m_cigar= parts[7]
-            cur_m_md   = parts[8]
-            cur_m_pos  = parts[9]
-
-            if cur_tag not in tags:
+                flag = 0
+            yield parts[0], (sys.intern(parts[1]), flag, parts[6], parts[7], parts[8], parts[9])
+
+def load_parsed(path):
+    """The whole parsed mapping as {tag: entry}, to share across replicates."""
+    return dict(parsed_entries(path))
+
+def load_matched(path):
+    """Barcode counts from a .match file (record_id, barcode), in first-seen order."""
+    tags = Counter()
+    with open(path) as mf:
+        for line in mf:
+            parts = line.rstrip('\n').split('\t')
+            if len(parts) < 2:
                 continue
-            entry = tags[cur_tag]
-            # Map flags
-            if cur_flag > 0:
-                if cur_flag == 1:
-                    # simple multimapping: choose primary
-                    entry['orient'] = -4
-                    entry['loc']    = cur_loc
-                    entry['flag']   = str(cur_flag)
-                    entry['score']  = cur_m_aln
-                    entry['cigar']  = cur_m_cigar
-                    entry['md']     = cur_m_md
-                    entry['pos']    = cur_m_pos
-                elif cur_flag == 2:
-                    entry['orient'] = -5
-                    entry['loc']    = cur_loc
-                    entry['flag']   = str(cur_flag)
-                    entry['score']  = cur_m_aln
-                    entry['cigar']  = cur_m_cigar
-                    entry['md']     = cur_m_md
-                    entry['pos']    = cur_m_pos
-                else:
-                    entry['orient'] = -6
-                    entry['loc']    = cur_loc
-                    entry['flag']   = str(cur_flag)
-                    entry['score']  = cur_m_aln
-                    entry['cigar']  = cur_m_cigar
-                    entry['md']     = cur_m_md
-                    entry['pos']    = cur_m_pos
+            tags[parts[1]] += 1
+    return tags
+
+def rescue_tags(tags: Counter, library: BarcodeWhitelist):
+    """Fold barcodes one mismatch away from a single mapped barcode into it.
+
+    Returns (tags, rescued): the merged counts, in first-seen order of the
+    resulting barcodes, and the reads of each rescued barcode.
+    """
+    seen = list(tags)
+    miss = [tag for tag, ok in zip(seen, library.contains(seen)) if not ok]
+    parent = {tag: p for tag, p in zip(miss, library.rescue(miss)) if p is not None}
+    if not parent:
+        return tags, Counter()
+    merged, rescued = Counter(), Counter()
+    for tag, count in tags.items():
+        target = parent.get(tag, tag)
+        merged[target] += count
+        if target != tag:
+            rescued[tag] = count
+    return merged, rescued
+
+def associate_tags(tags: Counter, parsed, out: str, rescue: BarcodeWhitelist = None) -> None:
+    """Write the .tag table for barcode counts `tags`.
+
+    parsed is the parsed mapping file (streamed, keeping only these tags) or a
+    dict from load_parsed(). rescue is the BarcodeWhitelist of its barcodes, to
+    count near misses under their mapped barcode.
+    """
+    sample = os.path.basename(out).rsplit('.tag', 1)[0]
+    metrics = Metrics('associate_tags', sample=sample)
+    if rescue is not None:
+        tags, rescued = rescue_tags(tags, rescue)
+        metrics.counters({'rescued_barcodes': len(rescued), 'rescued_reads': sum(rescued.values())})
+        print(f"{sample}: rescued {sum(rescued.values()):,} reads of {len(rescued):,} barcodes "
+              f"one mismatch from a mapped barcode", file=sys.stderr)
+    if isinstance(parsed, dict):
+        mapping = parsed
+    else:
+        mapping = dict(parsed_entries(parsed, wanted=tags))
+
+    orient_bc = Counter()
+    orient_reads = Counter()
+    with open(out, 'w') as fh:
+        for tag, count in tags.items():
+            hit = mapping.get(tag)
+            if hit is None:
+                orient = -9
+                fields = [tag, str(count), '-9', '-', '-', tag, 'NA', 'NA', 'NA', 'NA']
             else:
-                # cur_flag <= 0
-                entry['orient'] = 0
-                entry['loc']    = cur_loc
-                entry['flag']   = str(cur_flag)
-                entry['score']  = cur_m_aln
-                entry['cigar']  = cur_m_cigar
-                entry['md']     = cur_m_md
-                entry['pos']    = cur_m_pos
-
-    # Step 3: write out
-    with open(args.out, 'w') as out:
-        for tag, e in tags.items():
-            out.write('\t'.join([
-                tag,
-                str(e['count']),
-                str(e['orient']),
-                e['loc'],
-                e['flag'],
-                e['tag'],
-                e['score'],
-                e['cigar'],
-                e['md'],
-                e['pos']
-            ]) + '\n')
+                loc, flag, score, cigar, md, pos = hit
+                orient = orient_of(flag)
+                fields = [tag, str(count), str(orient), loc, str(flag), tag, score, cigar, md, pos]
+            fh.write('\t'.join(fields) + '\n')
+            orient_bc[orient] += 1
+            orient_reads[orient] += count
+
+    metrics.histogram('barcodes_by_orient', orient_bc)
+    metrics.histogram('reads_by_orient', orient_reads)
+
+@profiled('associate_tags')
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Associate matched tags with parsed oligos")
+    p.add_argument('matched', help='Matched tag file (.match)')
+    p.add_argument('parsed', help='Parsed mapping file from MPRAmatch')
+    p.add_argument('out', help='Output tag association file')
+    p.add_argument('orientation', nargs='?', default=None,
+                   help='Barcode orientation (unused)')
+    p.add_argument('--rescue', action='store_true',
+                   help='Count barcodes one mismatch away from a single mapped barcode under that barcode')
+    args = p.parse_args(argv)
+    rescue = BarcodeWhitelist.from_parsed(args.parsed) if args.rescue else None
+    associate_tags(load_matched(args.matched), args.parsed, args.out, rescue)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+barcode_whitelist.py
+
+Library barcode membership test for make_counts.py: the barcodes (column 1)
+of a .parsed map from the match step.
+
+Barcodes of up to 31 bases over ACGT are packed 2 bits per base, behind a
+sentinel bit that keeps lengths apart, into one sorted numpy uint64 array
+(8 bytes per barcode instead of ~80 for a str in a set). Reads are checked in
+batches with a single vectorized searchsorted, which is exact, so no second
+confirmation step is needed. The few barcodes that cannot be packed (N or
+other characters, longer than 31 bases) are kept in a plain set.
+
+rescue() finds, for barcodes outside the library, the one library barcode
+that differs by a single substitution (sequencing error): the 3 x length
+substituted keys of every barcode are looked up with the same searchsorted, so
+there is no neighbour index to build or store.
+
+Usage:
+    barcode_whitelist.py [--rescue] <parsed> [barcode ...]   # size of the whitelist, membership of the barcodes
+"""
+import argparse
+import gzip
+from collections import defaultdict
+
+import numpy as np
+
+from mpra_metrics import profiled
+
+MAX_PACKED = 31
+
+_CODE = np.full(256, 255, dtype=np.uint8)
+for _i, _c in enumerate(b'ACGT'):
+    _CODE[_c] = _CODE[_c + 32] = _i
+
+_BASE = np.frombuffer(b'ACGT', dtype=np.uint8)
+_RESCUE_CHUNK = 1 << 16
+
+def _codes(barcodes, length):
+    """(n, length) base codes 0-3 of equal-length barcodes, 255 where not ACGT."""
+    raw = np.frombuffer(''.join(barcodes).encode('ascii', 'replace'), dtype=np.uint8)
+    return _CODE[raw.reshape(-1, length)]
+
+def _packed(codes):
+    keys = np.ones(len(codes), dtype=np.uint64)
+    for j in range(codes.shape[1]):
+        keys = (keys << np.uint64(2)) | (codes[:, j] & 3).astype(np.uint64)
+    return keys
+
+def _pack(barcodes, length):
+    """Packed keys of equal-length barcodes and a mask of those that are pure ACGT."""
+    codes = _codes(barcodes, length)
+    return _packed(codes), (codes != 255).all(axis=1)
+
+def _unpack(keys, length):
+    shifts = np.uint64(2) * np.arange(length - 1, -1, -1, dtype=np.uint64)
+    codes = ((keys[:, None] >> shifts) & np.uint64(3)).astype(np.intp)
+    return [bc.decode() for bc in _BASE[codes].view(f'S{length}').ravel()]
+
+def _by_length(barcodes):
+    lengths = defaultdict(list)
+    for i, bc in enumerate(barcodes):
+        lengths[len(bc)].append(i)
+    return lengths.items()
+
+class BarcodeWhitelist:
+    def __init__(self, keys, extra=()):
+        self.keys = np.unique(np.asarray(keys, dtype=np.uint64))
+        self.extra = set(extra)
+
+    @classmethod
+    def from_barcodes(cls, barcodes, chunk=1 << 20):
+        keys, extra = [], set()
+        barcodes = iter(barcodes)
+        while True:
+            batch = [bc for _, bc in zip(range(chunk), barcodes)]
+            if not batch:
+                break
+            for length, idx in _by_length(batch):
+                group = [batch[i] for i in idx]
+                if not 0 < length <= MAX_PACKED:
+                    extra.update(group)
+                    continue
+                packed, valid = _pack(group, length)
+                keys.append(packed[valid])
+                extra.update(bc for bc, ok in zip(group, valid) if not ok)
+        return cls(np.concatenate(keys) if keys else [], extra)
+
+    @classmethod
+    def from_parsed(cls, path):
+        """Barcodes of a parsed mapping file (same rows as associate_tags.parsed_entries)."""
+        opener = gzip.open if path.endswith(('.gz', '.gzip')) else open
+        with opener(path, 'rt') as fh:
+            return cls.from_barcodes(line.split('\t', 1)[0] for line in fh if line.count('\t') >= 9)
+
+    def __len__(self):
+        return len(self.keys) + len(self.extra)
+
+    def __contains__(self, barcode):
+        return bool(self.contains([barcode])[0])
+
+    def contains(self, barcodes):
+        """Boolean numpy array: which of the barcodes are in the library."""
+        hit = np.zeros(len(barcodes), dtype=bool)
+        for length, idx in _by_length(barcodes):
+            group = [barcodes[i] for i in idx]
+            if not 0 < length <= MAX_PACKED or not len(self.keys):
+                hit[idx] = [bc in self.extra for bc in group]
+                continue
+            packed, valid = _pack(group, length)
+            pos = np.minimum(np.searchsorted(self.keys, packed), len(self.keys) - 1)
+            found = valid & (self.keys[pos] == packed)
+            if self.extra:
+                found |= ~valid & np.fromiter((bc in self.extra for bc in group), dtype=bool, count=len(group))
+            hit[idx] = found
+        return hit
+
+    def rescue(self, barcodes):
+        """Library barcode one substitution away from each barcode, or None.
+
+        A barcode with a single N (or other non-ACGT base) is tried with each
+        base at that position. Only unambiguous neighbours count: a barcode
+        next to two library barcodes gets None. Meant for barcodes that are
+        not themselves in the library.
+        """
+        parent = [None] * len(barcodes)
+        if not len(self.keys):
+            return parent
+        for length, idx in _by_length(barcodes):
+            if not 0 < length <= MAX_PACKED:
+                continue
+            for start in range(0, len(idx), _RESCUE_CHUNK):
+                chunk = idx[start:start + _RESCUE_CHUNK]
+                codes = _codes([barcodes[i] for i in chunk], length)
+                bad = codes == 255
+                n_bad = bad.sum(axis=1)
+                codes[bad] = 0
+                keys = _packed(codes)
+                shifts = np.uint64(2) * np.arange(length - 1, -1, -1, dtype=np.uint64)
+                # all 3 * length substitutions of a clean barcode: XOR one code with 1-3
+                sub = (np.arange(1, 4, dtype=np.uint64)[:, None] << shifts).ravel()
+                for rows, cand in (
+                        (n_bad == 0, lambda r: keys[r, None] ^ sub),
+                        # the 4 bases at the one bad position (zeroed above)
+                        (n_bad == 1, lambda r: keys[r, None] ^ (np.arange(4, dtype=np.uint64)
+                                                                << shifts[bad[r].argmax(axis=1)][:, None]))):
+                    rows = np.flatnonzero(rows)
+                    if not len(rows):
+                        continue
+                    cand = cand(rows)
+                    pos = np.minimum(np.searchsorted(self.keys, cand), len(self.keys) - 1)
+                    hit = self.keys[pos] == cand
+                    unique = hit.sum(axis=1) == 1
+                    found = cand[unique, hit[unique].argmax(axis=1)]
+                    for r, bc in zip(rows[unique], _unpack(found, length)):
+                        parent[chunk[r]] = bc
+        return parent
+
+@profiled('barcode_whitelist')
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Library barcode whitelist from a .parsed map")
+    p.add_argument('parsed', help='Parsed mapping file from the match step')
+    p.add_argument('barcodes', nargs='*', help='Barcodes to look up')
+    p.add_argument('--rescue', action='store_true',
+                   help='Also print the library barcode one mismatch away from each barcode not in it')
+    args = p.parse_args(argv)
+    wl = BarcodeWhitelist.from_parsed(args.parsed)
+    print(f"{len(wl):,} library barcodes ({len(wl.extra):,} unpacked, {wl.keys.nbytes:,} bytes packed)")
+    parents = wl.rescue(args.barcodes) if args.rescue else [None] * len(args.barcodes)
+    for bc, ok, parent in zip(args.barcodes, wl.contains(args.barcodes), parents):
+        print(f"{bc}\t{'library' if ok else 'not_in_library'}" + (f"\t{parent}" if parent and not ok else ""))
+
+if __name__ == '__main__':
+    main()
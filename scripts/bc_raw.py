@@ -3,40 +3,89 @@
 bc_raw.py
 
 Split the full MPRA count table into DNA vs. each cell-type:
-  - cond_file:  two-column TSV (celltype, replicate_count), includes DNA
+  - cond_file:  two-column TSV (replicate, celltype), includes DNA
   - count_table: full .count table from MPRAcount
   - id_out:      project prefix (used in output filenames)
   - out_dir:     directory to write the per-cell counts
+
+The count table is streamed once in fixed-size chunks of lines and every
+<id_out>_<cell>.counts file is written in the same pass, so memory stays
+bounded by the chunk size rather than the size of the table.
+
+Usage:
+    bc_raw.py [--chunk_size N] <cond_file> <count_table> <id_out> <out_dir>
 """
 
+import argparse
 import sys
-import pandas as pd
+from collections import OrderedDict
+from itertools import islice
 from pathlib import Path
 
-def main():
-    cond_file, count_file, id_out, out_dir = sys.argv[1:]
-    out_dir = Path(out_dir)
+from mpra_metrics import profiled
+
+def load_conditions(cond_file):
+    """Return an ordered mapping celltype -> [replicates], DNA first."""
+    cells = OrderedDict([('DNA', [])])
+    with open(cond_file) as f:
+        for line in f:
+            parts = line.rstrip('\n').split('\t')
+            if len(parts) < 2 or not parts[0]:
+                continue
+            rep, cell = parts[0], parts[1]
+            cells.setdefault(cell, []).append(rep)
+    return cells
+
+@profiled('bc_raw')
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Split the MPRA count table into per-cell-type count files")
+    p.add_argument('cond_file', help='Two-column condition TSV (replicate, celltype)')
+    p.add_argument('count_table', help='Full barcode-level .count table')
+    p.add_argument('id_out', help='Project prefix used in output filenames')
+    p.add_argument('out_dir', help='Directory to write the per-cell counts')
+    p.add_argument('--chunk_size', type=int, default=200000,
+                   help='Number of rows buffered per write (default 200000)')
+    args = p.parse_args(argv)
+
+    out_dir = Path(args.out_dir)
     out_dir.mkdir(parents=True, exist_ok=True)
 
-    # Load condition metadata
-    cond = pd.read_csv(cond_file, sep='\t', header=None, index_col=0, names=['condition'])
-    cond['condition'] = pd.Categorical(cond['condition'], categories=['DNA'] + [c for c in cond.index if c != 'DNA'], ordered=True)
+    cells = load_conditions(args.cond_file)
+    dna_reps = cells['DNA']
 
-    # Load the full barcode-level count table
-    df = pd.read_csv(count_file, sep='\t', dtype=str)
+    with open(args.count_table) as fin:
+        header = fin.readline().rstrip('\n').split('\t')
+        col_idx = {name: i for i, name in enumerate(header)}
 
-    # For each non-DNA celltype, write out subset
-    for cell in cond['condition'].cat.categories:
-        if cell == 'DNA':
-            continue
         # pick columns: Barcode, Oligo, plus any replicates labeled DNA or this cell
-        reps = cond.index[(cond['condition']=='DNA') | (cond['condition']==cell)]
-        cols = ['Barcode','Oligo'] + list(reps)
-        subset = df.loc[:, cols]
-        subset.to_csv(out_dir / f"{id_out}_{cell}.counts", sep='\t', index=False, quoting=False)
+        projections = OrderedDict()
+        for cell, reps in cells.items():
+            if cell == 'DNA':
+                continue
+            cols = ['Barcode', 'Oligo'] + dna_reps + reps
+            missing = [c for c in cols if c not in col_idx]
+            if missing:
+                sys.exit(f"ERROR: columns {missing} for {cell} not found in {args.count_table}")
+            projections[cell] = [col_idx[c] for c in cols]
+
+        handles = {cell: open(out_dir / f"{args.id_out}_{cell}.counts", 'w')
+                   for cell in projections}
+        try:
+            for cell, idx in projections.items():
+                handles[cell].write('\t'.join(header[i] for i in idx) + '\n')
+
+            while True:
+                chunk = list(islice(fin, args.chunk_size))
+                if not chunk:
+                    break
+                rows = [line.rstrip('\n').split('\t') for line in chunk]
+                for cell, idx in projections.items():
+                    handles[cell].write(''.join(
+                        '\t'.join([row[i] for i in idx]) + '\n' for row in rows
+                    ))
+        finally:
+            for fh in handles.values():
+                fh.close()
 
 if __name__ == '__main__':
-    if len(sys.argv) != 5:
-        print("Usage: bc_raw.py <cond_file> <count_table> <id_out> <out_dir>", file=sys.stderr)
-        sys.exit(1)
     main()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+build_attributes.py
+
+Single-pass replacement for map_oligos_proj.py -> make_project_list.py -> cat ->
+make_attributes_oligo.py in run_model.sh.
+
+Reads the reference FASTA once, joins each record's tile IDs (composite
+"(tile1; tile2)" headers are split on ';') against tile_proj_map.tsv, and
+writes directly:
+    <outdir>/<id_out>.proj_list   -- oligo_id <tab> project, grouped by project
+    <outdir>/<id_out>.attributes  -- attributes table for MPRAmodel
+
+Per-project FASTAs (<project>.fasta.gz, unassigned.fasta.gz) and
+expected_fastas.txt are only written with --write_fastas; each project file is
+compressed on its own thread.
+
+Usage:
+    build_attributes.py -m <tile_proj_map.tsv> -f <reference.fasta[.gz]> -o <outdir> -i <id_out> [--write_fastas]
+"""
+import argparse
+import csv
+import gzip
+import os
+import queue
+import sys
+import threading
+from collections import Counter, OrderedDict
+
+from make_attributes_oligo import write_attributes
+from make_project_list import header_to_id
+from mpra_metrics import profiled
+
+def open_by_suffix(filename):
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rt')
+    return open(filename, 'r')
+
+def read_fasta(path, with_seq=False):
+    """Yield (header, sequence) per record; sequence is None unless with_seq."""
+    header, seq = None, []
+    with open_by_suffix(path) as fh:
+        for line in fh:
+            if line.startswith('>'):
+                if header is not None:
+                    yield header, (''.join(seq) if with_seq else None)
+                header, seq = line[1:].strip(), []
+            elif with_seq:
+                seq.append(line.strip())
+        if header is not None:
+            yield header, (''.join(seq) if with_seq else None)
+
+class FastaWriters:
+    """One gzip writer thread per output file, fed through bounded queues."""
+
+    def __init__(self, paths, maxsize=10000):
+        self.queues = {}
+        self.threads = []
+        for key, path in paths.items():
+            q = queue.Queue(maxsize=maxsize)
+            t = threading.Thread(target=self._drain, args=(q, path), daemon=True)
+            t.start()
+            self.queues[key] = q
+            self.threads.append(t)
+
+    @staticmethod
+    def _drain(q, path):
+        with gzip.open(path, 'wt', compresslevel=6) as out:
+            while True:
+                item = q.get()
+                if item is None:
+                    return
+                out.write(item)
+
+    def write(self, key, header, seq):
+        self.queues[key].put(f">{header}\n{seq}\n")
+
+    def close(self):
+        for q in self.queues.values():
+            q.put(None)
+        for t in self.threads:
+            t.join()
+
+@profiled('build_attributes')
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Build <id>.proj_list and <id>.attributes from the reference FASTA in one pass")
+    p.add_argument('-m', '--map', dest='map_tsv', required=True, help='Path to the tile-to-project TSV file')
+    p.add_argument('-f', '--fasta', dest='ref_fasta', required=True, help='Path to the reference FASTA (.gz)')
+    p.add_argument('-o', '--outdir', required=True, help='Output directory')
+    p.add_argument('-i', '--id_out', required=True, help='Output prefix for .proj_list / .attributes')
+    p.add_argument('--write_fastas', action='store_true',
+                   help='Also write one gzipped FASTA per project (plus unassigned)')
+    args = p.parse_args(argv)
+
+    os.makedirs(args.outdir, exist_ok=True)
+
+    # -- 1) Read the TSV map file into a dictionary: ID -> project
+    id_to_proj = {}
+    try:
+        with open(args.map_tsv, newline='') as tsv:
+            for row in csv.DictReader(tsv, delimiter='\t'):
+                id_to_proj[row['ID']] = row['project']
+    except Exception as e:
+        print(f"Error reading TSV map file: {e}", file=sys.stderr)
+        sys.exit(1)
+    projects = sorted(set(id_to_proj.values()))
+
+    writers = None
+    if args.write_fastas:
+        paths = OrderedDict((proj, os.path.join(args.outdir, f"{proj}.fasta.gz")) for proj in projects)
+        paths['unassigned'] = os.path.join(args.outdir, 'unassigned.fasta.gz')
+        writers = FastaWriters(paths)
+
+    # -- 2) One pass over the reference headers
+    proj_ids = OrderedDict((proj, []) for proj in projects)
+    counts = Counter()
+    seen_ids = set()
+    unassigned_ids = []
+    total_records = 0
+    try:
+        for full_header, seq in read_fasta(args.ref_fasta, with_seq=args.write_fastas):
+            total_records += 1
+            tile_ids = [tid.strip() for tid in full_header.strip('()').split(';')]
+            seen_ids.update(tile_ids)
+            matched = {id_to_proj[tid] for tid in tile_ids if tid in id_to_proj}
+            # same ID the per-project FASTA -> make_project_list route produced
+            oligo_id = header_to_id(full_header)
+            if matched:
+                for proj in matched:
+                    proj_ids[proj].append(oligo_id)
+                    counts[proj] += 1
+                    if writers:
+                        writers.write(proj, full_header, seq)
+            else:
+                counts['unassigned'] += 1
+                unassigned_ids.append(full_header)
+                if writers:
+                    writers.write('unassigned', full_header, seq)
+    finally:
+        if writers:
+            writers.close()
+
+    # -- 3) proj_list grouped by project, then attributes (last project wins, as before)
+    oligo_proj = {}
+    proj_list_path = os.path.join(args.outdir, f"{args.id_out}.proj_list")
+    with open(proj_list_path, 'w') as out:
+        for proj, ids in proj_ids.items():
+            for oligo_id in ids:
+                out.write(f"{oligo_id}\t{proj}\n")
+                oligo_proj[oligo_id] = proj
+    write_attributes(oligo_proj, os.path.join(args.outdir, f"{args.id_out}.attributes"))
+
+    # -- 4) Reports
+    print(f"Total records processed: {total_records}")
+    for proj, cnt in counts.items():
+        print(f"  {proj}: {cnt}")
+    if args.write_fastas:
+        with open(os.path.join(args.outdir, 'expected_fastas.txt'), 'w') as ef:
+            for proj in projects:
+                ef.write(f"{proj}.fasta.gz\n")
+    if unassigned_ids:
+        with open(os.path.join(args.outdir, 'unassigned_ids.txt'), 'w') as fout:
+            for uid in unassigned_ids:
+                fout.write(uid + '\n')
+        print(f"Tiles in FASTA without mapping (unassigned): {len(unassigned_ids)} (see unassigned_ids.txt)")
+    missing_tsv_ids = sorted(set(id_to_proj) - seen_ids)
+    if missing_tsv_ids:
+        with open(os.path.join(args.outdir, 'tsv_ids_not_in_fasta.txt'), 'w') as fout:
+            for tid in missing_tsv_ids:
+                fout.write(tid + '\n')
+        print(f"Tiles in TSV not found in FASTA: {len(missing_tsv_ids)} (written to tsv_ids_not_in_fasta.txt)")
+    print(f"Wrote {proj_list_path} and {args.id_out}.attributes")
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,36 @@
 #!/usr/bin/env python3
 import argparse
+import contextlib
+import heapq
+import multiprocessing
+import os
+import shutil
 import sys
 import logging
+import tempfile
+import time
+import zlib
 from collections import defaultdict, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
-def parse_args():
+from mpra_metrics import Heartbeat, Metrics, profiled
+from oligo_matrix import OligoAggregator
+
+def parse_args(argv=None):
     p = argparse.ArgumentParser(description="Compile barcode counts with optional CIGAR/MD/Score/Position info")
     p.add_argument('-E', action='store_true', dest='err_flag', help='Append error rates')
     p.add_argument('-C', action='store_true', dest='cigar_flag', help='Append CIGAR strings')
     p.add_argument('-M', action='store_true', dest='md_flag', help='Append MD tags')
     p.add_argument('-S', action='store_true', dest='pos_flag', help='Append alignment start/stop')
     p.add_argument('-A', dest='aln_cutoff', type=float, default=0.05, help='Alignment error cutoff (default 0.05)')
+    p.add_argument('-O', dest='oligo_out', default=None,
+                   help='Also write <prefix>.oligo_counts / .oligo_barcodes oligo x sample matrices')
+    p.add_argument('-P', dest='partitions', type=int, default=1,
+                   help='Split barcodes by hash into this many shards compiled in parallel '
+                        '(default 1: one pass on one core)')
     p.add_argument('list_file', help='TSV: sample_id<tab>counts_file')
     p.add_argument('out_file', help='Output combined count table')
-    return p.parse_args()
+    return p.parse_args(argv)
 
 def load_file_list(path):
     file_list = OrderedDict()
@@ -26,43 +43,40 @@ def load_file_list(path):
             file_list[sample] = fname
     return file_list
 
-def main():
-    args = parse_args()
+def shard_of(barcode, partitions):
+    return zlib.crc32(barcode.encode()) % partitions
 
-    # Setup logging to a dedicated log file
-    log_file = args.out_file + '.log'
-    logging.basicConfig(
-        filename=log_file,
-        filemode='w',
-        level=logging.INFO,
-        format='%(asctime)s [%(levelname)s] %(message)s'
-    )
-    logger = logging.getLogger()
+class Compiled:
+    """Barcode rows merged across samples, with the duplicate and consistency checks."""
+    def __init__(self, aln_cutoff, logger):
+        self.aln_cutoff = aln_cutoff
+        self.logger = logger
+        self.counts = defaultdict(dict)
+        self.oligo_id = {}
+        self.aln = {}
+        self.cigar = {}
+        self.md = {}
+        self.pos = {}
+        self.sample_stats = defaultdict(lambda: defaultdict(lambda: {'ct': 0, 'sum': 0}))
+        self.origin = {}   # barcode -> (sample index, line) where a numbered read first kept it
 
-    if args.err_flag:
-        logger.info("Appending alignment scores")
-    if args.cigar_flag:
-        logger.info("Appending CIGAR strings")
-    if args.md_flag:
-        logger.info("Appending MD tags")
-    if args.pos_flag:
-        logger.info("Appending start/stop positions")
-    logger.info(f"Using {args.aln_cutoff} error rate for alignment cutoff")
-
-    file_list = load_file_list(args.list_file)
-
-    counts = defaultdict(dict)
-    oligo_id = {}
-    aln = {}
-    cigar = {}
-    md = {}
-    pos = {}
-    sample_stats = defaultdict(lambda: defaultdict(lambda: {'ct': 0, 'sum': 0}))
+    def read(self, sample_id, fname, beat, sample_index=None):
+        """Merge one tag file (or one shard of it); returns the number of lines read.
 
-    for sample_id, fname in file_list.items():
-        logger.info(f"Reading {sample_id} from {fname}")
+        With sample_index the lines carry their line number in the sample's tag
+        file as a leading field (see partition_sample), recorded in origin.
+        """
+        logger = self.logger
+        counts, oligo_id, aln, cigar, md, pos = self.counts, self.oligo_id, self.aln, self.cigar, self.md, self.pos
+        origin = self.origin
+        sample_stats = self.sample_stats[sample_id]
+        n_lines = 0
         with open(fname) as f:
             for line in f:
+                n_lines += 1
+                beat.tick(1, len(line))
+                if sample_index is not None:
+                    line_no, line = line.split('\t', 1)
                 parts = line.rstrip('\n').split('\t')
                 if len(parts) < 10:
                     continue
@@ -72,15 +86,15 @@ def main():
                 except ValueError:
                     continue
                 flag_B = parts[2]
-                oligo = parts[3]
+                oligo = sys.intern(parts[3])   # one shared str per oligo across barcodes
                 bc_flag = parts[4]
                 bc_aln_str = parts[6]
                 bc_cigar_str = parts[7]
                 bc_md_str = parts[8]
                 bc_pos_str = parts[9]
 
-                sample_stats[sample_id][bc_flag]['ct'] += 1
-                sample_stats[sample_id][bc_flag]['sum'] += bc_ct
+                sample_stats[bc_flag]['ct'] += 1
+                sample_stats[bc_flag]['sum'] += bc_ct
 
                 if ',' in bc_aln_str or bc_aln_str == "NA":
                     continue
@@ -91,7 +105,9 @@ def main():
                     continue
 
                 if bc_flag in ('0', '2') and oligo != '*':
-                    if bc_aln <= args.aln_cutoff:
+                    if bc_aln <= self.aln_cutoff:
+                        if sample_index is not None and barcode not in counts:
+                            origin[barcode] = (sample_index, int(line_no))
                         if sample_id in counts[barcode]:
                             logger.error(f"Duplicate barcode/sample combo {barcode}/{sample_id}")
                             raise RuntimeError(f"Duplicate barcode/sample combo {barcode}/{sample_id}")
@@ -118,8 +134,138 @@ def main():
                             cigar[barcode] = bc_cigar_str
                             md[barcode] = bc_md_str
                             pos[barcode] = bc_pos_str
+        return n_lines
+
+    def write_rows(self, out, args, samples, oligo_agg, numbered=False):
+        """Rows in first-seen order; numbered prefixes each with its origin (sample, line)."""
+        for bc in self.counts:
+            row = [bc, self.oligo_id[bc]]
+            if numbered:
+                row[:0] = map(str, self.origin[bc])
+            if args.err_flag: row.append(str(self.aln[bc]))
+            if args.cigar_flag: row.append(self.cigar[bc])
+            if args.md_flag: row.append(self.md[bc])
+            if args.pos_flag: row.append(self.pos[bc])
+            values = [self.counts[bc].get(sample_id, 0) for sample_id in samples]
+            row.extend(map(str, values))
+            out.write('\t'.join(row) + '\n')
+            if oligo_agg is not None:
+                oligo_agg.add(self.oligo_id[bc], values)
+
+def partition_sample(fname, prefix, partitions):
+    """Split one tag file into <prefix>.<shard> files by barcode hash; returns lines read.
+
+    Each line is written behind its line number, so the shards can be merged
+    back into the serial (first-seen) barcode order.
+    """
+    outs = [open(f"{prefix}.{k}", 'w') for k in range(partitions)]
+    n_lines = 0
+    start = time.perf_counter()
+    with open(fname) as f:
+        for line in f:
+            n_lines += 1
+            outs[shard_of(line.split('\t', 1)[0], partitions)].write(f"{n_lines}\t{line}")
+    for out in outs:
+        out.close()
+    return n_lines, time.perf_counter() - start
+
+def compile_shard(shard, samples, work_dir, args):
+    """Compile one barcode shard across all samples into <work_dir>/rows.<shard>.
+
+    The rows are numbered with their origin and, like the serial rows, come
+    out in first-seen order. Returns the per-sample stats, the oligo aggregate
+    of the shard and the origin of each oligo's first row.
+    """
+    start = time.perf_counter()
+    compiled = Compiled(args.aln_cutoff, logging.getLogger())
+    beat = Heartbeat(Metrics('compile_bc_cs', sample=f"shard{shard}"), 'lines')
+    for i, sample_id in enumerate(samples):
+        compiled.read(sample_id, os.path.join(work_dir, f"s{i}.{shard}"), beat, sample_index=i)
+    oligo_agg = OligoAggregator(samples) if args.oligo_out else None
+    with open(os.path.join(work_dir, f"rows.{shard}"), 'w') as out:
+        compiled.write_rows(out, args, samples, oligo_agg, numbered=True)
+    stats = {sid: {key: dict(st) for key, st in keys.items()} for sid, keys in compiled.sample_stats.items()}
+    oligo_origin = {}
+    if oligo_agg is not None:
+        for bc in compiled.counts:
+            oligo_origin.setdefault(compiled.oligo_id[bc], compiled.origin[bc])
+    return stats, oligo_agg, oligo_origin, len(compiled.counts), time.perf_counter() - start
+
+def numbered_row(line):
+    sample_index, line_no, row = line.split('\t', 2)
+    return (int(sample_index), int(line_no)), row
+
+def compile_partitioned(file_list, args, out, metrics):
+    """Hash-partition the tag files, compile the shards in parallel and append their rows to out.
+
+    Returns the sample stats reduced across shards and the merged oligo aggregate.
+    """
+    samples = list(file_list.keys())
+    work_dir = tempfile.mkdtemp(prefix='compile_bc_cs.', dir=os.path.dirname(os.path.abspath(args.out_file)))
+    sample_stats = defaultdict(lambda: defaultdict(lambda: {'ct': 0, 'sum': 0}))
+    oligo_agg = OligoAggregator(samples) if args.oligo_out else None
+    oligo_origin = {}
+    try:
+        with ProcessPoolExecutor(args.partitions, mp_context=multiprocessing.get_context("fork")) as pool:
+            jobs = {sample_id: pool.submit(partition_sample, fname, os.path.join(work_dir, f"s{i}"), args.partitions)
+                    for i, (sample_id, fname) in enumerate(file_list.items())}
+            for sample_id, job in jobs.items():
+                n_lines, seconds = job.result()
+                metrics.for_sample(sample_id).timing('read_sample', seconds, records=n_lines)
+            shards = [pool.submit(compile_shard, k, samples, work_dir, args) for k in range(args.partitions)]
+            for k, job in enumerate(shards):
+                stats, shard_agg, shard_origin, n_barcodes, seconds = job.result()
+                metrics.timing('compile_shard', seconds, records=n_barcodes, shard=k)
+                for sample_id, keys in stats.items():
+                    for key, st in keys.items():
+                        sample_stats[sample_id][key]['ct'] += st['ct']
+                        sample_stats[sample_id][key]['sum'] += st['sum']
+                if oligo_agg is not None:
+                    oligo_agg.merge(shard_agg)
+                    for oligo, origin in shard_origin.items():
+                        if oligo not in oligo_origin or origin < oligo_origin[oligo]:
+                            oligo_origin[oligo] = origin
+        # merge the shards on their rows' origins: the serial path's order
+        with contextlib.ExitStack() as stack:
+            shard_rows = [map(numbered_row, stack.enter_context(open(os.path.join(work_dir, f"rows.{k}"))))
+                          for k in range(args.partitions)]
+            out.writelines(row for _, row in heapq.merge(*shard_rows))
+    finally:
+        shutil.rmtree(work_dir)
+    if oligo_agg is not None:
+        oligo_agg.reorder(sorted(oligo_origin, key=oligo_origin.get))
+    return sample_stats, oligo_agg
+
+@profiled('compile_bc_cs')
+def main(argv=None):
+    args = parse_args(argv)
+
+    # Setup logging to a dedicated log file
+    log_file = args.out_file + '.log'
+    logging.basicConfig(
+        filename=log_file,
+        filemode='w',
+        level=logging.INFO,
+        format='%(asctime)s [%(levelname)s] %(message)s',
+        force=True,   # reconfigure when called repeatedly in one interpreter
+    )
+    logger = logging.getLogger()
+
+    if args.err_flag:
+        logger.info("Appending alignment scores")
+    if args.cigar_flag:
+        logger.info("Appending CIGAR strings")
+    if args.md_flag:
+        logger.info("Appending MD tags")
+    if args.pos_flag:
+        logger.info("Appending start/stop positions")
+    logger.info(f"Using {args.aln_cutoff} error rate for alignment cutoff")
+
+    file_list = load_file_list(args.list_file)
+    metrics = Metrics('compile_bc_cs')
+    # marks a full compile: mpra_metrics.sample_stats ignores anything earlier
+    metrics.counter('compiled_samples', len(file_list))
 
-    logger.info("Writing output file")
     with open(args.out_file, 'w') as out:
         header = ['Barcode', 'Oligo']
         if args.err_flag: header.append('Error')
@@ -129,15 +275,22 @@ def main():
         header.extend(file_list.keys())
         out.write('\t'.join(header) + '\n')
 
-        for bc in counts:
-            row = [bc, oligo_id[bc]]
-            if args.err_flag: row.append(str(aln[bc]))
-            if args.cigar_flag: row.append(cigar[bc])
-            if args.md_flag: row.append(md[bc])
-            if args.pos_flag: row.append(pos[bc])
-            for sample_id in file_list.keys():
-                row.append(str(counts[bc].get(sample_id, 0)))
-            out.write('\t'.join(row) + '\n')
+        if args.partitions > 1:
+            logger.info(f"Compiling {len(file_list)} samples in {args.partitions} barcode shards")
+            sample_stats, oligo_agg = compile_partitioned(file_list, args, out, metrics)
+        else:
+            compiled = Compiled(args.aln_cutoff, logger)
+            beat = Heartbeat(metrics, 'lines')
+            for sample_id, fname in file_list.items():
+                logger.info(f"Reading {sample_id} from {fname}")
+                sample_start = time.perf_counter()
+                n_lines = compiled.read(sample_id, fname, beat)
+                metrics.for_sample(sample_id).timing('read_sample', time.perf_counter() - sample_start, records=n_lines)
+
+            logger.info("Writing output file")
+            oligo_agg = OligoAggregator(file_list.keys()) if args.oligo_out else None
+            compiled.write_rows(out, args, file_list.keys(), oligo_agg)
+            sample_stats = compiled.sample_stats
 
         # Append summary pseudo-barcode lines for each sample
         logger.info("Writing summary stats to output file")
@@ -157,6 +310,12 @@ def main():
                 out.write('\t'.join(row) + '\n')
                 # Log summary stats for this sample/key
                 logger.info(f"Summary for sample={sample_id}, key={key}: count={st['ct']}, sum={st['sum']}")
+                metrics.for_sample(sample_id).counter('barcodes', st['ct'], key=key)
+                metrics.for_sample(sample_id).counter('reads', st['sum'], key=key)
+
+    if args.oligo_out:
+        logger.info(f"Writing oligo-level matrices to {args.oligo_out}.oligo_counts / .oligo_barcodes")
+        oligo_agg.write(args.oligo_out)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -5,17 +5,33 @@ count_qc.py
 Generate celltype-specific QC plots from MPRA count table.
 
 Usage:
-    count_qc.py <celltypes_file> <count_table> <id_out> <out_dir>
+    count_qc.py [--workers N] [--pdf <file>] <celltypes_file> <count_table> <id_out> <out_dir> [<oligo_counts> <oligo_barcodes>]
+
+If the oligo x sample matrices written by compile_bc_cs.py -O are given, the
+per-oligo sums and barcodes-per-oligo are read from them instead of being
+regrouped from the barcode-level table for every replicate.
+
+The histograms are binned with numpy while the tables are in memory and the
+pages are rendered afterwards (qc_plots.py), on --workers processes, or into
+the one multi-page PDF given with --pdf instead of one PDF per plot.
 """
+import argparse
+import os
 import sys
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
 from pathlib import Path
 
-def main(celltypes_file, count_table_file, id_out, floc):
+from mpra_metrics import profiled
+from qc_plots import hist_page, render_pages
+
+def count_qc(celltypes_file: str, count_table_file: str, id_out: str, floc: str,
+             oligo_counts_file: str = None, oligo_bc_file: str = None,
+             workers: int = 1, combined_pdf: str = None) -> None:
     out_dir = Path(floc)
     out_dir.mkdir(parents=True, exist_ok=True)
+    # set by count.py --preview: mark every plot as a preview
+    preview = os.environ.get("MPRA_PREVIEW")
 
     # 1) Load and write condition mapping
     ct = pd.read_csv(celltypes_file, sep='\t', header=None,
@@ -38,23 +54,36 @@ def main(celltypes_file, count_table_file, id_out, floc):
         if col in df.columns:
             df.drop(columns=col, inplace=True)
     print("\t".join(df.columns), file=sys.stderr)
+    # drop the per-sample summary pseudo-barcode rows appended by compile_bc_cs,
+    # which the oligo matrices do not carry either (as in oligo_matrix.py)
+    summary_tag = os.path.basename(count_table_file)
+    df = df[df['Oligo'].map(os.path.basename) != summary_tag].copy()
 
-    # 3) Loop over cell types
+    oligo_counts = oligo_bc = None
+    if oligo_counts_file and oligo_bc_file:
+        oligo_counts = pd.read_csv(oligo_counts_file, sep='\t', index_col='Oligo')
+        oligo_bc = pd.read_csv(oligo_bc_file, sep='\t', index_col='Oligo')
+
+    # 3) Loop over cell types, binning every histogram page
+    pages = []
     for cell in cond['condition'].cat.categories:
         if cell == 'DNA':
             continue
         reps = cond.index[cond['condition']==cell].tolist()
         print(f"\nCelltype: {cell}", file=sys.stderr)
         print("Replicates:", *reps, file=sys.stderr)
+        df[reps] = df[reps].astype(int)
 
         # Aggregated barcode-per-oligo
-        mask = (df[reps].astype(int) > 0).any(axis=1)
+        mask = (df[reps] > 0).any(axis=1)
         bc_counts = df.loc[mask, 'Oligo'].value_counts()
         agg_gt10 = (bc_counts > 10).sum()
 
         # Aggregated counts-per-oligo means
-        df[reps] = df[reps].astype(int)
-        agg_counts = df.groupby('Oligo')[reps].sum()
+        if oligo_counts is not None:
+            agg_counts = oligo_counts[reps].copy()
+        else:
+            agg_counts = df.groupby('Oligo')[reps].sum()
         agg_counts['means'] = agg_counts.mean(axis=1)
         mean_bound = np.percentile(agg_counts['means'], 90)
         tot_bound = 0.5 * agg_counts['means'].max()
@@ -62,63 +91,72 @@ def main(celltypes_file, count_table_file, id_out, floc):
         agg_ct_gt20 = (agg_counts['means'] > 20).sum()
         total_oligos = agg_counts.shape[0]
 
-        # Plot aggregated barcode histogram
-        plt.figure()
-        bc_counts.plot.hist(bins=200)
-        plt.axvline(10, color='red')
-        plt.xlabel("Barcodes per aggregated Oligo")
-        plt.title(f"Aggregated Barcode Count\n"
-                  f"{agg_gt10} >10 ("
-                  f"{agg_gt10/total_oligos*100:.1f}% of {total_oligos})")
-        plt.tight_layout()
-        plt.savefig(out_dir / f"{id_out}_{cell}_agg_barcode_QC.pdf")
-        plt.close()
+        # Aggregated barcode histogram
+        pages.append(hist_page(
+            out_dir / f"{id_out}_{cell}_agg_barcode_QC.pdf", bc_counts.values, 200,
+            "Barcodes per aggregated Oligo",
+            f"Aggregated Barcode Count\n"
+            f"{agg_gt10} >10 ("
+            f"{agg_gt10/total_oligos*100:.1f}% of {total_oligos})",
+            vline=10, preview=preview))
 
         # Clip means to xup to match R logic and fix histogram shape
-        agg_counts_clipped = agg_counts[agg_counts['means'] <= xup]
-        plt.figure()
-        ax = agg_counts_clipped['means'].plot.hist(bins=300)
-        plt.axvline(20, color='red')
-        plt.xlim(0, xup)
-        plt.xlabel("Mean Count per aggregated Oligo")
-        plt.title(f"Mean Oligo Counts\n"
-                  f"{agg_ct_gt20} >20 ("
-                  f"{agg_ct_gt20/total_oligos*100:.1f}% of {total_oligos})")
-        plt.tight_layout()
-        plt.savefig(out_dir / f"{id_out}_{cell}_agg_counts_QC.pdf")
-        plt.close()
+        agg_means_clipped = agg_counts.loc[agg_counts['means'] <= xup, 'means']
+        pages.append(hist_page(
+            out_dir / f"{id_out}_{cell}_agg_counts_QC.pdf", agg_means_clipped.values, 300,
+            "Mean Count per aggregated Oligo",
+            f"Mean Oligo Counts\n"
+            f"{agg_ct_gt20} >20 ("
+            f"{agg_ct_gt20/total_oligos*100:.1f}% of {total_oligos})",
+            vline=20, xlim=(0, xup), preview=preview))
 
         # Per-replicate histograms
         for rep in reps:
-            rep_series = df.loc[df[rep].astype(int) > 0, 'Oligo'].value_counts()
+            if oligo_bc is not None:
+                rep_series = oligo_bc.loc[oligo_bc[rep] > 0, rep]
+            else:
+                rep_series = df.loc[df[rep] > 0, 'Oligo'].value_counts()
             indv_gt10 = (rep_series > 10).sum()
-            plt.figure()
-            rep_series.plot.hist(bins=200)
-            plt.axvline(10, color='red')
-            plt.xlabel("Barcodes per Oligo")
-            plt.title(f"{cell} {rep} Barcode Count\n"
-                      f"{indv_gt10} >10")
-            plt.tight_layout()
-            plt.savefig(out_dir / f"{id_out}_{cell}_{rep}_barcode_QC.pdf")
-            plt.close()
-
-            rep_counts = df.groupby('Oligo')[rep].sum().astype(int)
+            pages.append(hist_page(
+                out_dir / f"{id_out}_{cell}_{rep}_barcode_QC.pdf", rep_series.values, 200,
+                "Barcodes per Oligo",
+                f"{cell} {rep} Barcode Count\n"
+                f"{indv_gt10} >10",
+                vline=10, preview=preview))
+
+            if oligo_counts is not None:
+                rep_counts = oligo_counts[rep]
+            else:
+                rep_counts = df.groupby('Oligo')[rep].sum()
             clip_val = np.percentile(rep_counts, 80)
             rep_counts_clipped = rep_counts[rep_counts <= clip_val]
             indv_ct_gt20 = (rep_counts > 20).sum()
             max_ct = rep_counts.max()
-            plt.figure()
-            rep_counts_clipped.plot.hist(bins=200)
-            plt.axvline(10, color='red')
-            plt.xlabel("Counts per Oligo")
-            plt.title(f"{cell} {rep} Oligo Counts\n"
-                      f"{indv_ct_gt20} >20, max={max_ct}")
-            plt.tight_layout()
-            plt.savefig(out_dir / f"{id_out}_{cell}_{rep}_counts_QC.pdf")
-            plt.close()
+            pages.append(hist_page(
+                out_dir / f"{id_out}_{cell}_{rep}_counts_QC.pdf", rep_counts_clipped.values, 200,
+                "Counts per Oligo",
+                f"{cell} {rep} Oligo Counts\n"
+                f"{indv_ct_gt20} >20, max={max_ct}",
+                vline=10, preview=preview))
+
+    # 4) Render
+    render_pages(pages, workers, combined_pdf)
+    print(f"Wrote {len(pages)} QC plots" + (f" to {combined_pdf}" if combined_pdf else ""), file=sys.stderr)
+
+@profiled('count_qc')
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Cell-type and replicate QC plots from an MPRA count table")
+    p.add_argument('celltypes_file', help='acc_id table: file, replicate, celltype, material')
+    p.add_argument('count_table', help='Compiled .count table')
+    p.add_argument('id_out', help='Output prefix')
+    p.add_argument('out_dir', help='Output directory')
+    p.add_argument('oligo_counts', nargs='?', help='<prefix>.oligo_counts from compile_bc_cs.py -O')
+    p.add_argument('oligo_barcodes', nargs='?', help='<prefix>.oligo_barcodes from compile_bc_cs.py -O')
+    p.add_argument('--workers', type=int, default=1, help='Processes rendering the plots (default 1)')
+    p.add_argument('--pdf', default=None, help='Write all plots as pages of this one PDF')
+    args = p.parse_args(argv)
+    count_qc(args.celltypes_file, args.count_table, args.id_out, args.out_dir,
+             args.oligo_counts, args.oligo_barcodes, args.workers, args.pdf)
 
 if __name__ == '__main__':
-    if len(sys.argv) != 5:
-        print(__doc__, file=sys.stderr)
-        sys.exit(1)
-    main(*sys.argv[1:])
+    main()
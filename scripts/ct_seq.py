@@ -1,8 +1,11 @@
 #!/usr/bin/env python3
 import argparse
-from collections import defaultdict
+from collections import Counter, defaultdict
 
-def process_group(cur_hits, cur_pass_flag, cur_hits_score, cur_cigar, cur_mdtag, cur_pos, ct_pass_flag, last_barcode):
+from mpra_metrics import Heartbeat, Metrics, profiled
+from oligo_ids import OligoIds
+
+def process_group(cur_hits, cur_pass_flag, cur_hits_score, cur_cigar, cur_mdtag, cur_pos, ct_pass_flag, last_barcode, ids=None):
     # Prepare outputs for one barcode group
     keys = list(cur_hits.keys())
     values = [cur_hits[k] for k in keys]
@@ -27,7 +30,7 @@ def process_group(cur_hits, cur_pass_flag, cur_hits_score, cur_cigar, cur_mdtag,
     # Build line
     out_fields = [
         last_barcode,
-        ",".join(keys),
+        ",".join(map(ids.decode, keys) if ids is not None else keys),
         ",".join(str(v) for v in values),
         str(total),
         str(group_flag),
@@ -38,17 +41,22 @@ def process_group(cur_hits, cur_pass_flag, cur_hits_score, cur_cigar, cur_mdtag,
         ",".join(best_pos)
     ]
     print("	".join(out_fields))
+    return group_flag
 
 
-def main():
+@profiled('ct_seq')
+def main(argv=None):
     parser = argparse.ArgumentParser(description="Python version of Ct_seq.pl")
     parser.add_argument("input", help="Mapped input file (sam2mpra output)")
     parser.add_argument("ct_col", type=int, help="1-based column index for barcode")
     parser.add_argument("cmp_col", type=int, help="1-based column index for compare id")
-    args = parser.parse_args()
+    parser.add_argument("--ids", default=None,
+                        help="oligo_ids.py table: the compare ids are codes, write them as names")
+    args = parser.parse_args(argv)
 
     CT_COL = args.ct_col - 1
     CMP_COL = args.cmp_col - 1
+    ids = OligoIds.load(args.ids) if args.ids else None
 
     first = True
     cur_hits = defaultdict(int)
@@ -59,9 +67,15 @@ def main():
     cur_pos = defaultdict(list)
     ct_pass_flag = 2
     last_barcode = None
+    metrics = Metrics('ct_seq')
+    group_flags = Counter()
+    n_records = 0
+    beat = Heartbeat(metrics, 'records')
 
-    with open(args.input) as fin:
+    with metrics.timer() as timing, open(args.input) as fin:
         for line in fin:
+            n_records += 1
+            beat.tick(1, len(line))
             parts = line.rstrip().split("	")
             if first:
                 last_parts = parts
@@ -97,9 +111,9 @@ def main():
                 cur_pos[cmp_id].append(parts[13])
             else:
                 # Flush previous group
-                process_group(cur_hits, cur_pass_flag, cur_hits_score,
-                              cur_cigar, cur_mdtag, cur_pos,
-                              ct_pass_flag, last_barcode)
+                group_flags[process_group(cur_hits, cur_pass_flag, cur_hits_score,
+                                          cur_cigar, cur_mdtag, cur_pos,
+                                          ct_pass_flag, last_barcode, ids)] += 1
                 # Reset for new group
                 cur_hits.clear()
                 cur_pass_flag.clear()
@@ -122,9 +136,13 @@ def main():
 
         # End of file: flush last group
         if not first:
-            process_group(cur_hits, cur_pass_flag, cur_hits_score,
-                          cur_cigar, cur_mdtag, cur_pos,
-                          ct_pass_flag, last_barcode)
+            group_flags[process_group(cur_hits, cur_pass_flag, cur_hits_score,
+                                      cur_cigar, cur_mdtag, cur_pos,
+                                      ct_pass_flag, last_barcode, ids)] += 1
+        timing['records'] = n_records
+
+    metrics.counter('records_in', n_records)
+    metrics.histogram('barcodes_by_flag', group_flags)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+inprocess.py
+
+Run the helper scripts in the driver's own interpreter (match.py, count.py):
+call("ct_seq", ...) imports scripts/ct_seq.py and calls its main(argv) with
+argv as on its command line, instead of starting a new python3.
+
+stdout / stderr of a call can go to files. Drivers that run steps on several
+threads at once (match.py) first install ThreadStream proxies with
+capture_streams(), so each thread's redirection only captures its own step.
+"""
+import contextlib
+import importlib
+import sys
+import threading
+
+class ThreadStream:
+    """Stand-in for sys.stdout / sys.stderr that writes to a per-thread target,
+    so steps running concurrently in this process each capture their own output."""
+    def __init__(self, default):
+        self.default = default
+        self.local = threading.local()
+
+    def target(self):
+        return getattr(self.local, "stream", None) or self.default
+
+    def write(self, text):
+        return self.target().write(text)
+
+    def flush(self):
+        self.target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.target(), name)
+
+def capture_streams():
+    """Replace sys.stdout / sys.stderr with ThreadStreams (once)."""
+    if not isinstance(sys.stdout, ThreadStream):
+        sys.stdout = ThreadStream(sys.stdout)
+    if not isinstance(sys.stderr, ThreadStream):
+        sys.stderr = ThreadStream(sys.stderr)
+
+def call(script, *argv, stdout=None, stderr=None):
+    """Run scripts/<script>.py in this interpreter, with argv as on its command line."""
+    argv = [str(a) for a in argv]
+    print(f">> {script}.py {' '.join(argv)}" + (f" > {stdout}" if stdout else ""), file=sys.stderr)
+    module = importlib.import_module(script)
+    if stdout or stderr:
+        capture_streams()
+    with contextlib.ExitStack() as stack:
+        for stream, path in ((sys.stdout, stdout), (sys.stderr, stderr)):
+            if path:
+                stream.local.stream = stack.enter_context(open(path, "w"))
+                stack.callback(setattr, stream.local, "stream", None)
+        module.main(argv)
@@ -11,6 +11,73 @@ Output columns:
 
 import sys
 
+HEADER = ["ID", "SNP", "chr", "pos", "ref_allele", "alt_allele",
+          "allele", "window", "strand", "project", "haplotype"]
+
+def oligo_attributes(oligo, project):
+    """Return the attribute row for one oligo ID; warnings go to stderr.
+
+    Raises ValueError if the ID has fewer than 4 ':'-separated fields.
+    """
+    attributes = oligo.split(':')
+    length = len(attributes)
+
+    if length < 4:
+        raise ValueError(f"Need at least 4 attributes in ID. Only {length} found in {oligo}")
+
+    chr_ = attributes[0]
+    snp_pos = attributes[1]
+    ref_allele = attributes[2]
+    alt_allele = attributes[3]
+
+    allele = "NA"
+    if length >= 5:
+        allele = attributes[4]
+        if allele == "R":
+            allele = "ref"
+        elif allele == "A":
+            allele = "alt"
+    if allele not in ("ref", "alt"):
+        print(f"Allele should be R or A, set as '{allele}' in {oligo}", file=sys.stderr)
+
+    window = "NA"
+    if length >= 6:
+        window = attributes[5]
+        if window == "wL":
+            window = "left"
+        elif window == "wC":
+            window = "center"
+        elif window == "wR":
+            window = "right"
+    if window not in ("left", "center", "right", "NA"):
+        print(f"Window should be wL, wC or wR, set as '{window}' in {oligo}", file=sys.stderr)
+
+    snp = f"{chr_}:{snp_pos}:{ref_allele}:{alt_allele}"
+    strand = "fwd"
+    haplotype = "ref"
+
+    # Additional attributes check (haplotype)
+    if length > 5:
+        for attr in attributes[5:]:
+            if attr.startswith("Alt"):
+                haplotype = "alt"
+
+    return [oligo, snp, chr_, snp_pos, ref_allele,
+            alt_allele, allele, window, strand,
+            project, haplotype]
+
+def write_attributes(oligo_proj, out_file):
+    """oligo_proj: mapping oligo ID -> project. Exits on malformed IDs like the CLI."""
+    with open(out_file, 'w') as out:
+        out.write("\t".join(HEADER) + "\n")
+        for oligo, project in oligo_proj.items():
+            try:
+                row = oligo_attributes(oligo, project)
+            except ValueError as e:
+                print(e, file=sys.stderr)
+                sys.exit(1)
+            out.write("\t".join(row) + "\n")
+
 def main():
     if len(sys.argv) != 3:
         print("Usage: python3 make_attributes_oligo.py <oligo_project_file> <project_name>", file=sys.stderr)
@@ -35,62 +102,10 @@ def main():
         sys.exit(1)
 
     try:
-        with open(out_file, 'w') as out:
-            header = ["ID", "SNP", "chr", "pos", "ref_allele", "alt_allele",
-                      "allele", "window", "strand", "project", "haplotype"]
-            out.write("\t".join(header) + "\n")
-
-            for oligo, project in oligo_proj.items():
-                attributes = oligo.split(':')
-                length = len(attributes)
-
-                if length < 4:
-                    print(f"Need at least 4 attributes in ID. Only {length} found in {oligo}", file=sys.stderr)
-                    sys.exit(1)
-
-                chr_ = attributes[0]
-                snp_pos = attributes[1]
-                ref_allele = attributes[2]
-                alt_allele = attributes[3]
-
-                allele = "NA"
-                if length >= 5:
-                    allele = attributes[4]
-                    if allele == "R":
-                        allele = "ref"
-                    elif allele == "A":
-                        allele = "alt"
-                if allele not in ("ref", "alt"):
-                    print(f"Allele should be R or A, set as '{allele}' in {oligo}", file=sys.stderr)
-
-                window = "NA"
-                if length >= 6:
-                    window = attributes[5]
-                    if window == "wL":
-                        window = "left"
-                    elif window == "wC":
-                        window = "center"
-                    elif window == "wR":
-                        window = "right"
-                if window not in ("left", "center", "right", "NA"):
-                    print(f"Window should be wL, wC or wR, set as '{window}' in {oligo}", file=sys.stderr)
-
-                snp = f"{chr_}:{snp_pos}:{ref_allele}:{alt_allele}"
-                strand = "fwd"
-                haplotype = "ref"
-
-                # Additional attributes check (haplotype)
-                if length > 5:
-                    for attr in attributes[5:]:
-                        if attr.startswith("Alt"):
-                            haplotype = "alt"
-
-                out.write("\t".join([oligo, snp, chr_, snp_pos, ref_allele,
-                                     alt_allele, allele, window, strand,
-                                     project, haplotype]) + "\n")
-    except Exception as e:
+        write_attributes(oligo_proj, out_file)
+    except OSError as e:
         print(f"ERROR: cannot write to file ({out_file}): {e}", file=sys.stderr)
         sys.exit(1)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -5,45 +5,87 @@ make_counts.py
 Extract barcode sequences from an MPRA FASTQ file.
 
 Usage:
-    make_counts.py <fastq> <out_id> <read_number> <bc_len>
+    make_counts.py [--whitelist <parsed> [--rescue]] <fastq> <out_id> <read_number> <bc_len>
+
+With --whitelist, barcodes that are not in the library (the .parsed map of the
+match step) are counted as 'not_in_library' rejects and dropped at read time,
+so .match, .tag and .count carry library barcodes only. With --rescue as well,
+barcodes one mismatch away from a single library barcode are kept, for
+associate_tags.py --rescue to count under that barcode.
 
 Outputs:
     <out_id>.match         — Tab-delimited file of record_id and barcode
-    <out_id>.reject.fastq  — FASTQ of reads whose barcodes were rejected (currently unused)
-    <out_id>.reject.bc     — Tab-delimited file of record_id and rejected barcode (currently unused)
+    <out_id>.reject.bc     — record_id and rejected barcode, only with MPRA_REJECTS=all
+                             (sample[:N] keeps N of them in <out_id>.reject.bc.sample)
 """
-import sys
+import argparse
 import os
 import gzip
+from collections import Counter
 from pathlib import Path
+import numpy as np
 from Bio import SeqIO
 
+from barcode_whitelist import BarcodeWhitelist
+
+from mpra_metrics import Heartbeat, Metrics, Rejects, profiled
+
 def open_by_suffix(filename):
     if filename.endswith('.gz'):
         return gzip.open(filename, 'rt')
     else:
         return open(filename, 'r')
 
-def main():
-    fastqfile = sys.argv[1]
-    out_id = sys.argv[2]
-    read_number = int(sys.argv[3])
-    bc_len = int(sys.argv[4])
+BATCH = 50000
+
+def write_batch(batch, whitelist, match_oligo, barcodes, rejects, rescue=False):
+    """Write the (record_id, barcode) pairs that pass the whitelist; returns how many did."""
+    if whitelist is None:
+        keep = [True] * len(batch)
+    else:
+        keep = whitelist.contains([bc for _, bc in batch])
+        if rescue and not keep.all():
+            miss = np.flatnonzero(~keep)
+            near = whitelist.rescue([batch[i][1] for i in miss])
+            keep[miss] = [parent is not None for parent in near]
+    kept = 0
+    for (name, bc_seq), ok in zip(batch, keep):
+        if ok:
+            match_oligo.write(f"{name}\t{bc_seq}\n")
+            barcodes[bc_seq] += 1
+            kept += 1
+        else:
+            rejects.add('not_in_library', len(bc_seq), name, bc_seq)
+    return kept
 
+def make_counts(fastqfile: str, out_id: str, read_number: int, bc_len: int,
+                whitelist: BarcodeWhitelist = None, rescue: bool = False) -> Counter:
+    """Write <out_id>.match in the working directory; return the barcode counts.
+
+    With a whitelist only library barcodes are kept, plus (with rescue) those
+    one mismatch away from exactly one library barcode.
+    """
     current_path = os.getcwd()
 
     match_path = Path(current_path) / f"{out_id}.match"
-    reject_fastq_path = Path(current_path) / f"{out_id}.reject.fastq"
     reject_bc_path = Path(current_path) / f"{out_id}.reject.bc"
 
-    with match_path.open('w') as match_oligo, \
-         reject_fastq_path.open('w') as reject_fastq, \
-         reject_bc_path.open('w') as reject_bc, \
+    metrics = Metrics('make_counts', sample=out_id)
+    reads_in = reads_out = short_bc = 0
+    barcodes = Counter()
+    beat = Heartbeat(metrics, 'reads')
+    batch = []
+
+    with metrics.timer() as timing, \
+         match_path.open('w') as match_oligo, \
+         Rejects(metrics, reject_bc_path) as rejects, \
          open_by_suffix(fastqfile) as handle:
 
         print("Reading Records...")
         for record in SeqIO.parse(handle, "fastq"):
+            reads_in += 1
             seq_only = record.seq
+            beat.tick(1, len(seq_only))
             if read_number != 2:
                 seq_only = seq_only.reverse_complement()
             seq_only = str(seq_only)
@@ -52,13 +94,34 @@ def main():
                 bc_seq = seq_only[0:bc_len]
             else:
                 bc_seq = seq_only[-bc_len:]
+            if len(bc_seq) < bc_len:
+                short_bc += 1
+
+            batch.append((record.name, bc_seq))
+            if len(batch) == BATCH:
+                reads_out += write_batch(batch, whitelist, match_oligo, barcodes, rejects, rescue)
+                batch = []
+        reads_out += write_batch(batch, whitelist, match_oligo, barcodes, rejects, rescue)
+        timing['records'] = reads_in
+
+    metrics.counters({'reads_in': reads_in, 'reads_out': reads_out, 'short_barcode': short_bc,
+                      'not_in_library': reads_in - reads_out})
+    return barcodes
 
-            # Placeholder for dictionary check
-            # if bc_seq in BC_dict:
-            match_oligo.write(f"{record.name}\t{bc_seq}\n")
-            # else:
-            #     SeqIO.write(record, reject_fastq, "fastq")
-            #     reject_bc.write(f"{record.name}\t{bc_seq}\n")
+@profiled('make_counts')
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Extract barcode sequences from an MPRA FASTQ file")
+    p.add_argument('fastq', help='Replicate FASTQ (optionally gzipped)')
+    p.add_argument('out_id', help='Output prefix (<out_id>.match)')
+    p.add_argument('read_number', type=int, help='2 if the barcode starts the read, else it ends it (reverse complement)')
+    p.add_argument('bc_len', type=int, help='Barcode length')
+    p.add_argument('--whitelist', metavar='PARSED', default=None,
+                   help='Keep only barcodes present in this .parsed map')
+    p.add_argument('--rescue', action='store_true',
+                   help='With --whitelist, also keep barcodes one mismatch away from a library barcode')
+    args = p.parse_args(argv)
+    whitelist = BarcodeWhitelist.from_parsed(args.whitelist) if args.whitelist else None
+    make_counts(args.fastq, args.out_id, args.read_number, args.bc_len, whitelist, args.rescue)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
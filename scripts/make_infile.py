@@ -13,12 +13,15 @@ Outputs:
 import argparse
 from pathlib import Path
 
-def main():
+from mpra_metrics import profiled
+
+@profiled('make_infile')
+def main(argv=None):
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('tag_ids', help='Comma-separated list of sample IDs')
     parser.add_argument('tag_files', help='Comma-separated list of tag file paths')
     parser.add_argument('out_id', help='Output prefix')
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     ids = args.tag_ids.split(',')
     files = args.tag_files.split(',')
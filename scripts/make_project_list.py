@@ -19,6 +19,22 @@ Outputs a tab-separated .proj_list file with:
 import sys
 import gzip
 
+def header_to_id(line):
+    """Oligo ID from a FASTA header line, with colons filled to at least 4 fields."""
+    header = line.strip().split()
+    array = header[0].split('|')
+    id_str = array[0]
+    id_str = id_str.lstrip('>@')
+    # Remove only the exact trailing '/1' (not all '1' or '/' chars)
+    if id_str.endswith('/1'):
+        id_str = id_str[:-2]
+
+    # Add missing colons if fewer than 3
+    n_colons = id_str.count(':')
+    if n_colons < 3:
+        id_str += (":NA" * (3 - n_colons))
+    return id_str
+
 def main():
     if len(sys.argv) != 3:
         print("Usage: python3 make_project_list.py <oligo_seqs.fasta(.gz)> <project_name>", file=sys.stderr)
@@ -41,20 +57,7 @@ def main():
         with fasta, open(output_file, 'w') as out:
             for line in fasta:
                 if line.startswith('>'):
-                    header = line.strip().split()
-                    array = header[0].split('|')
-                    id_str = array[0]
-                    id_str = id_str.lstrip('>@')
-                    # Remove only the exact trailing '/1' (not all '1' or '/' chars)
-                    if id_str.endswith('/1'):
-                        id_str = id_str[:-2]
-
-                    # Add missing colons if fewer than 3
-                    n_colons = id_str.count(':')
-                    if n_colons < 3:
-                        id_str += (":NA" * (3 - n_colons))
-
-                    out.write(f"{id_str}\t{project_name}\n")
+                    out.write(f"{header_to_id(line)}\t{project_name}\n")
     except Exception as e:
         print(f"ERROR during writing: {e}", file=sys.stderr)
         sys.exit(1)
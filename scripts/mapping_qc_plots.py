@@ -8,14 +8,22 @@ Usage:
     mapping_qc_plots.py <parsed_file> <hist_file> <preseq_out> <preseq_in> <fasta_file> <id_out>
 
 Produces a PDF "<id_out>_barcode_qc.pdf" with 5 QC plots.
+
+With --metrics, the mapping-flag and error-rate panels are built from the
+parse_map records of the metrics stream instead of re-reading <parsed_file>.
+Histograms are binned with numpy and the coverage CDF is drawn with one point
+per distinct coverage (qc_plots.py).
 """
 
 import argparse
+import os
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
 import gzip
 
+from mpra_metrics import latest, read_records, profiled
+from qc_plots import draw_hist, ecdf, histogram, pyplot
+
 def open_text_file(path):
     if path.endswith(".gz"):
         try:
@@ -25,7 +33,8 @@ def open_text_file(path):
     else:
         return open(path, "r")
 
-def main():
+@profiled('mapping_qc_plots')
+def main(argv=None):
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('parsed_file', help='Parsed counts file')
     parser.add_argument('hist_file', help='Histogram counts file')
@@ -33,11 +42,27 @@ def main():
     parser.add_argument('preseq_in', help='Preseq input histogram file')
     parser.add_argument('fasta_file', help='Reference fasta file')
     parser.add_argument('id_out', help='Output prefix / project ID')
-    args = parser.parse_args()
+    parser.add_argument('--metrics', help='Metrics JSONL with parse_map histograms')
+    args = parser.parse_args(argv)
+    plt = pyplot()
 
     # Load data
     count_hist = pd.read_csv(args.hist_file, sep='\t', header=None)
-    flags = pd.read_csv(args.parsed_file, sep='\t', header=None, usecols=[4,6])
+    flag_hist = error_hist = None
+    if args.metrics:
+        for rec in latest(read_records(args.metrics, stage='parse_map', mtype='histogram')):
+            if rec['name'] == 'mapping_flag':
+                flag_hist = pd.Series(rec['value'], dtype=float)
+            elif rec['name'] == 'pass_error_rate':
+                error_hist = pd.Series(rec['value'], dtype=float)
+    if flag_hist is None or error_hist is None:
+        flags = pd.read_csv(args.parsed_file, sep='\t', header=None, usecols=[4,6])
+        pass_err = pd.to_numeric(flags[flags.iloc[:,0] == 0].iloc[:,1], errors='coerce').dropna()
+        error_hist = pass_err.value_counts()
+        flag_hist = flags.iloc[:,0].value_counts()
+    else:
+        error_hist.index = pd.to_numeric(error_hist.index, errors='coerce')
+        error_hist = error_hist[error_hist.index.notna()]
     preseq_out = pd.read_csv(args.preseq_out, sep='\t', header=0)
     preseq_in = pd.read_csv(args.preseq_in, sep='\t', header=None)
 
@@ -56,8 +81,8 @@ def main():
     print("First row of count.hist:", *count_hist.iloc[0].tolist(), sep='\t')
     print("First row of preseq_out:", *preseq_out.iloc[0].tolist(), sep='\t')
     print("First row of preseq_in:", *preseq_in.iloc[0].tolist(), sep='\t')
-    print("Max error rate in flags:", flags.iloc[:,1].max())
-    print("Min error rate in flags:", flags.iloc[:,1].min())
+    print("Max error rate in passing barcodes:", error_hist.index.max())
+    print("Min error rate in passing barcodes:", error_hist.index.min())
 
     # Plot A — Barcode count histogram (truncated)
     parsed_hist = count_hist[count_hist[1] < count_hist[1].quantile(0.99)]
@@ -68,12 +93,8 @@ def main():
     mean_cov = count_hist[2].mean()
     max_cov = count_hist[2].max()
 
-    # Plot C — Error rate histogram for passing barcodes
-    pass_flags = flags[flags.iloc[:,0] == 0].copy()
-    pass_flags.iloc[:,1] = pd.to_numeric(pass_flags.iloc[:,1], errors='coerce')
-
     # Plot D — Mapping flag bar chart
-    flag_ct = flags.iloc[:,0].value_counts().reset_index()
+    flag_ct = flag_hist.sort_values(ascending=False).reset_index()
     flag_ct.columns = ["Flag", "Freq"]
     flag_ct["Flag"] = flag_ct["Flag"].astype(str)
     flag_ct.loc[flag_ct["Flag"] == "0", "Flag"] = "Passing"
@@ -89,15 +110,14 @@ def main():
     fig, axs = plt.subplots(3, 2, figsize=(14, 12))
 
     # A
-    axs[0,0].hist(parsed_hist[1], bins=200)
+    draw_hist(axs[0,0], *histogram(parsed_hist[1], 200))
     axs[0,0].set_xlabel("Barcodes per Oligo")
     axs[0,0].set_title(f"Barcode Count - truncated, max: {maxb}")
     # axs[0,0].grid(True, linestyle='--', alpha=0.5)
 
     # B
-    sorted_cov = np.sort(count_hist[2])
-    ecdf = np.arange(1, len(sorted_cov)+1) / len(sorted_cov)
-    axs[0,1].step(sorted_cov, ecdf, where='post')
+    cov_x, cov_y = ecdf(count_hist[2])
+    axs[0,1].step(cov_x, cov_y, where='post')
     axs[0,1].axvline(mean_cov, linestyle='-', color='red', lw=0.8)
     axs[0,1].axvline(mean_cov*5, linestyle='--', color='red', lw=0.8)
     axs[0,1].axvline(mean_cov/5, linestyle='--', color='red', lw=0.8)
@@ -107,7 +127,8 @@ def main():
     # axs[0,1].grid(True, linestyle='--', alpha=0.5)
 
     # C
-    axs[1,0].hist(pass_flags.iloc[:,1].dropna(), bins=50)
+    draw_hist(axs[1,0], *np.histogram(error_hist.index.values.astype(float), bins=50,
+                                      weights=error_hist.values))
     axs[1,0].set_xlabel("Error Rate for Passing Barcodes")
     axs[1,0].set_title("Oligo Error Rate")
     # axs[1,0].grid(True, linestyle='--', alpha=0.5)
@@ -136,7 +157,12 @@ def main():
     seen = len(count_hist)
     total = len(fasta_df)
     per = round(seen / total, 4) * 100
-    fig.suptitle(f"{args.id_out} - {per:.2f}% captured - {seen}/{total}", fontsize=16)
+    title = f"{args.id_out} - {per:.2f}% captured - {seen}/{total}"
+    # set by match.py --preview: mark the figure as a preview
+    preview = os.environ.get("MPRA_PREVIEW")
+    if preview:
+        title += f"\n{preview}"
+    fig.suptitle(title, fontsize=16)
 
     plt.tight_layout(rect=[0, 0, 1, 0.95])
     plt.savefig(f"{args.id_out}_barcode_qc.pdf")
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+mappy_align.py
+
+Align the merged oligo sequences in-process with the minimap2 Python binding
+(mappy) and write sam2mpra_cs.py output directly from the hits, without
+writing or parsing SAM.
+
+Uses the same settings as the minimap2 command in match.py: -k 10 (or a
+prebuilt .mmi index), --for-only, -Y, --secondary=no, -m 10, -n 1, -O 5 -E 1,
+--eqx and --cs=short. mappy does not expose --end-bonus, so alignments that
+the command-line run would extend to the oligo ends with the +12 bonus can come
+out soft-clipped here.
+
+Query batches are aligned on a thread pool (mappy releases the GIL while
+mapping); output order follows the input. With --bam the hits are also
+serialized as SAM and piped through samtools into a BAM file.
+
+Usage:
+    mappy_align.py [-C] [-B] [-O 0.05] [--threads N] [--bam out.bam] [--ids table.ids] <reference.fa|.mmi> <queries.fa[.gz]> <output>
+"""
+import argparse
+import subprocess
+import sys
+import threading
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import mappy
+
+from mpra_metrics import Metrics, profiled
+from oligo_ids import OligoIds
+from sam2mpra_cs import mpra_fields
+
+# minimap2 MM_F_* flags for options mappy has no keyword for
+MM_F_SOFTCLIP = 0x80000     # -Y
+MM_F_FOR_ONLY = 0x100000    # --for-only
+MM_F_EQX      = 0x4000000   # --eqx
+
+def load_aligner(reference, threads):
+    return mappy.Aligner(reference, k=10, min_cnt=1, min_chain_score=10, best_n=1,
+                         scoring=[2, 4, 5, 1], n_threads=threads,
+                         extra_flags=MM_F_SOFTCLIP | MM_F_FOR_ONLY | MM_F_EQX)
+
+def batches(path, size):
+    batch = []
+    for name, seq, _ in mappy.fastx_read(path, read_comment=False):
+        batch.append((name, seq))
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def sam_records(aligner, buf, name, seq):
+    """SAM-equivalent (qname, flag, rname, pos0, mapq, cigar, seq, size, cs) tuples for one query."""
+    records = []
+    primary = True
+    for hit in aligner.map(seq, buf=buf, cs=True):
+        if not hit.is_primary:
+            continue                                    # --secondary=no
+        flag = (0 if primary else 0x800) | (0x10 if hit.strand < 0 else 0)
+        clip5, clip3 = hit.q_st, len(seq) - hit.q_en
+        if hit.strand < 0:
+            clip5, clip3 = clip3, clip5
+        cigar = (f"{clip5}S" if clip5 else "") + hit.cigar_str + (f"{clip3}S" if clip3 else "")
+        out_seq = mappy.revcomp(seq) if hit.strand < 0 else seq
+        records.append((name, flag, hit.ctg, hit.r_st, hit.mapq, cigar, out_seq, hit.ctg_len, hit.cs))
+        primary = False
+    if not records:
+        records.append((name, 0x4, '*', -1, 0, '*', seq, 0, '*'))
+    return records
+
+@profiled('mappy_align')
+def main(argv=None):
+    p = argparse.ArgumentParser(description="In-process minimap2 alignment to MPRA mapping output")
+    p.add_argument('-C', action='store_true', dest='cigar_flag',
+                   help='Include CIGAR substitutions in score_all')
+    p.add_argument('-B', action='store_true', dest='bit_flag',
+                   help='Filter to forward-strand only (bit 0x10 unset)')
+    p.add_argument('-O', '--oligo_alnmismatchrate_cutoff', type=float, default=0.05,
+                   help='Maximum allowed oligo alignment mismatch rate (default: 0.05)')
+    p.add_argument('--threads', type=int, default=4, help='Alignment threads (default 4)')
+    p.add_argument('--batch', type=int, default=20000, help='Queries per batch (default 20000)')
+    p.add_argument('--bam', default=None, help='Also write the alignments to this BAM file')
+    p.add_argument('--ids', default=None,
+                   help='oligo_ids.py table: write reference columns 4-5 as integer codes')
+    p.add_argument('reference', help='Reference FASTA or prebuilt minimap2 .mmi index')
+    p.add_argument('queries', help='Query FASTA/FASTQ (optionally gzipped), names <barcode>#<id>')
+    p.add_argument('out', help='Output mapping table')
+    args = p.parse_args(argv)
+
+    aligner = load_aligner(args.reference, args.threads)
+    ids = OligoIds.load(args.ids) if args.ids else None
+    if not aligner:
+        sys.exit(f"ERROR: could not load or build an index from {args.reference}")
+
+    local = threading.local()
+    def align(batch):
+        if not hasattr(local, 'buf'):
+            local.buf = mappy.ThreadBuffer()
+        return [rec for name, seq in batch for rec in sam_records(aligner, local.buf, name, seq)]
+
+    bam = None
+    if args.bam:
+        bam = subprocess.Popen(f"samtools view -b -o {args.bam} -", shell=True,
+                               stdin=subprocess.PIPE, text=True)
+        for name in aligner.seq_names:
+            bam.stdin.write(f"@SQ\tSN:{name}\tLN:{len(aligner.seq(name))}\n")
+        bam.stdin.write("@PG\tID:mappy\tPN:mappy\tVN:" + mappy.__version__ + "\n")
+
+    metrics = Metrics('mappy_align', sample=Path(args.out).name)
+    stats = Counter()
+    with metrics.timer() as timing, open(args.out, 'w') as fout, \
+         ThreadPoolExecutor(max_workers=args.threads) as pool:
+        pending = deque()
+        def drain(n):
+            while len(pending) > n:
+                for qname, flag, rname, pos0, mapq, cigar, seq, size, cs in pending.popleft().result():
+                    stats['records_in'] += 1
+                    if bam:
+                        bam.stdin.write(f"{qname}\t{flag}\t{rname}\t{pos0 + 1}\t{mapq}\t{cigar}\t*\t0\t0\t{seq}\t*"
+                                        + (f"\tcs:Z:{cs}\n" if cs != '*' else "\n"))
+                    if args.bit_flag and (flag & 0x10):
+                        stats['skipped_reverse_strand'] += 1
+                        continue
+                    out_fields = mpra_fields(qname, flag, rname, str(mapq), cigar, seq, size, pos0, cs,
+                                             args.cigar_flag, args.oligo_alnmismatchrate_cutoff)
+                    if ids is not None:
+                        ids.encode_fields(out_fields)
+                    fout.write("\t".join(out_fields) + "\n")
+                    stats['records_out'] += 1
+                    stats['pass' if out_fields[10] == "PASS" else 'fail'] += 1
+                    if rname == '*':
+                        stats['unmapped'] += 1
+        for batch in batches(args.queries, args.batch):
+            pending.append(pool.submit(align, batch))
+            drain(2 * args.threads)
+        drain(0)
+        timing['records'] = stats['records_in']
+
+    if bam:
+        bam.stdin.close()
+        if bam.wait() != 0:
+            sys.exit(f"ERROR: samtools failed writing {args.bam}")
+    metrics.counters(stats)
+    print(f"Aligned {stats['records_in']:,} records with mappy {mappy.__version__} "
+          f"({stats['unmapped']:,} unmapped)", file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
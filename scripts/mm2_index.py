@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+mm2_index.py
+
+Build (once) and reuse a minimap2 .mmi index of the oligo reference.
+
+Indexes live in a cache directory under a name derived from the SHA-256 of the
+reference sequence content (gzip-transparent, so ref.fa and ref.fa.gz share an
+index), the indexing options and the minimap2 version:
+    <cache_dir>/<sha256[:16]>.<options-hash>.mmi
+    <cache_dir>/<sha256[:16]>.<options-hash>.json   -- provenance (reference, options, version)
+Concurrent callers (e.g. parallel alignment jobs) wait on a lock while one of
+them builds; everybody else loads the finished index. The index path is
+printed on stdout.
+
+Usage:
+    mm2_index.py [--index_opts "-k 10"] [--threads N] <reference.fa[.gz]> <cache_dir>
+"""
+import argparse
+import fcntl
+import gzip
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+
+from mpra_metrics import Metrics, profiled
+
+def content_sha256(path):
+    h = hashlib.sha256()
+    opener = gzip.open if path.endswith(('.gz', '.gzip')) else open
+    with opener(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def minimap2_version():
+    return subprocess.run(['minimap2', '--version'], capture_output=True, text=True, check=True).stdout.strip()
+
+def cached_index(reference, cache_dir, index_opts='-k 10', threads=3):
+    """Return the path of the cached index for (reference, index_opts), building it if needed."""
+    metrics = Metrics('mm2_index')
+    os.makedirs(cache_dir, exist_ok=True)
+    ref_hash = content_sha256(reference)
+    version = minimap2_version()
+    opts = ' '.join(index_opts.split())
+    opts_hash = hashlib.sha256(f"{opts}\t{version}".encode()).hexdigest()[:8]
+    stem = os.path.join(cache_dir, f"{ref_hash[:16]}.{opts_hash}")
+    mmi = stem + '.mmi'
+
+    with open(stem + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(mmi):
+            print(f"Reusing minimap2 index {mmi}", file=sys.stderr)
+            metrics.counter('index_cache_hit', 1)
+            return mmi
+        tmp = f"{mmi}.tmp{os.getpid()}"
+        cmd = ['minimap2', *opts.split(), '-t', str(threads), '-d', tmp, reference]
+        print(f">> {' '.join(cmd)}", file=sys.stderr)
+        t0 = time.perf_counter()
+        subprocess.run(cmd, check=True)
+        os.replace(tmp, mmi)
+        metrics.timing('build_index', time.perf_counter() - t0, nbytes=os.path.getsize(mmi))
+        metrics.counter('index_cache_hit', 0)
+        with open(stem + '.json', 'w') as out:
+            json.dump({'reference': os.path.abspath(reference), 'sha256': ref_hash,
+                       'index_opts': opts, 'minimap2': version,
+                       'created': time.strftime('%Y-%m-%dT%H:%M:%S')}, out, indent=2)
+            out.write('\n')
+    return mmi
+
+@profiled('mm2_index')
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Build or reuse a cached minimap2 index")
+    p.add_argument('reference', help='Reference FASTA (optionally gzipped)')
+    p.add_argument('cache_dir', help='Directory holding cached .mmi files')
+    p.add_argument('--index_opts', default='-k 10',
+                   help='minimap2 indexing options baked into the index (default "-k 10")')
+    p.add_argument('--threads', type=int, default=3, help='Indexing threads (default 3)')
+    args = p.parse_args(argv)
+    print(cached_index(args.reference, args.cache_dir, args.index_opts, args.threads))
+
+if __name__ == '__main__':
+    main()
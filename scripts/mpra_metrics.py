@@ -0,0 +1,426 @@
+#!/usr/bin/env python3
+"""
+mpra_metrics.py
+
+Append typed metric records to a shared JSONL stream.
+
+Every helper script creates a Metrics object for its stage; records are
+appended (one JSON object per line) to the file named by the MPRA_METRICS
+environment variable, or to an explicit path. When no path is set the
+writer is a no-op, so scripts behave as before when run by hand.
+
+Record fields:
+    ts      -- unix time the record was written
+    stage   -- script / step name (e.g. pull_barcodes)
+    sample  -- sample or replicate id, if any
+    type    -- counter | histogram | timing | heartbeat
+    name    -- metric name
+    value   -- int/float for counters and timings, {bin: count} for histograms
+    labels  -- optional extra key/value pairs
+    run     -- id of the driver run that wrote it (MPRA_RUN, set by match.py /
+               count.py; reruns in the same out_dir append to the same stream)
+    host, pid
+
+Rejected reads are accounted for by Rejects: per-reason length histograms in
+the stream, and per-read records on disk only when MPRA_REJECTS asks for them
+('counts', the default; 'sample[:N]' for a reservoir of N records; 'all').
+
+Profiling is opt-in and shared by all helper scripts: their main() is wrapped
+with @profiled, which honours --profile[=MODE] on the command line or
+MPRA_PROFILE in the environment:
+    cprofile    deterministic cProfile; <stage>[.<sample>].<pid>.prof (pstats)
+                and a cumulative-time listing in .prof.txt
+    sample[:MS] statistical sampler every MS milliseconds (default 10) over all
+                threads; folded stacks (flamegraph.pl input) in .stacks and a
+                self/total listing in .stacks.txt
+Profiles are written next to the metrics stream (or to $MPRA_PROFILE_DIR, else
+the working directory). Hot loops report progress through a Heartbeat: every
+MPRA_HEARTBEAT seconds (default 60 while profiling, off otherwise) a line with
+records/s and bytes/s goes to stderr and a 'heartbeat' record to the stream.
+
+Usage:
+    mpra_metrics.py summary <metrics.jsonl>
+    mpra_metrics.py stats   <metrics.jsonl>   # Sample/Key/Count/Sum table
+"""
+import argparse
+import functools
+import json
+import os
+import random
+import socket
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+ENV_VAR = "MPRA_METRICS"
+REJECTS_VAR = "MPRA_REJECTS"
+PROFILE_VAR = "MPRA_PROFILE"
+PROFILE_DIR_VAR = "MPRA_PROFILE_DIR"
+HEARTBEAT_VAR = "MPRA_HEARTBEAT"
+RUN_VAR = "MPRA_RUN"
+
+def start_run():
+    """Give this driver run (and the helpers it calls) a run id, unless one is set."""
+    if not os.environ.get(RUN_VAR):
+        os.environ[RUN_VAR] = f"{time.strftime('%Y%m%dT%H%M%S')}.{os.getpid()}"
+    return os.environ[RUN_VAR]
+
+class Metrics:
+    def __init__(self, stage, sample=None, path=None):
+        self.stage = stage
+        self.sample = sample
+        self.path = path or os.environ.get(ENV_VAR) or None
+        self._host = socket.gethostname()
+
+    def for_sample(self, sample):
+        """Return a writer for the same stream and stage, tagged with another sample."""
+        return Metrics(self.stage, sample=sample, path=self.path)
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def _emit(self, mtype, name, value, labels):
+        if not self.enabled:
+            return
+        rec = {
+            'ts': round(time.time(), 3),
+            'stage': self.stage,
+            'sample': self.sample,
+            'type': mtype,
+            'name': name,
+            'value': value,
+            'labels': labels,
+            'run': os.environ.get(RUN_VAR),
+            'host': self._host,
+            'pid': os.getpid(),
+        }
+        # one write() per record so concurrent appenders do not interleave lines
+        with open(self.path, 'a') as fh:
+            fh.write(json.dumps(rec, sort_keys=True) + '\n')
+
+    def counter(self, name, value, **labels):
+        self._emit('counter', name, value, labels)
+
+    def counters(self, values, **labels):
+        for name, value in values.items():
+            self.counter(name, value, **labels)
+
+    def histogram(self, name, counts, **labels):
+        """counts: mapping bin/value -> number of observations."""
+        self._emit('histogram', name, {str(k): v for k, v in counts.items()}, labels)
+
+    def timing(self, name, seconds, records=None, nbytes=None, **labels):
+        if records is not None:
+            labels['records'] = records
+            labels['records_per_s'] = round(records / seconds, 1) if seconds > 0 else None
+        if nbytes is not None:
+            labels['bytes'] = nbytes
+            labels['bytes_per_s'] = round(nbytes / seconds, 1) if seconds > 0 else None
+        self._emit('timing', name, round(seconds, 3), labels)
+
+    @contextmanager
+    def timer(self, name='total', **labels):
+        """Time a block; set 'records' / 'bytes' on the yielded dict for throughput."""
+        info = {}
+        start = time.perf_counter()
+        try:
+            yield info
+        finally:
+            self.timing(name, time.perf_counter() - start,
+                        records=info.get('records'), nbytes=info.get('bytes'), **labels)
+
+class Rejects:
+    """Reject accounting for one output file.
+
+    Every add() is counted by reason and length bin (emitted as one
+    'reject_length' histogram per reason on close). What reaches the disk
+    depends on the mode (argument, else $MPRA_REJECTS, else 'counts'):
+        counts      nothing
+        sample[:N]  a uniform reservoir of N (default 1000) records in <path>.sample
+        all         every record in <path>
+    """
+    def __init__(self, metrics, path, mode=None, bin_width=10, seed=0):
+        mode = mode or os.environ.get(REJECTS_VAR) or 'counts'
+        self.mode, _, size = mode.partition(':')
+        if self.mode not in ('counts', 'sample', 'all'):
+            raise ValueError(f"{REJECTS_VAR} must be counts, sample[:N] or all (got {mode!r})")
+        self.metrics = metrics
+        self.path = str(path)
+        self.bin_width = bin_width
+        self.sample_size = int(size) if size else 1000
+        self.counts = defaultdict(int)
+        self.lengths = defaultdict(lambda: defaultdict(int))
+        self._seen = 0
+        self._reservoir = []
+        self._rng = random.Random(seed)
+        self._out = open(self.path, 'w') if self.mode == 'all' else None
+
+    def add(self, reason, length, *fields):
+        """Count one reject; fields are the tab-separated record kept in sample/all mode."""
+        self.counts[reason] += 1
+        self.lengths[reason][length - length % self.bin_width] += 1
+        if self._out is not None:
+            self._out.write('\t'.join(map(str, fields)) + '\n')
+        elif self.mode == 'sample':
+            self._seen += 1
+            if len(self._reservoir) < self.sample_size:
+                self._reservoir.append(fields)
+            else:
+                j = self._rng.randrange(self._seen)
+                if j < self.sample_size:
+                    self._reservoir[j] = fields
+
+    def close(self):
+        if self._out is not None:
+            self._out.close()
+        elif self.mode == 'sample':
+            with open(self.path + '.sample', 'w') as out:
+                for fields in self._reservoir:
+                    out.write('\t'.join(map(str, fields)) + '\n')
+        for reason, hist in self.lengths.items():
+            self.metrics.histogram('reject_length', dict(sorted(hist.items())),
+                                   reason=reason, bin_width=self.bin_width)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class Heartbeat:
+    """Progress counter for a hot loop: tick() per record, a report every interval.
+
+    tick() only adds to two integers and compares against the next check
+    point, so leaving it in a loop costs next to nothing when heartbeats are
+    off (interval from the argument, else $MPRA_HEARTBEAT, else 60 s while
+    profiling and off otherwise). The clock is looked at every `every` records.
+    """
+    def __init__(self, metrics, name='records', interval=None, every=10000):
+        if interval is None:
+            env = os.environ.get(HEARTBEAT_VAR)
+            interval = float(env) if env else (60.0 if os.environ.get(PROFILE_VAR) else 0)
+        self.metrics = metrics
+        self.name = name
+        self.interval = interval
+        self.every = every
+        self.records = 0
+        self.bytes = 0
+        self._start = self._last = time.perf_counter()
+        self._last_records = self._last_bytes = 0
+        self._next = every if interval > 0 else float('inf')
+
+    def tick(self, records=1, nbytes=0):
+        self.records += records
+        self.bytes += nbytes
+        if self.records >= self._next:
+            self._check()
+
+    def _check(self):
+        self._next = self.records + self.every
+        now = time.perf_counter()
+        if now - self._last < self.interval:
+            return
+        span = now - self._last
+        rps = (self.records - self._last_records) / span
+        bps = (self.bytes - self._last_bytes) / span
+        elapsed = now - self._start
+        print(f"[heartbeat] {self.metrics.stage}{'/' + self.metrics.sample if self.metrics.sample else ''} "
+              f"{self.name}={self.records:,} ({rps:,.0f}/s) bytes={self.bytes:,} ({bps / 1e6:,.1f} MB/s) "
+              f"elapsed={elapsed:,.0f}s", file=sys.stderr, flush=True)
+        self.metrics._emit('heartbeat', self.name, self.records,
+                           {'bytes': self.bytes, 'records_per_s': round(rps, 1),
+                            'bytes_per_s': round(bps, 1), 'elapsed': round(elapsed, 1)})
+        self._last, self._last_records, self._last_bytes = now, self.records, self.bytes
+
+class Sampler:
+    """Statistical profiler: a daemon thread snapshots every thread's stack."""
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def write(self, path):
+        with open(path, 'w') as out:
+            for stack, n in self.stacks.most_common():
+                out.write(f"{stack} {n}\n")
+        own, total = Counter(), Counter()
+        for stack, n in self.stacks.items():
+            frames = stack.split(';')
+            own[frames[-1]] += n
+            for fn in set(frames):
+                total[fn] += n
+        samples = sum(self.stacks.values()) or 1
+        with open(path + '.txt', 'w') as out:
+            out.write(f"{samples} samples every {self.interval * 1000:g} ms\n\n"
+                      f"{'self%':>7} {'total%':>7}  function\n")
+            for fn, n in own.most_common(40):
+                out.write(f"{100 * n / samples:7.1f} {100 * total[fn] / samples:7.1f}  {fn}\n")
+
+def profile_path(stage, sample=None, suffix='.prof'):
+    out_dir = os.environ.get(PROFILE_DIR_VAR)
+    if not out_dir:
+        out_dir = os.path.dirname(os.environ[ENV_VAR]) if os.environ.get(ENV_VAR) else '.'
+    name = f"{stage}.{sample}" if sample else stage
+    return os.path.join(out_dir, f"{name}.{os.getpid()}{suffix}")
+
+@contextmanager
+def profile(stage, sample=None, mode=None):
+    """Profile a block as configured by mode (else $MPRA_PROFILE); a no-op when unset."""
+    mode = mode or os.environ.get(PROFILE_VAR) or ''
+    kind, _, arg = mode.partition(':')
+    if not kind:
+        yield
+        return
+    if kind == 'cprofile':
+        import cProfile
+        import pstats
+        prof = cProfile.Profile()
+        prof.enable()
+        try:
+            yield
+        finally:
+            prof.disable()
+            path = profile_path(stage, sample)
+            prof.dump_stats(path)
+            with open(path + '.txt', 'w') as out:
+                pstats.Stats(prof, stream=out).sort_stats('cumulative').print_stats(40)
+            print(f"Profile written to {path}", file=sys.stderr)
+    elif kind == 'sample':
+        sampler = Sampler(float(arg) / 1000 if arg else 0.01)
+        sampler.start()
+        try:
+            yield
+        finally:
+            sampler.stop()
+            path = profile_path(stage, sample, '.stacks')
+            sampler.write(path)
+            print(f"Profile written to {path}", file=sys.stderr)
+    else:
+        raise ValueError(f"{PROFILE_VAR} must be cprofile or sample[:MS] (got {mode!r})")
+
+def profiled(stage):
+    """Decorator for a script's main(argv=None): accepts --profile[=MODE] and honours $MPRA_PROFILE."""
+    def wrap(main):
+        @functools.wraps(main)
+        def run(argv=None):
+            argv = list(sys.argv[1:] if argv is None else argv)
+            mode = None
+            for arg in list(argv):
+                if arg == '--profile' or arg.startswith('--profile='):
+                    argv.remove(arg)
+                    mode = arg.partition('=')[2] or 'cprofile'
+            with profile(stage, mode=mode):
+                return main(argv)
+        return run
+    return wrap
+
+def read_records(path, stage=None, mtype=None, name=None):
+    """Yield records from a metrics JSONL file, optionally filtered."""
+    with open(path) as fh:
+        for line in fh:
+            line = line.strip()
+            if not line:
+                continue
+            rec = json.loads(line)
+            if stage is not None and rec.get('stage') != stage:
+                continue
+            if mtype is not None and rec.get('type') != mtype:
+                continue
+            if name is not None and rec.get('name') != name:
+                continue
+            yield rec
+
+def latest(records, key=('stage', 'sample', 'name')):
+    """Keep only the most recent record per key (reruns append, they do not rewrite)."""
+    out = {}
+    for rec in records:
+        k = tuple(rec.get(f) for f in key) + (json.dumps(rec.get('labels', {}), sort_keys=True),)
+        out[k] = rec
+    return list(out.values())
+
+def sample_stats(path):
+    """Per-sample barcode/read totals by mapping key, as reported by compile_bc_cs.
+
+    Only the newest full compile counts (it starts with a 'compiled_samples'
+    record), plus later incremental updates (update_count.py), each of which
+    replaces every key of the samples it rewrote. Samples and keys of earlier
+    runs appended to the same stream are dropped.
+
+    Returns a list of (sample, key, count, sum) in the order samples were compiled.
+    """
+    records = list(read_records(path, stage='compile_bc_cs', mtype='counter'))
+    starts = [i for i, rec in enumerate(records) if rec['name'] == 'compiled_samples']
+    rows, writer = {}, {}       # sample -> {key: row}, sample -> run that wrote it
+    for rec in records[starts[-1] if starts else 0:]:
+        if rec['name'] not in ('barcodes', 'reads'):
+            continue
+        sample = rec['sample']
+        run = (rec.get('run'), rec.get('pid'))
+        if writer.setdefault(sample, run) != run:
+            # a later update of this sample: forget its previous keys
+            writer[sample] = run
+            rows[sample] = {}
+        key = rec['labels'].get('key')
+        row = rows.setdefault(sample, {}).setdefault(key, [sample, key, 0, 0])
+        if rec['name'] == 'barcodes':
+            row[2] = rec['value']
+        elif rec['name'] == 'reads':
+            row[3] = rec['value']
+    return [tuple(r) for keys in rows.values() for r in keys.values()]
+
+def summary(path, out=sys.stdout):
+    timings = list(read_records(path, mtype='timing'))
+    counters = defaultdict(int)
+    for rec in latest(read_records(path, mtype='counter')):
+        counters[(rec['stage'], rec['name'])] += rec['value']
+    print("Stage\tSample\tTiming\tSeconds\tRecords\tRecords/s", file=out)
+    for rec in sorted(timings, key=lambda r: r['ts']):
+        lab = rec.get('labels', {})
+        print(f"{rec['stage']}\t{rec.get('sample') or '-'}\t{rec['name']}\t{rec['value']}\t"
+              f"{lab.get('records', '-')}\t{lab.get('records_per_s', '-')}", file=out)
+    print("\nStage\tCounter\tTotal", file=out)
+    for (stage, name), value in sorted(counters.items()):
+        print(f"{stage}\t{name}\t{value}", file=out)
+
+@profiled('mpra_metrics')
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Inspect an MPRA metrics JSONL stream")
+    sub = p.add_subparsers(dest='cmd', required=True)
+    s = sub.add_parser('summary', help='Print per-stage timings and counter totals')
+    s.add_argument('metrics', help='Metrics JSONL file')
+    s = sub.add_parser('stats', help='Print the Sample/Key/Count/Sum table from compile_bc_cs records')
+    s.add_argument('metrics', help='Metrics JSONL file')
+    args = p.parse_args(argv)
+    if args.cmd == 'summary':
+        summary(args.metrics)
+    elif args.cmd == 'stats':
+        print("Sample\tKey\tCount\tSum")
+        for sample, key, count, total in sample_stats(args.metrics):
+            print(f"{sample}\t{key}\t{count}\t{total}")
+
+if __name__ == '__main__':
+    main()
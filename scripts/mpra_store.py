@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""
+mpra_store.py
+
+Indexed SQLite store of the count table and the barcode–oligo map, for looking
+up a few barcodes, oligos or projects without scanning the .count and .parsed
+files. count.py builds <id_out>.db at the end of the count stage.
+
+Tables:
+    samples(col, sample)                        -- count columns, in table order
+    barcodes(barcode, oligo, error, cigar, cs, aln, counts)
+                                                -- .count rows (counts: tab-joined, one per sample),
+                                                   keyed by barcode, indexed by oligo
+    summary(flag, sample, reads)                -- the per-sample summary rows of the .count file
+    mapping(barcode, oligos, seen, total, flag, flags, error, cigar, md, pos)
+                                                -- .parsed rows, keyed by barcode
+    members(member, oligo)                      -- atomic IDs of composite "(tile1; tile2)" oligos
+    projects(project, oligo)                    -- with --projects tile_proj_map.tsv
+
+Lookups: barcode -> mapping and per-sample counts, barcode range or prefix,
+oligo (or one member of a composite oligo) -> its barcodes and counts,
+project -> its oligos. The same queries are available from Python:
+
+    from mpra_store import MpraStore
+    store = MpraStore("OL49_trial.db")
+    store.barcode("ACGT...")   # {'barcode': ..., 'oligo': ..., 'counts': {sample: n}, 'mapping': {...}}
+    store.oligo("oligo12")     # [barcode dicts]
+    store.project("proj1")     # [oligo IDs]
+
+Usage:
+    mpra_store.py build --count <id>.count [--parsed <map>.parsed] [--projects tile_proj_map.tsv] <out.db>
+    mpra_store.py query <db> barcode|oligo|project <key> [<key> ...]
+    mpra_store.py query <db> prefix <barcode_prefix>
+    mpra_store.py query <db> range <first_barcode> <last_barcode>
+"""
+import argparse
+import csv
+import gzip
+import os
+import sqlite3
+import sys
+import time
+
+from mpra_metrics import Metrics, profiled
+from oligo_ids import split_ID
+
+COUNT_FIELDS = {'Error': 'error', 'CIGAR': 'cigar', 'cs': 'cs', 'Aln_Start:Stop': 'aln'}
+MAPPING_COLUMNS = ('barcode', 'oligos', 'seen', 'total', 'flag', 'flags', 'error', 'cigar', 'md', 'pos')
+
+SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE samples (col INTEGER PRIMARY KEY, sample TEXT);
+CREATE TABLE barcodes (barcode TEXT PRIMARY KEY, oligo TEXT, error TEXT, cigar TEXT, cs TEXT, aln TEXT,
+                       counts TEXT) WITHOUT ROWID;
+CREATE TABLE summary (flag TEXT, sample TEXT, reads INTEGER);
+CREATE TABLE mapping (barcode TEXT PRIMARY KEY, oligos TEXT, seen TEXT, total INTEGER, flag INTEGER,
+                      flags TEXT, error TEXT, cigar TEXT, md TEXT, pos TEXT) WITHOUT ROWID;
+CREATE TABLE members (member TEXT, oligo TEXT);
+CREATE TABLE projects (project TEXT, oligo TEXT);
+"""
+# built after the bulk inserts
+INDEXES = """
+CREATE INDEX barcodes_oligo ON barcodes (oligo);
+CREATE INDEX members_member ON members (member);
+CREATE INDEX projects_project ON projects (project);
+CREATE INDEX projects_oligo ON projects (oligo);
+"""
+
+def open_by_suffix(filename):
+    if filename.endswith(('.gz', '.gzip')):
+        return gzip.open(filename, 'rt')
+    return open(filename, 'r')
+
+def _count(value):
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+# ─── build ──────────────────────────────────────────────────────────────────
+
+def load_count(db, path):
+    """Insert a compile_bc_cs .count table; returns the oligo IDs seen."""
+    oligos = set()
+    with open_by_suffix(path) as fh:
+        header = fh.readline().rstrip('\n').split('\t')
+        # optional -E/-C/-S/-M columns between Oligo and the samples
+        info = []
+        for h in header[2:]:
+            if h not in COUNT_FIELDS:
+                break
+            info.append(COUNT_FIELDS[h])
+        n_info = len(info)
+        samples = header[2 + n_info:]
+        db.executemany("INSERT INTO samples VALUES (?, ?)", enumerate(samples))
+        cols = ['barcode', 'oligo', *info, 'counts']
+        insert = f"INSERT OR REPLACE INTO barcodes ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))})"
+        summary = []
+        def rows():
+            for line in fh:
+                parts = line.rstrip('\n').split('\t')
+                if len(parts) < 2 + n_info + len(samples):
+                    continue
+                counts = parts[2 + n_info:]
+                # per-sample summary pseudo-barcodes (flag, <count file>, NA...)
+                if os.path.basename(parts[1]).endswith('.count') and all(v == 'NA' for v in parts[2:2 + n_info]):
+                    summary.extend((parts[0], s, int(c)) for s, c in zip(samples, counts) if c != '0')
+                    continue
+                oligos.add(parts[1])
+                yield (*parts[:2 + n_info], '\t'.join(counts))
+        db.executemany(insert, rows())
+        db.executemany("INSERT INTO summary VALUES (?, ?, ?)", summary)
+    return oligos
+
+def load_mapping(db, path):
+    """Insert a .parsed barcode–oligo map (later rows for a barcode win, as in associate_tags)."""
+    def rows():
+        with open_by_suffix(path) as fh:
+            for line in fh:
+                parts = line.rstrip('\n').split('\t')
+                if len(parts) < len(MAPPING_COLUMNS):
+                    continue
+                yield parts[:len(MAPPING_COLUMNS)]
+    db.executemany(f"INSERT OR REPLACE INTO mapping VALUES ({', '.join('?' * len(MAPPING_COLUMNS))})", rows())
+
+def load_projects(db, path, oligos):
+    """Join the oligos (and the members of composite ones) against tile_proj_map.tsv (ID, project)."""
+    with open(path, newline='') as tsv:
+        tile_proj = {}
+        for row in csv.DictReader(tsv, delimiter='\t'):
+            tile_proj.setdefault(row['ID'], set()).add(row['project'])
+    rows = set()
+    for oligo in oligos:
+        for tile in (oligo, *(m.strip() for m in split_ID(oligo))):
+            rows.update((proj, oligo) for proj in tile_proj.get(tile, ()))
+    db.executemany("INSERT INTO projects VALUES (?, ?)", sorted(rows))
+
+def build(out, count=None, parsed=None, projects=None):
+    """Write the store to out (replaced atomically once complete)."""
+    metrics = Metrics('mpra_store', sample=os.path.basename(out))
+    tmp = f"{out}.tmp{os.getpid()}"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    with metrics.timer() as timing:
+        db = sqlite3.connect(tmp)
+        db.executescript("PRAGMA journal_mode = OFF; PRAGMA synchronous = OFF;" + SCHEMA)
+        with db:
+            oligos = load_count(db, count) if count else set()
+            if parsed:
+                load_mapping(db, parsed)
+                oligos.update(o for (o,) in db.execute("SELECT DISTINCT oligos FROM mapping WHERE flag != 1"))
+            oligos.discard('*')
+            db.executemany("INSERT INTO members VALUES (?, ?)",
+                           ((m.strip(), o) for o in sorted(oligos) for m in split_ID(o) if m.strip() != o))
+            if projects:
+                load_projects(db, projects, oligos)
+            db.executemany("INSERT INTO meta VALUES (?, ?)", [
+                ('count', os.path.abspath(count) if count else ''),
+                ('parsed', os.path.abspath(parsed) if parsed else ''),
+                ('projects', os.path.abspath(projects) if projects else ''),
+                ('created', time.strftime('%Y-%m-%dT%H:%M:%S'))])
+        db.executescript(INDEXES + "ANALYZE;")
+        n_barcodes, = db.execute("SELECT COUNT(*) FROM barcodes").fetchone()
+        n_mapped, = db.execute("SELECT COUNT(*) FROM mapping").fetchone()
+        db.close()
+        os.replace(tmp, out)
+        timing['records'] = n_barcodes + n_mapped
+    metrics.counters({'barcodes': n_barcodes, 'mapped_barcodes': n_mapped, 'oligos': len(oligos)})
+    print(f"{out}: {n_barcodes:,} counted and {n_mapped:,} mapped barcodes, {len(oligos):,} oligos "
+          f"({os.path.getsize(out):,} bytes)", file=sys.stderr)
+
+# ─── query ──────────────────────────────────────────────────────────────────
+
+class MpraStore:
+    def __init__(self, path):
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+        self.db = sqlite3.connect(f"file:{os.path.abspath(path)}?mode=ro", uri=True)
+        self.db.row_factory = sqlite3.Row
+        self.samples = [s for (s,) in self.db.execute("SELECT sample FROM samples ORDER BY col")]
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _counted(self, row):
+        rec = dict(row)
+        rec['counts'] = dict(zip(self.samples, map(_count, rec['counts'].split('\t'))))
+        return rec
+
+    def mapping(self, barcode):
+        row = self.db.execute("SELECT * FROM mapping WHERE barcode = ?", (barcode,)).fetchone()
+        return dict(row) if row else None
+
+    def barcode(self, barcode):
+        """Count row and mapping of one barcode (either may be None), or None if it is in neither."""
+        row = self.db.execute("SELECT * FROM barcodes WHERE barcode = ?", (barcode,)).fetchone()
+        mapping = self.mapping(barcode)
+        if row is None and mapping is None:
+            return None
+        rec = self._counted(row) if row else {'barcode': barcode, 'oligo': None, 'counts': None}
+        rec['mapping'] = mapping
+        return rec
+
+    def barcodes(self, first=None, last=None, prefix=None, limit=None):
+        """Count rows with first <= barcode <= last, or starting with prefix, in barcode order."""
+        where, params = [], []
+        if prefix is not None:
+            first, last = prefix, prefix + '\U0010ffff'
+        if first is not None:
+            where.append("barcode >= ?")
+            params.append(first)
+        if last is not None:
+            where.append("barcode <= ?")
+            params.append(last)
+        sql = "SELECT * FROM barcodes" + (" WHERE " + " AND ".join(where) if where else "") + " ORDER BY barcode"
+        if limit is not None:
+            sql += f" LIMIT {int(limit)}"
+        for row in self.db.execute(sql, params):
+            yield self._counted(row)
+
+    def oligo(self, oligo):
+        """Count rows of the barcodes of an oligo, or of every composite oligo it is a member of."""
+        rows = self.db.execute(
+            "SELECT * FROM barcodes WHERE oligo = ? "
+            "UNION ALL SELECT b.* FROM members m JOIN barcodes b ON b.oligo = m.oligo WHERE m.member = ? "
+            "ORDER BY oligo, barcode", (oligo, oligo))
+        return [self._counted(row) for row in rows]
+
+    def project(self, project):
+        """Oligo IDs of a project."""
+        return [o for (o,) in self.db.execute(
+            "SELECT oligo FROM projects WHERE project = ? ORDER BY oligo", (project,))]
+
+    def summary(self):
+        return [dict(row) for row in self.db.execute("SELECT * FROM summary")]
+
+# ─── CLI ────────────────────────────────────────────────────────────────────
+
+def print_rows(samples, recs, with_mapping=False):
+    header = ['barcode', 'oligo', 'error', 'cigar', 'cs', 'aln', *samples]
+    if with_mapping:
+        header += [f"map_{c}" for c in MAPPING_COLUMNS[1:]]
+    print('\t'.join(header))
+    for rec in recs:
+        counts = rec['counts'] or {}
+        row = [rec['barcode'], rec['oligo'] or '-', *(rec.get(c) or '-' for c in ('error', 'cigar', 'cs', 'aln')),
+               *(str(counts.get(s, '-')) for s in samples)]
+        if with_mapping:
+            mapping = rec.get('mapping') or {}
+            row += [str(mapping.get(c, '-')) for c in MAPPING_COLUMNS[1:]]
+        print('\t'.join(row))
+
+@profiled('mpra_store')
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Indexed store of MPRA count tables and mapping results")
+    sub = p.add_subparsers(dest='cmd', required=True)
+    s = sub.add_parser('build', help='Build the store from a count table and/or a parsed map')
+    s.add_argument('--count', default=None, help='compile_bc_cs .count table')
+    s.add_argument('--parsed', default=None, help='Parsed barcode–oligo map from the match step')
+    s.add_argument('--projects', default=None, help='tile_proj_map.tsv (ID, project) for project lookups')
+    s.add_argument('out', help='Store to write (SQLite)')
+    s = sub.add_parser('query', help='Look barcodes, oligos or projects up')
+    s.add_argument('db', help='Store built by "build"')
+    s.add_argument('kind', choices=['barcode', 'oligo', 'project', 'prefix', 'range'])
+    s.add_argument('keys', nargs='+', help='Barcodes, oligo IDs, projects, a prefix or first and last barcode')
+    args = p.parse_args(argv)
+
+    if args.cmd == 'build':
+        if not (args.count or args.parsed):
+            p.error("build needs --count and/or --parsed")
+        build(args.out, args.count, args.parsed, args.projects)
+        return
+
+    with MpraStore(args.db) as store:
+        if args.kind == 'barcode':
+            print_rows(store.samples, filter(None, map(store.barcode, args.keys)), with_mapping=True)
+        elif args.kind == 'oligo':
+            print_rows(store.samples, (rec for key in args.keys for rec in store.oligo(key)))
+        elif args.kind == 'project':
+            print("project\toligo")
+            for key in args.keys:
+                for oligo in store.project(key):
+                    print(f"{key}\t{oligo}")
+        elif args.kind == 'prefix':
+            print_rows(store.samples, (rec for key in args.keys for rec in store.barcodes(prefix=key)))
+        else:
+            if len(args.keys) != 2:
+                p.error("range needs <first_barcode> <last_barcode>")
+            print_rows(store.samples, store.barcodes(*args.keys))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+oligo_ids.py
+
+Integer codes for the oligo IDs of a reference FASTA.
+
+Every reference record gets a code (1, 2, ... in FASTA order; 0 is the
+unmapped '*'), and every atomic member of a composite "(tile1; tile2)" header
+gets an atom code, so the members of an oligo are a tuple of small ints split
+once when the table is built. The per-read match intermediates (.mapped and its
+barcode sort) carry the codes in place of the reference columns, and ct_seq.py
+turns them back into names when it writes the .ct file, so everything from .ct
+on (.parsed, .tag, .count) is unchanged.
+
+A reverse-strand hit is written as the negative code and decodes to the
+"<first>_RC_<rest>" name sam2mpra_cs.py gives it.
+
+The table is stored as a sidecar, one "code<TAB>name" line per oligo:
+    <id_out>.oligo.ids
+
+Usage:
+    oligo_ids.py <reference.fa[.gz]> <out.ids>     # build the sidecar
+    oligo_ids.py --decode <out.ids> <code> ...     # look codes up
+"""
+import argparse
+import gzip
+import sys
+
+from mpra_metrics import profiled
+
+UNMAPPED = '*'
+
+def split_ID(full_id):
+    """Atomic members of a (possibly composite) oligo ID, as in parse_map.py."""
+    return full_id.strip("()").split(";")
+
+def rc_name(name):
+    """Name of a reverse-strand hit on `name` (see sam2mpra_cs.mpra_fields)."""
+    parts = name.split('_')
+    return parts[0] + "_RC_" + "_".join(parts[1:])
+
+def reference_names(path):
+    """Record names (header up to the first whitespace) of a FASTA, in file order."""
+    opener = gzip.open if path.endswith(('.gz', '.gzip')) else open
+    with opener(path, 'rt') as fh:
+        for line in fh:
+            if line.startswith('>'):
+                fields = line[1:].split(None, 1)
+                yield fields[0] if fields else ''
+
+class OligoIds:
+    def __init__(self, names):
+        self.names = [UNMAPPED]
+        self.code = {UNMAPPED: 0}
+        self.atoms = []
+        self.atom_code = {}
+        self.members = [()]
+        for name in names:
+            if name in self.code:
+                continue
+            self.code[name] = len(self.names)
+            self.names.append(name)
+            self.members.append(tuple(self._atom(a) for a in split_ID(name)))
+
+    def _atom(self, atom):
+        code = self.atom_code.get(atom)
+        if code is None:
+            code = self.atom_code[atom] = len(self.atoms)
+            self.atoms.append(atom)
+        return code
+
+    @classmethod
+    def from_fasta(cls, path):
+        return cls(reference_names(path))
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as fh:
+            return cls(line.rstrip('\n').split('\t', 1)[1] for line in fh)
+
+    def write(self, path):
+        with open(path, 'w') as out:
+            for code, name in enumerate(self.names[1:], 1):
+                out.write(f"{code}\t{name}\n")
+
+    def __len__(self):
+        return len(self.names) - 1
+
+    def encode(self, name, reverse=False):
+        """Code of a reference name (as a string, negative for reverse-strand hits)."""
+        code = self.code[name]
+        return str(-code if reverse else code)
+
+    def decode(self, token):
+        """Oligo name for a code written by encode()."""
+        code = int(token)
+        return rc_name(self.names[-code]) if code < 0 else self.names[code]
+
+    def member_names(self, token):
+        return [self.atoms[a] for a in self.members[abs(int(token))]]
+
+    def encode_fields(self, fields):
+        """Replace the reference columns (4: oriented name, 5: rname) of a mapping row with codes."""
+        rname = fields[4]
+        fields[3] = self.encode(rname, reverse=fields[3] != rname)
+        fields[4] = self.encode(rname)
+        return fields
+
+@profiled('oligo_ids')
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Integer codes for the oligo IDs of a reference FASTA")
+    p.add_argument('--decode', action='store_true', help='Look codes up in an existing .ids file')
+    p.add_argument('source', help='Reference FASTA (optionally gzipped), or the .ids file with --decode')
+    p.add_argument('rest', nargs='*', help='Output .ids file, or the codes to decode')
+    args = p.parse_args(argv)
+    if args.decode:
+        ids = OligoIds.load(args.source)
+        for token in args.rest:
+            print(f"{token}\t{ids.decode(token)}\t{';'.join(ids.member_names(token))}")
+        return
+    if len(args.rest) != 1:
+        p.error("expected <reference.fa> <out.ids>")
+    ids = OligoIds.from_fasta(args.source)
+    ids.write(args.rest[0])
+    print(f"{len(ids):,} oligo IDs, {len(ids.atoms):,} atomic members -> {args.rest[0]}", file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+oligo_matrix.py
+
+Collapse a barcode-level MPRA count table to oligo level.
+
+Writes two integer oligo x sample matrices (header: Oligo, <samples...>):
+    <out_prefix>.oligo_counts    -- summed barcode counts per oligo
+    <out_prefix>.oligo_barcodes  -- number of barcodes with count > 0 per oligo
+
+compile_bc_cs.py and update_count.py feed OligoAggregator row by row while
+they write the .count table, so the matrices come out of the same pass. The
+CLI rebuilds them from an existing table in one streaming pass.
+
+Usage:
+    oligo_matrix.py [-E] [-C] [-M] [-S] <count_table> <out_prefix>
+"""
+import argparse
+import os
+
+from mpra_metrics import profiled
+
+class OligoAggregator:
+    def __init__(self, samples):
+        self.samples = list(samples)
+        self.counts = {}
+        self.barcodes = {}
+
+    def add(self, oligo, values):
+        """values: per-sample integer counts of one barcode, in sample order."""
+        ct = self.counts.get(oligo)
+        if ct is None:
+            ct = self.counts[oligo] = [0] * len(self.samples)
+            self.barcodes[oligo] = [0] * len(self.samples)
+        bc = self.barcodes[oligo]
+        for i, v in enumerate(values):
+            if v:
+                ct[i] += v
+                bc[i] += 1
+
+    def merge(self, other):
+        """Add the totals of another aggregator over the same samples (e.g. one barcode shard)."""
+        for oligo, ct in other.counts.items():
+            mine = self.counts.get(oligo)
+            if mine is None:
+                self.counts[oligo] = list(ct)
+                self.barcodes[oligo] = list(other.barcodes[oligo])
+                continue
+            bc = self.barcodes[oligo]
+            for i, (v, n) in enumerate(zip(ct, other.barcodes[oligo])):
+                mine[i] += v
+                bc[i] += n
+
+    def reorder(self, oligos):
+        """Put the rows in the given oligo order (e.g. first appearance across merged shards)."""
+        self.counts = {oligo: self.counts[oligo] for oligo in oligos}
+        self.barcodes = {oligo: self.barcodes[oligo] for oligo in oligos}
+
+    def write(self, out_prefix):
+        header = '\t'.join(['Oligo'] + self.samples) + '\n'
+        for suffix, table in (('oligo_counts', self.counts), ('oligo_barcodes', self.barcodes)):
+            with open(f"{out_prefix}.{suffix}", 'w') as out:
+                out.write(header)
+                for oligo, row in table.items():
+                    out.write(oligo + '\t' + '\t'.join(map(str, row)) + '\n')
+
+@profiled('oligo_matrix')
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Collapse a barcode-level count table to oligo x sample matrices")
+    p.add_argument('-E', action='store_true', dest='err_flag', help='Table has error rate column')
+    p.add_argument('-C', action='store_true', dest='cigar_flag', help='Table has CIGAR column')
+    p.add_argument('-M', action='store_true', dest='md_flag', help='Table has MD/cs column')
+    p.add_argument('-S', action='store_true', dest='pos_flag', help='Table has alignment start/stop column')
+    p.add_argument('count_table', help='Barcode-level .count table')
+    p.add_argument('out_prefix', help='Prefix for the .oligo_counts / .oligo_barcodes files')
+    args = p.parse_args(argv)
+
+    first = 2 + sum([args.err_flag, args.cigar_flag, args.md_flag, args.pos_flag])
+    summary_tag = os.path.basename(args.count_table)
+    with open(args.count_table) as fin:
+        header = fin.readline().rstrip('\n').split('\t')
+        agg = OligoAggregator(header[first:])
+        for line in fin:
+            row = line.rstrip('\n').split('\t')
+            # skip the per-sample summary pseudo-barcode rows
+            if os.path.basename(row[1]) == summary_tag:
+                continue
+            agg.add(row[1], [int(v) for v in row[first:]])
+    agg.write(args.out_prefix)
+
+if __name__ == '__main__':
+    main()
@@ -20,13 +20,17 @@ Output:
 
 import sys
 import argparse
+from collections import Counter
+from functools import lru_cache
 
-def parse_args():
+from mpra_metrics import Metrics, profiled
+
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(description="Faithful port of Perl parse_map.pl for MPRA barcode resolution")
     parser.add_argument("mapped_file", help="Input mapped file")
     parser.add_argument("-S", "--saturation", action="store_true", help="Enable saturation mutagenesis mode")
     parser.add_argument("-A", "--attributes", type=str, help="Attributes file (required if -S)")
-    return parser.parse_args()
+    return parser.parse_args(argv)
 
 def load_attributes(file_path):
     ref_hash = {}
@@ -47,12 +51,14 @@ def load_attributes(file_path):
     print(f"ID Col: {ID_col}\nSat Ref Col: {sat_ref_col}", file=sys.stderr)
     return ref_hash
 
+@lru_cache(maxsize=None)
 def split_ID(full_id):
-    full_id = full_id.strip("()")
-    return full_id.split(";")
+    # each oligo recurs across many collisions; split it once
+    return tuple(full_id.strip("()").split(";"))
 
-def main():
-    args = parse_args()
+@profiled('parse_map')
+def main(argv=None):
+    args = parse_args(argv)
 
     ref_hash = {}
     if args.saturation:
@@ -60,7 +66,18 @@ def main():
             sys.exit("ERROR: Attributes file must be provided when using -S.")
         ref_hash = load_attributes(args.attributes)
 
-    with open(args.mapped_file) as f:
+    metrics = Metrics('parse_map')
+    flag_ct = Counter()
+    error_hist = Counter()
+
+    def emit(fields):
+        # flag / error columns of the output line feed the mapping QC plots
+        flag_ct[fields[4]] += 1
+        if fields[4] == "0" and "," not in fields[6]:
+            error_hist[fields[6]] += 1
+        print("\t".join(fields))
+
+    with metrics.timer() as timing, open(args.mapped_file) as f:
         for line in f:
             line = line.strip()
             if not line:
@@ -115,11 +132,15 @@ def main():
                         mds[max_idx],
                         poss[max_idx]
                     ]
-                    print("\t".join(out_line))
+                    emit(out_line)
                 else:
-                    print("\t".join(cols))
+                    emit(cols)
             else:
-                print("\t".join(cols))
+                emit(cols)
+        timing['records'] = sum(flag_ct.values())
+
+    metrics.histogram('mapping_flag', flag_ct)
+    metrics.histogram('pass_error_rate', error_hist)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
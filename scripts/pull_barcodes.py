@@ -11,10 +11,28 @@ Usage:
 
 Writes:
     <out_prefix>.match   -- matched barcodes and oligos
-    <out_prefix>.reject  -- rejected reads with reasons
+    <out_prefix>.reject  -- rejected reads with reasons (only with --rejects all;
+                            --rejects sample[:N] keeps N of them in <out_prefix>.reject.sample)
+Reject reasons and length histograms always go to the metrics stream.
+
+Linkers are located by exact search (str.find). Only with --link_edits
+(barcode linker) or --oligo_link_edits (oligo start/end linkers) above their
+default of 0 are reads without an exact hit searched again, accepting the best
+hit within that many edits. The barcode linker only accepts substitutions (an
+ungapped hit), since an indel there would shift the barcode by a base; it is a
+plain per-read Hamming scan of the short window, not bit-parallel. The oligo
+linkers use Myers' bit-vector algorithm, one read at a time. With approximate
+search on, the best edit distance of the barcode linker is reported per read
+as the 'linker_edit_distance' histogram, split into accepted and rejected
+reads, and summarised on stderr.
 """
 import argparse
+import os
 import re
+import sys
+from collections import Counter
+
+from mpra_metrics import Heartbeat, Metrics, Rejects, profiled
 
 # translation for reverse complement
 _RC_TABLE = str.maketrans('ACGTNacgtn', 'TGCANtgcan')
@@ -22,7 +40,90 @@ _RC_TABLE = str.maketrans('ACGTNacgtn', 'TGCANtgcan')
 def reverse_complement(seq: str) -> str:
     return seq.translate(_RC_TABLE)[::-1]
 
-def main():
+def myers_search(pattern, text):
+    """Best semi-global match of pattern in text: (edit distance, end index), leftmost on ties.
+
+    Myers' bit-vector algorithm: one pass over text with the pattern columns
+    packed into an integer; returns (len(pattern), -1) for empty text.
+    """
+    m = len(pattern)
+    full = (1 << m) - 1
+    high = 1 << (m - 1)
+    peq = {}
+    for i, c in enumerate(pattern):
+        peq[c] = peq.get(c, 0) | (1 << i)
+    pv, mv, score = full, 0, m
+    best, best_end = m, -1
+    for j, c in enumerate(text):
+        eq = peq.get(c, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = (mv | ~(xh | pv)) & full
+        mh = pv & xh
+        if ph & high:
+            score += 1
+        elif mh & high:
+            score -= 1
+        # text start is free (semi-global): no carry into the first row
+        ph = (ph << 1) & full
+        mh = (mh << 1) & full
+        pv = (mh | ~(xv | ph)) & full
+        mv = ph & xv
+        if score < best:
+            best, best_end = score, j
+    return best, best_end
+
+def edit_distance(a, b):
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i]
+        for j, cb in enumerate(b, 1):
+            cur.append(min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != cb)))
+        prev = cur
+    return prev[-1]
+
+def hamming_search(pattern, text):
+    """Best ungapped placement of pattern in text: (mismatches, start), leftmost on ties."""
+    m = len(pattern)
+    best, best_start = m + 1, -1
+    for s in range(len(text) - m + 1):
+        d = sum(a != b for a, b in zip(pattern, text[s:s + m]))
+        if d < best:
+            best, best_start = d, s
+    return best, best_start
+
+def find_linker(text, pattern, max_edits, gapped=True):
+    """Start of pattern in text and its edit distance: exact first, then within max_edits.
+
+    Returns (start, edits); start is -1 when the best hit needs more than
+    max_edits edits (edits is then that best distance, or None when
+    max_edits is 0 and no approximate search is made). With gapped=False
+    only substitutions count, so the hit keeps the pattern's length.
+    """
+    idx = text.find(pattern)
+    if idx != -1:
+        return idx, 0
+    if max_edits <= 0:
+        return -1, None
+    if not gapped:
+        dist, start = hamming_search(pattern, text)
+        if dist > max_edits or start < 0:
+            return -1, dist
+        return start, dist
+    dist, end = myers_search(pattern, text)
+    if dist > max_edits or end < 0:
+        return -1, dist
+    # the hit ends at `end`; of the starts that reach the same distance take
+    # the one closest to an ungapped placement
+    m = len(pattern)
+    ungapped = end - m + 1
+    starts = sorted(range(max(0, ungapped - dist), min(end, ungapped + dist) + 1),
+                    key=lambda s: abs(s - ungapped))
+    start = next(s for s in starts if edit_distance(pattern, text[s:end + 1]) == dist)
+    return start, dist
+
+@profiled('pull_barcodes')
+def main(argv=None):
     p = argparse.ArgumentParser(description=__doc__)
     p.add_argument('fastq', help='Flashed FASTQ file')
     p.add_argument('read_orientation', type=int, help='1 if R1 is reverse complement')
@@ -36,7 +137,14 @@ def main():
     p.add_argument('bc_len', type=int, help='Barcode length')
     p.add_argument('link_A_size', type=int, help='Adapter length before enhancer')
     p.add_argument('link_end_size', type=int, help='Adapter length after enhancer')
-    args = p.parse_args()
+    p.add_argument('--rejects', default=None, metavar='counts|sample[:N]|all',
+                   help='Per-read reject output (default $MPRA_REJECTS, else counts only)')
+    p.add_argument('--link_edits', type=int, default=0,
+                   help='Substitutions allowed in the barcode linker (default 0 = exact only)')
+    p.add_argument('--oligo_link_edits', type=int, default=0,
+                   help='Edits allowed in the oligo start/end linkers before the old fallbacks '
+                        '(default 0 = exact only)')
+    args = p.parse_args(argv)
 
     # compute adjustments
     link_A_adj = args.link_A_size - 8
@@ -44,10 +152,16 @@ def main():
     if link_end_adj < 0:
         link_end_adj = args.link_end_size + 2
 
+    metrics = Metrics('pull_barcodes', sample=os.path.basename(args.out_prefix))
+    stats = Counter()
+    length_hist = Counter()
+    link_edits = {'accepted': Counter(), 'rejected': Counter()}
+
     match_out = open(f"{args.out_prefix}.match", 'w')
-    reject_out = open(f"{args.out_prefix}.reject", 'w')
+    rejects = Rejects(metrics, f"{args.out_prefix}.reject", args.rejects)
+    beat = Heartbeat(metrics, 'reads')
 
-    with open(args.fastq) as fq:
+    with metrics.timer() as timing, open(args.fastq) as fq:
         while True:
             # read four lines of FASTQ
             id_line = fq.readline()
@@ -59,12 +173,16 @@ def main():
             if not qual_line:
                 break
 
+            stats['reads_in'] += 1
+            beat.tick(1, len(id_line) + len(seq_line) + len(plus_line) + len(qual_line))
             rid = id_line.strip().lstrip('@')
             if rid.endswith('/1'):
                 rid = rid[:-2]
 
             r1 = seq_line.strip()
             if len(r1) < args.min_seq_size:
+                rejects.add('too_short', len(r1), rid, "Sequence Too Short", len(r1))
+                stats['reject_too_short'] += 1
                 continue
 
             if args.read_orientation == 1:
@@ -72,10 +190,19 @@ def main():
 
             # find linker near barcode end
             seg = r1[args.bc_len-2 : args.bc_len-2 + 10]
-            idx = seg.find(args.link_A_bc)
+            idx, edits = find_linker(seg, args.link_A_bc, args.link_edits, gapped=False)
             if idx == -1:
-                reject_out.write(f"{rid}\tLinker Sequence Not Found\n")
+                if edits is None:
+                    rejects.add('linker_not_found', len(r1), rid, "Linker Sequence Not Found")
+                else:
+                    link_edits['rejected'][edits] += 1
+                    rejects.add('linker_not_found', len(r1), rid, "Linker Sequence Not Found", edits)
+                stats['reject_linker_not_found'] += 1
                 continue
+            if args.link_edits:
+                link_edits['accepted'][edits] += 1
+            if edits:
+                stats['linker_approx'] += 1
             link_index = idx + (args.bc_len - 2)
 
             # extract barcode
@@ -87,7 +214,9 @@ def main():
 
             # find oligo start
             sub = r1[link_index + link_A_adj : link_index + link_A_adj + 12]
-            oligo_start = sub.find(args.link_A_oligo)
+            oligo_start, edits = find_linker(sub, args.link_A_oligo, args.oligo_link_edits)
+            if edits and oligo_start != -1:
+                stats['oligo_link_approx'] += 1
             if oligo_start == -1:
                 m = re.search(r'A[ACTG][ACTG]G', sub)
                 oligo_start = m.start() if m else 0
@@ -95,7 +224,9 @@ def main():
 
             # find oligo end
             end_sub = r1[-link_end_adj:] if link_end_adj > 0 else ''
-            oligo_end = end_sub.find(args.end_A_oligo)
+            oligo_end, edits = find_linker(end_sub, args.end_A_oligo, args.oligo_link_edits)
+            if edits and oligo_end != -1:
+                stats['end_link_approx'] += 1
             if oligo_end == -1:
                 oligo_end = 2
             oligo_end -= link_end_adj
@@ -106,11 +237,27 @@ def main():
 
             if args.min_enh_size <= oligo_length <= args.max_enh_size:
                 match_out.write(f"{rid}\t{barcode_seq}\t{oligo_seq}\t{oligo_length}\t{len(r1)}\n")
+                stats['reads_out'] += 1
+                length_hist[oligo_length] += 1
             else:
-                reject_out.write(f"{rid}\tOligo Outside Length Bounds\t{barcode_seq}\t{oligo_length}\n")
+                rejects.add('oligo_length', oligo_length, rid, "Oligo Outside Length Bounds",
+                            barcode_seq, oligo_length)
+                stats['reject_oligo_length'] += 1
+        timing['records'] = stats['reads_in']
 
     match_out.close()
-    reject_out.close()
+    rejects.close()
+
+    metrics.counters(stats)
+    metrics.histogram('oligo_length', length_hist)
+    for outcome, hist in link_edits.items():
+        if hist:
+            metrics.histogram('linker_edit_distance', dict(sorted(hist.items())), outcome=outcome)
+    if args.link_edits:
+        accepted = link_edits['accepted']
+        print(f"{os.path.basename(args.out_prefix)}: barcode linker accepted "
+              + ", ".join(f"{accepted[e]:,} at {e} edit(s)" for e in range(args.link_edits + 1))
+              + f"; {sum(link_edits['rejected'].values()):,} rejected", file=sys.stderr)
 
 if __name__ == '__main__':
     main()
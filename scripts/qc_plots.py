@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+qc_plots.py
+
+Plotting layer shared by the QC scripts (count_qc.py, mapping_qc_plots.py,
+read_stats.py).
+
+Values are binned up front with numpy and figures are drawn from the binned
+arrays as one filled step outline per histogram, instead of handing millions
+of raw values to pandas/matplotlib and drawing one patch per bin. A histogram
+figure is described by a plain dict (hist_page), so a list of them can be
+rendered with the headless Agg backend in a process pool, each page to its own
+PDF, or all of them into one multi-page PDF.
+"""
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+MARGINS = dict(left=0.14, right=0.96, bottom=0.11, top=0.87)
+
+def pyplot():
+    """matplotlib.pyplot on the non-interactive Agg backend."""
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    return plt
+
+def histogram(values, bins, range=None):
+    """(counts, edges) of values in `bins` equal-width bins over [min, max] (or range)."""
+    values = np.asarray(values, dtype=float)
+    if values.size == 0:
+        return np.zeros(bins, dtype=np.int64), np.linspace(0, 1, bins + 1)
+    return np.histogram(values, bins=bins, range=range)
+
+def draw_hist(ax, counts, edges, **kwargs):
+    ax.stairs(counts, edges, fill=True, **kwargs)
+
+def ecdf(values):
+    """(x, y) of the empirical CDF with one point per distinct value."""
+    x, n = np.unique(np.asarray(values), return_counts=True)
+    return x, np.cumsum(n) / n.sum()
+
+def hist_page(path, values, bins, xlabel, title, vline=None, xlim=None, preview=None):
+    counts, edges = histogram(values, bins)
+    return {"path": str(path), "counts": counts, "edges": edges, "xlabel": xlabel,
+            "title": title, "vline": vline, "xlim": xlim, "preview": preview}
+
+def render_page(page, pdf=None):
+    """Draw one hist_page; save it to its own path, or as the next page of pdf."""
+    plt = pyplot()
+    fig, ax = plt.subplots()
+    draw_hist(ax, page["counts"], page["edges"])
+    if page["vline"] is not None:
+        ax.axvline(page["vline"], color="red")
+    if page["xlim"] is not None:
+        ax.set_xlim(*page["xlim"])
+    ax.set_xlabel(page["xlabel"])
+    ax.set_ylabel("Frequency")
+    ax.set_title(page["title"])
+    if page["preview"]:
+        fig.text(0.5, 0.995, page["preview"], ha="center", va="top", color="red", fontsize=8)
+    # fixed margins (room for a two-line title) instead of tight_layout, which
+    # measures every tick label and costs about as much as drawing the page
+    fig.subplots_adjust(**MARGINS)
+    if pdf is not None:
+        pdf.savefig(fig)
+    else:
+        fig.savefig(page["path"])
+    plt.close(fig)
+    return page["path"]
+
+def render_pages(pages, workers=1, combined=None):
+    """Render hist_pages: into the one multi-page PDF `combined`, else one PDF each on `workers` processes."""
+    if combined:
+        pyplot()
+        from matplotlib.backends.backend_pdf import PdfPages
+        with PdfPages(combined) as pdf:
+            for page in pages:
+                render_page(page, pdf)
+        return [combined]
+    if workers > 1 and len(pages) > 1:
+        with ProcessPoolExecutor(min(workers, len(pages)),
+                                 mp_context=multiprocessing.get_context("fork")) as pool:
+            return list(pool.map(render_page, pages))
+    return [render_page(page) for page in pages]
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+qsub_local.py
+
+Local stand-in for SGE qsub, for testing job submission (pipeline.py
+--executor sge, model.py --executor sge) without a cluster.
+
+Understands the options the pipeline uses: -N, -t first-last[:step], -hold_jid,
+-o, -e, -terse, -sync and -cwd, on the command line or as "#$" lines in the job
+script; other options (-P, -pe, -l, ...) are recorded and ignored. Jobs run
+immediately, one array task after another with SGE_TASK_ID/JOB_ID/JOB_NAME set,
+so a job submitted after the jobs it holds on always sees them finished.
+
+Every submission is appended as one JSON record to $QSUB_LOCAL_LOG (default
+./qsub_local.jsonl) with the job id, name, tasks, holds, resources and exit
+codes. With QSUB_LOCAL_DRY=1 jobs are recorded but not run.
+
+Usage:
+    qsub_local.py [qsub options] <job_script>
+"""
+import json
+import os
+import shlex
+import subprocess
+import sys
+
+def parse_options(tokens, opts):
+    i = 0
+    while i < len(tokens):
+        tok = tokens[i]
+        if tok in ("-terse", "-cwd"):
+            opts[tok[1:]] = True
+            i += 1
+        elif tok.startswith("-") and i + 1 < len(tokens):
+            key = tok[1:]
+            if key in ("l", "pe"):
+                opts.setdefault(key, []).append(" ".join(tokens[i + 1:i + (3 if key == "pe" else 2)]))
+                i += 3 if key == "pe" else 2
+            else:
+                opts[key] = tokens[i + 1]
+                i += 2
+        else:
+            return tokens[i:]
+    return []
+
+def task_ids(spec):
+    if not spec:
+        return [None]
+    rng, _, step = spec.partition(":")
+    first, _, last = rng.partition("-")
+    return list(range(int(first), int(last or first) + 1, int(step or 1)))
+
+def next_job_id(log_path):
+    job_id = 1
+    if os.path.exists(log_path):
+        with open(log_path) as fh:
+            for line in fh:
+                if line.strip():
+                    job_id = max(job_id, json.loads(line)["job_id"] + 1)
+    return job_id
+
+def log_path_for(template, name, job_id, task_id, default_suffix):
+    path = template or f"{name}.{default_suffix}{job_id}"
+    path = path.replace("$JOB_ID", str(job_id)).replace("$JOB_NAME", name)
+    return path.replace("$TASK_ID", str(task_id) if task_id is not None else "undefined")
+
+def main():
+    opts = {}
+    rest = parse_options(sys.argv[1:], opts)
+    if not rest:
+        sys.exit("usage: qsub_local.py [qsub options] <job_script>")
+    script = rest[0]
+    # "#$" directives first; command-line options take precedence
+    embedded = {}
+    with open(script) as fh:
+        for line in fh:
+            if line.startswith("#$"):
+                parse_options(shlex.split(line[2:]), embedded)
+    embedded.update(opts)
+    opts = embedded
+
+    log_path = os.environ.get("QSUB_LOCAL_LOG", "qsub_local.jsonl")
+    job_id = next_job_id(log_path)
+    name = opts.get("N", os.path.basename(script))
+    tasks = task_ids(opts.get("t"))
+    holds = [h for h in opts.get("hold_jid", "").split(",") if h]
+
+    exit_codes = []
+    if os.environ.get("QSUB_LOCAL_DRY") != "1":
+        for tid in tasks:
+            env = dict(os.environ, JOB_ID=str(job_id), JOB_NAME=name)
+            if tid is not None:
+                env["SGE_TASK_ID"] = str(tid)
+            with open(log_path_for(opts.get("o"), name, job_id, tid, "o"), "w") as out, \
+                 open(log_path_for(opts.get("e"), name, job_id, tid, "e"), "w") as err:
+                exit_codes.append(subprocess.run(["bash", script], env=env, stdout=out, stderr=err).returncode)
+
+    record = {"job_id": job_id, "name": name, "script": os.path.abspath(script),
+              "tasks": [t for t in tasks if t is not None], "hold_jid": holds,
+              "resources": {k: opts[k] for k in ("P", "pe", "l") if k in opts},
+              "exit_codes": exit_codes}
+    with open(log_path, "a") as fh:
+        fh.write(json.dumps(record) + "\n")
+
+    if opts.get("terse"):
+        print(f"{job_id}.{opts['t']}" if "t" in opts else job_id)
+    elif "t" in opts:
+        print(f'Your job-array {job_id}.{opts["t"]} ("{name}") has been submitted')
+    else:
+        print(f'Your job {job_id} ("{name}") has been submitted')
+    # -sync y reports the job's exit status, as qsub does
+    if opts.get("sync") == "y" and any(exit_codes):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
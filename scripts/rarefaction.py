@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+rarefaction.py
+
+Per-replicate barcode rarefaction curves from a compiled MPRA count table.
+
+For each replicate with N reads and barcode counts c_i, the expected outcome
+of drawing d reads without replacement is computed in closed form from the
+hypergeometric distribution (no resampling):
+
+    P(barcode i unseen at depth d) = C(N - c_i, d) / C(N, d)
+
+evaluated once per distinct count value of the replicate's count histogram.
+From these probabilities the script reports, at each depth:
+  - expected distinct barcodes
+  - expected oligos with >= m barcodes, for each threshold m: the exact
+    Poisson-binomial tail of each oligo's barcode detection probabilities,
+    from a DP over its barcodes that tracks P(k seen) for k < max(m)
+
+Usage:
+    rarefaction.py [--points 20] [--min_bc 1,5,10] <count_table> <id_out> <out_dir>
+
+Outputs:
+    <out_dir>/<id_out>_rarefaction.tsv  -- Sample, Fraction, Reads, Barcodes, Oligos_ge<m>...
+"""
+import argparse
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from scipy.special import gammaln
+
+from mpra_metrics import profiled
+
+QC_COLS = ['Error', 'CIGAR', 'MD', 'cs', 'Aln_Start:Stop', 'Aln_Start.Stop']
+
+def unseen_prob(k, n_total, depth):
+    """P(no read of a barcode with k reads among `depth` reads drawn from n_total), vectorized over k."""
+    k = np.asarray(k, dtype=float)
+    rest = n_total - k
+    out = np.zeros_like(k)
+    ok = rest >= depth
+    out[ok] = np.exp(gammaln(rest[ok] + 1) - gammaln(rest[ok] - depth + 1)
+                     - gammaln(n_total + 1) + gammaln(n_total - depth + 1))
+    return out
+
+def barcode_rounds(oligo_idx):
+    """Barcode indices split into rounds: round r holds the r-th barcode of every
+    oligo that has one, so no oligo appears twice within a round."""
+    order = np.argsort(oligo_idx, kind='stable')
+    sorted_idx = oligo_idx[order]
+    group_start = np.searchsorted(sorted_idx, sorted_idx)
+    rank = np.arange(len(order)) - group_start
+    by_rank = order[np.argsort(rank, kind='stable')]
+    return np.split(by_rank, np.cumsum(np.bincount(rank))[:-1]) if len(rank) else []
+
+def oligos_at_least(p_seen, oligo_idx, rounds, n_oligos, thresholds):
+    """Expected number of oligos with >= m barcodes seen, for each m in thresholds.
+
+    Exact Poisson-binomial tail per oligo: dp[o, k] = P(k of the barcodes of
+    oligo o processed so far are seen), for k < max(thresholds).
+    """
+    top = max(thresholds)
+    if top <= 0:
+        return [float(n_oligos)] * len(thresholds)
+    dp = np.zeros((n_oligos, top))
+    dp[:, 0] = 1.0
+    for idx in rounds:
+        o = oligo_idx[idx]
+        q = p_seen[idx][:, None]
+        cur = dp[o]
+        new = cur * (1.0 - q)
+        new[:, 1:] += cur[:, :-1] * q
+        dp[o] = new
+    below = np.cumsum(dp, axis=1)   # below[:, m-1] = P(fewer than m seen)
+    return [float(n_oligos) if m <= 0 else float(np.clip(1.0 - below[:, m - 1], 0.0, 1.0).sum())
+            for m in thresholds]
+
+def replicate_curve(counts, oligo_idx, n_oligos, fractions, thresholds):
+    counts = np.asarray(counts)
+    keep = counts > 0
+    counts, oligo_idx = counts[keep], oligo_idx[keep]
+    n_total = int(counts.sum())
+    rows = []
+    if n_total == 0:
+        return rows
+    # evaluate the hypergeometric term once per distinct count value
+    values, inverse = np.unique(counts, return_inverse=True)
+    rounds = barcode_rounds(oligo_idx)
+    for frac in fractions:
+        depth = int(round(frac * n_total))
+        p_seen = 1.0 - unseen_prob(values, n_total, depth)
+        per_bc = p_seen[inverse]
+        row = [frac, depth, float(per_bc.sum())]
+        row += oligos_at_least(per_bc, oligo_idx, rounds, n_oligos, thresholds)
+        rows.append(row)
+    return rows
+
+@profiled('rarefaction')
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Barcode rarefaction curves per replicate")
+    p.add_argument('count_table', help='Compiled .count table')
+    p.add_argument('id_out', help='Output prefix')
+    p.add_argument('out_dir', help='Output directory')
+    p.add_argument('--points', type=int, default=20, help='Number of subsampling depths (default 20)')
+    p.add_argument('--min_bc', default='1,5,10',
+                   help='Comma-separated barcodes-per-oligo thresholds (default 1,5,10)')
+    args = p.parse_args(argv)
+
+    thresholds = [int(x) for x in args.min_bc.split(',')]
+    fractions = np.linspace(1.0 / args.points, 1.0, args.points)
+
+    header = pd.read_csv(args.count_table, sep='\t', nrows=0).columns
+    samples = [c for c in header if c not in ['Barcode', 'Oligo'] + QC_COLS]
+    df = pd.read_csv(args.count_table, sep='\t', usecols=['Oligo'] + samples,
+                     dtype={'Oligo': str})
+    # drop the per-sample summary pseudo-barcode rows appended by compile_bc_cs
+    summary_tag = os.path.basename(args.count_table)
+    df = df[df['Oligo'].map(os.path.basename) != summary_tag]
+    oligo_idx, oligos = pd.factorize(df['Oligo'])
+
+    rows = []
+    for sample in samples:
+        curve = replicate_curve(df[sample].to_numpy(dtype=np.int64), oligo_idx,
+                                len(oligos), fractions, thresholds)
+        rows += [[sample] + r for r in curve]
+
+    out_dir = Path(args.out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    cols = ['Sample', 'Fraction', 'Reads', 'Barcodes'] + [f"Oligos_ge{m}" for m in thresholds]
+    out = out_dir / f"{args.id_out}_rarefaction.tsv"
+    pd.DataFrame(rows, columns=cols).to_csv(out, sep='\t', index=False, float_format='%.6g')
+    print(f"Rarefaction curves written to: {out}")
+
+if __name__ == '__main__':
+    main()
@@ -5,27 +5,39 @@ read_stats.py
 Generate read-stats PDF summarizing good barcodes and read counts per replicate.
 
 Usage:
-    read_stats.py <stats_out_file> <acc_file> <id_out> <out_dir>
+    read_stats.py <stats_out_file|metrics.jsonl> <acc_file> <id_out> <out_dir>
+
+The first argument may be the legacy .stats table or the metrics JSONL stream
+written by the count stage (see mpra_metrics.py).
 
 Outputs:
     <out_dir>/<id_out>_read_stats.pdf
 """
 import argparse
+import os
 import pandas as pd
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_pdf import PdfPages
-from matplotlib.ticker import MaxNLocator
 
-def main():
+from mpra_metrics import sample_stats, profiled
+from qc_plots import pyplot
+
+@profiled('read_stats')
+def main(argv=None):
     parser = argparse.ArgumentParser(description="Generate read-stats PDF summarizing good barcodes and read counts per replicate.")
-    parser.add_argument('stats_file', help='Tab-delimited stats file with Sample, Key, Count, Sum')
+    parser.add_argument('stats_file', help='Tab-delimited stats file with Sample, Key, Count, Sum, or a metrics .jsonl')
     parser.add_argument('acc_file', help='Accumulator file: file_name<tab>rep<tab>cell<tab>source')
     parser.add_argument('id_out', help='Output prefix')
     parser.add_argument('out_dir', help='Output directory')
-    args = parser.parse_args()
+    parser.add_argument('--rarefaction', help='Rarefaction TSV from rarefaction.py (adds saturation pages)')
+    args = parser.parse_args(argv)
+    plt = pyplot()
+    from matplotlib.backends.backend_pdf import PdfPages
+    from matplotlib.ticker import MaxNLocator
 
     # Load stats file
-    stats_df = pd.read_csv(args.stats_file, sep='\t')
+    if args.stats_file.endswith('.jsonl'):
+        stats_df = pd.DataFrame(sample_stats(args.stats_file), columns=["Sample", "Key", "Count", "Sum"])
+    else:
+        stats_df = pd.read_csv(args.stats_file, sep='\t', dtype={"Key": str})
 
     # Define valid keys for total
     valid_keys = ["0", "1", "2"]
@@ -68,6 +80,9 @@ def main():
     # Assign colors
     colors = merged["cell"].map(cell_color_map)
 
+    # set by count.py --preview: mark every plot as a preview
+    preview = os.environ.get("MPRA_PREVIEW")
+
     # PDF output
     pdf_path = f"{args.out_dir}/{args.id_out}_read_stats.pdf"
     with PdfPages(pdf_path) as pdf:
@@ -81,6 +96,8 @@ def main():
         ax1.legend(handles, cell_color_map.keys(), title="Cell Type")
         ax1.set_yticks(range(len(merged["Sample"])))
         ax1.set_yticklabels(merged["Sample"])
+        if preview:
+            fig1.text(0.5, 0.995, preview, ha='center', va='top', color='red', fontsize=8)
         pdf.savefig(fig1)
         plt.close(fig1)
 
@@ -94,9 +111,31 @@ def main():
         ax2.xaxis.set_major_locator(MaxNLocator(prune='both', nbins=6))
         ax2.set_yticks(range(len(merged["Sample"])))
         ax2.set_yticklabels(merged["Sample"])
+        if preview:
+            fig2.text(0.5, 0.995, preview, ha='center', va='top', color='red', fontsize=8)
         pdf.savefig(fig2)
         plt.close(fig2)
 
+        # Rarefaction / saturation curves
+        if args.rarefaction:
+            rare = pd.read_csv(args.rarefaction, sep='\t')
+            rare["Sample"] = rare["Sample"].astype(str).str.strip()
+            metrics_cols = ["Barcodes"] + [c for c in rare.columns if c.startswith("Oligos_ge")]
+            fig3, axs3 = plt.subplots(len(metrics_cols), 1, figsize=(8, 4 * len(metrics_cols)), squeeze=False)
+            for ax, col in zip(axs3[:, 0], metrics_cols):
+                for sample, sub in rare.groupby("Sample", sort=False):
+                    ax.plot(sub["Reads"], sub[col], color=cell_color_map.get(sample_to_cell.get(sample), "grey"), lw=1)
+                label = "Distinct barcodes" if col == "Barcodes" else f"Oligos with >= {col[len('Oligos_ge'):]} barcodes"
+                ax.set_xlabel("Subsampled reads")
+                ax.set_ylabel(label)
+                ax.set_title(f"Expected {label} vs Depth")
+            axs3[0, 0].legend(handles, cell_color_map.keys(), title="Cell Type")
+            if preview:
+                fig3.text(0.5, 0.995, preview, ha='center', va='top', color='red', fontsize=8)
+            fig3.tight_layout()
+            pdf.savefig(fig3)
+            plt.close(fig3)
+
     print(f"PDF written to: {pdf_path}")
 
 if __name__ == "__main__":
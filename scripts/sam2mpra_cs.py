@@ -5,17 +5,22 @@ sam2mpra_cs.py
 Convert a SAM file into MPRA mapping output, parsing CIGAR and cs-tags.
 
 Usage:
-    sam2mpra_cs.py [-C] [-B] <input.sam> <output_prefix>
+    sam2mpra_cs.py [-C] [-B] [--ids <table.ids>] <input.sam> <output_prefix>
 
 Options:
   -C    Use updated CIGAR scoring in score_all (include CIGAR substitutions)
   -B    Only include forward‐strand reads (bitflag 0x10 must be unset)
+  --ids Write the reference columns as oligo_ids.py codes
 """
 import argparse
 import sys
 import re
+from collections import Counter
 from pathlib import Path
 
+from mpra_metrics import Heartbeat, Metrics, profiled
+from oligo_ids import OligoIds
+
 # Translation table for reverse-complement
 _RC_TABLE = str.maketrans('ACGTNacgtn', 'TGCANtgcan')
 
@@ -64,7 +69,63 @@ def parse_cs(cs: str):
             raise ValueError(f"Unexpected cs element: {orig}")
     return mismatch_cs, indel_cs
 
-def main():
+def mpra_fields(qname, flag, rname, mapq, cigar, seq, size, pos0, cs_val, cigar_flag, score_cutoff):
+    """Output columns for one alignment record (SAM fields plus reference length)."""
+    # parse CIGAR and cs
+    _, mismatch_cigar, cigar_sub, aln_len = parse_cigar(cigar)
+    mismatch_cs, _ = parse_cs(cs_val)
+
+    # determine strand and orientation
+    bits = format(flag, '012b')
+    rev_strand = bits[7] == '1'
+    seq_ori = reverse_complement(seq) if rev_strand else seq
+
+    # compute scores
+    if size > 0:
+        unaln_len = size - aln_len
+        score = mismatch_cigar / size
+        if cigar_flag:
+            score_all = (mismatch_cigar + cigar_sub + unaln_len) / size
+        else:
+            score_all = (mismatch_cigar + mismatch_cs + unaln_len) / size
+        score_all_str = f"{score_all:.3f}"
+        score_str = f"{score:.3f}"
+    else:
+        score_all_str = score_str = '-'
+        unaln_len = None
+
+    aln_info = f"{pos0}:{aln_len}"
+    updated_chr = rname
+    if rev_strand:
+        parts = rname.split('_')
+        updated_chr = parts[0] + "_RC_" + "_".join(parts[1:])
+
+    status = "PASS" if (score_all_str != '-' and float(score_all_str) <= score_cutoff) else "FAIL"
+
+    if '#' in qname:
+        bc_id, oligo_id = qname.split('#', 1)
+    else:
+        bc_id, oligo_id = qname, ''
+
+    return [
+        bc_id,
+        oligo_id,
+        '1' if not rev_strand else '0',
+        updated_chr,
+        rname,
+        mapq,          # ← added!
+        str(size),
+        cigar,
+        score_all_str,
+        seq_ori,
+        status,
+        score_str,
+        cs_val,
+        aln_info
+    ]
+
+@profiled('sam2mpra_cs')
+def main(argv=None):
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('-C', action='store_true', dest='cigar_flag',
                         help='Include CIGAR substitutions in score_all')
@@ -72,18 +133,25 @@ def main():
                         help='Filter to forward-strand only (bit 0x10 unset)')
     parser.add_argument('-O', '--oligo_alnmismatchrate_cutoff', type=float, default=0.05,
                         help='Maximum allowed oligo alignment mismatch rate (default: 0.05)')
+    parser.add_argument('--ids', default=None,
+                        help='oligo_ids.py table: write reference columns 4-5 as integer codes')
     parser.add_argument('sam', help='Input SAM file path')
     parser.add_argument('out', help='Output prefix (will write to this file)')
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     infile = Path(args.sam)
     outfile = Path(args.out)
 
     score_cutoff = args.oligo_alnmismatchrate_cutoff
+    ids = OligoIds.load(args.ids) if args.ids else None
     chr_size = {}
+    metrics = Metrics('sam2mpra_cs', sample=outfile.name)
+    stats = Counter()
+    beat = Heartbeat(metrics, 'records')
 
-    with infile.open() as fin, outfile.open('w') as fout:
+    with metrics.timer() as timing, infile.open() as fin, outfile.open('w') as fout:
         for line in fin:
+            beat.tick(1, len(line))
             line = line.rstrip('\r\n')
             if line.startswith('@SQ'):
                 # header line: @SQ SN:chr LN:length
@@ -98,75 +166,34 @@ def main():
 
             cols = line.split('\t')
             flag = int(cols[1])
+            stats['records_in'] += 1
             # filter by bitflag if requested
             if args.bit_flag and (flag & 0x10):
+                stats['skipped_reverse_strand'] += 1
                 continue
 
             qname = cols[0]
             rname = cols[2]
-            mapq = cols[4]  # ← **MAPQ field added**
-            cigar = cols[5]
-            seq = cols[9]
-            size = chr_size.get(rname, 0)
             pos0 = int(cols[3]) - 1
 
             # extract cs:Z: tag
             cs_field = next((f for f in cols if f.startswith('cs:Z:')), 'cs:Z:*')
             cs_val = cs_field.split(':',2)[2]
 
-            # parse CIGAR and cs
-            _, mismatch_cigar, cigar_sub, aln_len = parse_cigar(cigar)
-            mismatch_cs, _ = parse_cs(cs_val)
-
-            # determine strand and orientation
-            bits = format(flag, '012b')
-            rev_strand = bits[7] == '1'
-            seq_ori = reverse_complement(seq) if rev_strand else seq
-
-            # compute scores
-            if size > 0:
-                unaln_len = size - aln_len
-                score = mismatch_cigar / size
-                if args.cigar_flag:
-                    score_all = (mismatch_cigar + cigar_sub + unaln_len) / size
-                else:
-                    score_all = (mismatch_cigar + mismatch_cs + unaln_len) / size
-                score_all_str = f"{score_all:.3f}"
-                score_str = f"{score:.3f}"
-            else:
-                score_all_str = score_str = '-'
-                unaln_len = None
-
-            aln_info = f"{pos0}:{aln_len}"
-            updated_chr = rname
-            if rev_strand:
-                parts = rname.split('_')
-                updated_chr = parts[0] + "_RC_" + "_".join(parts[1:])
-
-            status = "PASS" if (score_all_str != '-' and float(score_all_str) <= score_cutoff) else "FAIL"
-
-            if '#' in qname:
-                bc_id, oligo_id = qname.split('#', 1)
-            else:
-                bc_id, oligo_id = qname, ''
-
-            out_fields = [
-                bc_id,
-                oligo_id,
-                '1' if not rev_strand else '0',
-                updated_chr,
-                rname,
-                mapq,          # ← added!
-                str(size),
-                cigar,
-                score_all_str,
-                seq_ori,
-                status,
-                score_str,
-                cs_val,
-                aln_info
-            ]
+            out_fields = mpra_fields(qname, flag, rname, cols[4], cols[5], cols[9],
+                                     chr_size.get(rname, 0), pos0, cs_val,
+                                     args.cigar_flag, score_cutoff)
+            if ids is not None:
+                ids.encode_fields(out_fields)
+            status = out_fields[10]
             fout.write("\t".join(out_fields) + "\n")
+            stats['records_out'] += 1
+            stats['pass' if status == "PASS" else 'fail'] += 1
+            if rname == '*':
+                stats['unmapped'] += 1
+        timing['records'] = stats['records_in']
+
+    metrics.counters(stats)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+scratch.py
+
+Working directory for the match and count stages.
+
+Without a scratch root every step runs in <out_dir> and nothing is moved or
+removed (the original layout). With a scratch root (e.g. $TMPDIR on the compute
+node) the steps run in a private directory under it:
+  - release(): intermediates are deleted as soon as their last consumer is done
+  - finish():  only the declared final artifacts are copied back to <out_dir>,
+               gzip-compressed where requested, then the directory is removed
+  - close():   removes the directory without copying anything back, so a
+               failed run does not leave it behind on the node
+"""
+import gzip
+import os
+import shutil
+import sys
+import tempfile
+
+class Workspace:
+    def __init__(self, out_dir, scratch_root=None, prefix="mpra"):
+        self.out_dir = os.path.abspath(out_dir)
+        self.scratch = bool(scratch_root)
+        if self.scratch:
+            scratch_root = os.path.abspath(scratch_root)
+            os.makedirs(scratch_root, exist_ok=True)
+            self.dir = tempfile.mkdtemp(prefix=f"{prefix}.", dir=scratch_root)
+        else:
+            self.dir = self.out_dir
+        os.makedirs(self.out_dir, exist_ok=True)
+
+    def release(self, *paths):
+        """Intermediates no later step reads; removed in scratch mode only."""
+        if not self.scratch:
+            return
+        for path in paths:
+            if os.path.lexists(path):
+                os.remove(path)
+
+    def link_in(self, name):
+        """Make <out_dir>/<name> visible under the same relative name in the workspace."""
+        if self.scratch and not os.path.lexists(name):
+            os.symlink(os.path.join(self.out_dir, name), name)
+
+    def copy_in(self, name):
+        """Copy <out_dir>/<name>, if it exists, into the workspace: for files a step
+        appends to, which must not change in out_dir before the run finishes."""
+        src = os.path.join(self.out_dir, name)
+        if self.scratch and not os.path.lexists(name) and os.path.exists(src):
+            shutil.copyfile(src, name)
+
+    def close(self):
+        """Drop the workspace if finish() has not (e.g. after a failure)."""
+        if self.scratch and os.path.isdir(self.dir):
+            os.chdir(self.out_dir)
+            shutil.rmtree(self.dir)
+
+    def finish(self, keep=(), compress=()):
+        """Copy final artifacts back to out_dir (compressed ones get .gz) and drop the workspace."""
+        if not self.scratch:
+            return
+        for path in keep:
+            if os.path.islink(path):
+                continue
+            dest = os.path.join(self.out_dir, os.path.basename(path))
+            print(f">> copy {path} -> {dest}", file=sys.stderr)
+            shutil.copyfile(path, dest)
+        for path in compress:
+            dest = os.path.join(self.out_dir, os.path.basename(path) + ".gz")
+            print(f">> gzip {path} -> {dest}", file=sys.stderr)
+            with open(path, "rb") as fin, gzip.open(dest, "wb", compresslevel=6) as out:
+                shutil.copyfileobj(fin, out, 1 << 20)
+        os.chdir(self.out_dir)
+        shutil.rmtree(self.dir)
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+subsample_fastq.py
+
+Stream one or more FASTQ files in lockstep (e.g. R1 and R2) and write a
+subsample of the records, for quick preview runs of the match/count stages.
+
+The preview size is either a fraction (0 < x < 1) or a number of reads (x >= 1):
+  - fraction:  each record is kept with probability x (single streaming pass)
+  - N reads:   the first N records (--method head, default; stops reading
+               early), or a reservoir sample of N records (--method reservoir,
+               reads the whole input)
+
+Usage:
+    subsample_fastq.py [--method head|reservoir] [--seed S] <preview> <in.fq[.gz]>[,<in2.fq[.gz]>...] <out.fq>[,<out2.fq>...]
+
+Outputs are plain-text FASTQ. Reads kept/seen are reported to the metrics stream.
+"""
+import argparse
+import gzip
+import os
+import random
+import sys
+from itertools import islice
+
+from mpra_metrics import Metrics, profiled
+
+def open_by_suffix(filename):
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rt')
+    return open(filename, 'r')
+
+def parse_preview(value):
+    """Return (fraction, n_reads); exactly one is set."""
+    x = float(value)
+    if x <= 0:
+        raise ValueError(f"preview must be > 0, got {value}")
+    if x < 1:
+        return x, None
+    if x != int(x):
+        raise ValueError(f"preview read count must be an integer, got {value}")
+    return None, int(x)
+
+def records(handles):
+    """Yield tuples of 4-line FASTQ records, one per input, in lockstep."""
+    while True:
+        recs = tuple(''.join(islice(h, 4)) for h in handles)
+        if not recs[0]:
+            return
+        if any(not r for r in recs):
+            raise RuntimeError("FASTQ inputs have different numbers of records")
+        yield recs
+
+def subsample(in_paths, out_paths, preview, method='head', seed=1):
+    fraction, n_reads = parse_preview(preview)
+    rng = random.Random(seed)
+    metrics = Metrics('subsample_fastq', sample=os.path.basename(out_paths[0]))
+
+    ins = [open_by_suffix(p) for p in in_paths]
+    outs = [open(p, 'w') for p in out_paths]
+    seen = kept = 0
+    try:
+        with metrics.timer() as timing:
+            if fraction is not None:
+                for recs in records(ins):
+                    seen += 1
+                    if rng.random() < fraction:
+                        kept += 1
+                        for out, rec in zip(outs, recs):
+                            out.write(rec)
+            elif method == 'head':
+                for recs in islice(records(ins), n_reads):
+                    seen += 1
+                    kept += 1
+                    for out, rec in zip(outs, recs):
+                        out.write(rec)
+            else:
+                # Algorithm R: memory bounded by n_reads records
+                reservoir = []
+                for recs in records(ins):
+                    if seen < n_reads:
+                        reservoir.append(recs)
+                    else:
+                        j = rng.randint(0, seen)
+                        if j < n_reads:
+                            reservoir[j] = recs
+                    seen += 1
+                kept = len(reservoir)
+                for recs in reservoir:
+                    for out, rec in zip(outs, recs):
+                        out.write(rec)
+            timing['records'] = seen
+    finally:
+        for h in ins + outs:
+            h.close()
+
+    # head mode stops early, so the total is unknown and no projection factor exists
+    complete = fraction is not None or method != 'head'
+    metrics.counters({'reads_seen': seen, 'reads_kept': kept}, complete=complete)
+    return seen, kept, complete
+
+@profiled('subsample_fastq')
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Subsample FASTQ files (in lockstep) for preview runs")
+    p.add_argument('preview', help='Fraction of reads (0-1) or number of reads (>=1)')
+    p.add_argument('inputs', help='Comma-separated input FASTQ(s)')
+    p.add_argument('outputs', help='Comma-separated output FASTQ(s), same order')
+    p.add_argument('--method', choices=['head', 'reservoir'], default='head',
+                   help='How to pick N reads (default head; ignored for fractions)')
+    p.add_argument('--seed', type=int, default=1, help='Random seed (default 1)')
+    args = p.parse_args(argv)
+
+    in_paths = args.inputs.split(',')
+    out_paths = args.outputs.split(',')
+    if len(in_paths) != len(out_paths):
+        sys.exit("ERROR: number of inputs and outputs must match")
+
+    seen, kept, complete = subsample(in_paths, out_paths, args.preview, args.method, args.seed)
+    total = str(seen) if complete else f">={seen}"
+    print(f"Kept {kept} of {total} reads", file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
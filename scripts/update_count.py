@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+update_count.py
+
+Merge top-up sequencing or new replicates into an existing compiled count table.
+
+For every sample in <list_file> (sample_id<tab>new_tag_file):
+  - if <sample_id>.tag already exists, the new tag counts are summed into it
+    (top-up of an existing replicate); otherwise the new tag file becomes
+    <sample_id>.tag (new replicate)
+  - the sample column of <count_table> is replaced with the merged counts, or
+    appended as a new column for a new replicate
+  - the summary pseudo-barcode rows of the updated samples are regenerated;
+    rows of untouched samples are kept as they are
+
+The same alignment cutoff and duplicate/consistency checks as compile_bc_cs.py
+are applied: a barcode already in the table must agree on the Oligo and on
+whichever of the Error, CIGAR, cs and Aln_Start:Stop columns the table has.
+The count table is streamed and rewritten in place.
+
+Usage:
+    update_count.py [-E] [-C] [-M] [-S] [-A cutoff] [-O prefix] <list_file> <count_table>
+"""
+import argparse
+import logging
+import os
+import sys
+from collections import OrderedDict, defaultdict
+
+from mpra_metrics import Metrics, profiled
+from oligo_matrix import OligoAggregator
+
+TAG_FIELDS = 10
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Merge new replicate / top-up tag files into an existing count table")
+    p.add_argument('-E', action='store_true', dest='err_flag', help='Table has error rate column')
+    p.add_argument('-C', action='store_true', dest='cigar_flag', help='Table has CIGAR column')
+    p.add_argument('-M', action='store_true', dest='md_flag', help='Table has MD/cs column')
+    p.add_argument('-S', action='store_true', dest='pos_flag', help='Table has alignment start/stop column')
+    p.add_argument('-A', dest='aln_cutoff', type=float, default=0.05, help='Alignment error cutoff (default 0.05)')
+    p.add_argument('-O', dest='oligo_out', default=None,
+                   help='Also rewrite <prefix>.oligo_counts / .oligo_barcodes from the updated table')
+    p.add_argument('list_file', help='TSV: sample_id<tab>new_tag_file')
+    p.add_argument('count_table', help='Existing count table to update')
+    return p.parse_args(argv)
+
+def read_tags(path):
+    tags = OrderedDict()
+    with open(path) as f:
+        for line in f:
+            parts = line.rstrip('\n').split('\t')
+            if len(parts) < TAG_FIELDS:
+                continue
+            tags[parts[0]] = parts
+    return tags
+
+def merge_tags(old_path, new_path):
+    """Sum the per-barcode counts of two tag files, keeping the newest mapping info."""
+    merged = read_tags(old_path)
+    for bc, parts in read_tags(new_path).items():
+        if bc in merged:
+            parts = list(parts)
+            parts[1] = str(int(parts[1]) + int(merged[bc][1]))
+        merged[bc] = parts
+    return merged
+
+def write_tags(tags, path):
+    """Write to <path>.tmp; the caller moves it into place once the table is updated."""
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as out:
+        for parts in tags.values():
+            out.write('\t'.join(parts) + '\n')
+    return tmp
+
+def sample_counts(tags, aln_cutoff):
+    """Apply compile_bc_cs filters; return (barcode -> info, key -> {'ct', 'sum'})."""
+    kept = {}
+    stats = defaultdict(lambda: {'ct': 0, 'sum': 0})
+    for barcode, parts in tags.items():
+        try:
+            bc_ct = int(parts[1])
+        except ValueError:
+            continue
+        oligo, bc_flag = parts[3], parts[4]
+        stats[bc_flag]['ct'] += 1
+        stats[bc_flag]['sum'] += bc_ct
+        bc_aln_str = parts[6]
+        if ',' in bc_aln_str or bc_aln_str == "NA":
+            continue
+        try:
+            bc_aln = float(bc_aln_str)
+        except ValueError:
+            continue
+        if bc_flag in ('0', '2') and oligo != '*' and bc_aln <= aln_cutoff:
+            kept[barcode] = (bc_ct, oligo, bc_aln, parts[7], parts[8], parts[9])
+    return kept, stats
+
+MISMATCH = ("Oligo ID", "Alignment", "CIGAR", "MD", "Position")
+
+def table_info(row, args):
+    """(oligo, aln, cigar, md, pos) of a count table row; None for columns the table lacks."""
+    extra = iter(row[2:])
+    aln, cigar, md, pos = (next(extra) if flag else None
+                           for flag in (args.err_flag, args.cigar_flag, args.md_flag, args.pos_flag))
+    return row[1], None if aln is None else float(aln), cigar, md, pos
+
+def check_consistent(bc, have, info, logger):
+    """compile_bc_cs.py's checks for a barcode seen again: have and info are
+    (oligo, aln, cigar, md, pos), and None in have is not compared."""
+    for what, old, new in zip(MISMATCH, have, info):
+        if old is not None and old != new:
+            logger.error(f"{what} mismatch for {bc}")
+            raise RuntimeError(f"{what} mismatch for {bc}")
+
+def row_tag(summary_rows, count_table):
+    """Reuse the Oligo label of existing summary rows so they stay recognizable."""
+    return summary_rows[0][1] if summary_rows else count_table
+
+@profiled('update_count')
+def main(argv=None):
+    args = parse_args(argv)
+
+    logging.basicConfig(
+        filename=args.count_table + '.update.log',
+        filemode='a',
+        level=logging.INFO,
+        format='%(asctime)s [%(levelname)s] %(message)s',
+        force=True,   # reconfigure when called repeatedly in one interpreter
+    )
+    logger = logging.getLogger()
+    metrics = Metrics('compile_bc_cs')
+
+    updates = OrderedDict()
+    with open(args.list_file) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                sample, fname = line.split()[:2]
+                updates[sample] = fname
+
+    n_extra = sum([args.err_flag, args.cigar_flag, args.md_flag, args.pos_flag])
+    first_sample_col = 2 + n_extra
+    summary_tag = os.path.basename(args.count_table)
+
+    with open(args.count_table) as fin:
+        header = fin.readline().rstrip('\n').split('\t')
+        samples = header[first_sample_col:]
+
+        # merge tag files and derive the new per-sample columns
+        new_cols = {}
+        new_stats = {}
+        pending_tags = {}
+        for sample_id, new_tag in updates.items():
+            tag_path = f"{sample_id}.tag"
+            if os.path.exists(tag_path) and os.path.abspath(tag_path) != os.path.abspath(new_tag):
+                if sample_id not in samples:
+                    logger.warning(f"{tag_path} exists but {sample_id} is not in {args.count_table}; merging anyway")
+                logger.info(f"Top-up: summing {new_tag} into {tag_path}")
+                tags = merge_tags(tag_path, new_tag)
+            else:
+                logger.info(f"New replicate: {sample_id} from {new_tag}")
+                tags = read_tags(new_tag)
+            pending_tags[tag_path] = write_tags(tags, tag_path)
+            new_cols[sample_id], new_stats[sample_id] = sample_counts(tags, args.aln_cutoff)
+
+        added = [s for s in updates if s not in samples]
+        out_samples = samples + added
+        col_of = {s: first_sample_col + i for i, s in enumerate(out_samples)}
+        seen = set()
+        oligo_agg = OligoAggregator(out_samples) if args.oligo_out else None
+
+        tmp_path = args.count_table + '.tmp'
+        with open(tmp_path, 'w') as out:
+            out.write('\t'.join(header[:first_sample_col] + out_samples) + '\n')
+            summary_rows = []
+            for line in fin:
+                row = line.rstrip('\n').split('\t')
+                if os.path.basename(row[1]) == summary_tag:
+                    summary_rows.append(row)
+                    continue
+                row.extend(['0'] * len(added))
+                bc = row[0]
+                have = None
+                for sample_id, col in new_cols.items():
+                    info = col.get(bc)
+                    if info is None:
+                        row[col_of[sample_id]] = '0'
+                        continue
+                    if have is None:
+                        have = table_info(row, args)
+                    check_consistent(bc, have, info[1:], logger)
+                    row[col_of[sample_id]] = str(info[0])
+                    seen.add(bc)
+                out.write('\t'.join(row) + '\n')
+                if oligo_agg is not None:
+                    oligo_agg.add(row[1], [int(v) for v in row[first_sample_col:]])
+
+            # barcodes only present in the new data
+            new_rows = OrderedDict()
+            first_info = {}
+            for sample_id, col in new_cols.items():
+                for bc, (bc_ct, oligo, bc_aln, cigar, md, pos) in col.items():
+                    if bc in seen:
+                        continue
+                    row = new_rows.get(bc)
+                    if row is None:
+                        first_info[bc] = (oligo, bc_aln, cigar, md, pos)
+                        row = [bc, oligo]
+                        if args.err_flag: row.append(str(bc_aln))
+                        if args.cigar_flag: row.append(cigar)
+                        if args.md_flag: row.append(md)
+                        if args.pos_flag: row.append(pos)
+                        row.extend(['0'] * len(out_samples))
+                        new_rows[bc] = row
+                    else:
+                        check_consistent(bc, first_info[bc], (oligo, bc_aln, cigar, md, pos), logger)
+                    row[col_of[sample_id]] = str(bc_ct)
+            for row in new_rows.values():
+                out.write('\t'.join(row) + '\n')
+                if oligo_agg is not None:
+                    oligo_agg.add(row[1], [int(v) for v in row[first_sample_col:]])
+            logger.info(f"Added {len(new_rows)} new barcodes")
+
+            # summary pseudo-barcode rows: keep untouched samples, regenerate updated ones
+            for row in summary_rows:
+                row.extend(['0'] * len(added))
+                owner = next((s for s in samples if row[col_of[s]] != '0'), None)
+                if owner in updates:
+                    continue
+                out.write('\t'.join(row) + '\n')
+            for sample_id in updates:
+                stats = new_stats[sample_id]
+                for key in sorted(stats):
+                    st = stats[key]
+                    row = [key, row_tag(summary_rows, args.count_table)] + ['NA'] * n_extra
+                    row.extend(str(st['sum']) if s == sample_id else '0' for s in out_samples)
+                    out.write('\t'.join(row) + '\n')
+                    logger.info(f"Summary for sample={sample_id}, key={key}: count={st['ct']}, sum={st['sum']}")
+                    metrics.for_sample(sample_id).counter('barcodes', st['ct'], key=key)
+                    metrics.for_sample(sample_id).counter('reads', st['sum'], key=key)
+
+    # only commit the merged tag files once the table itself is in place,
+    # so a failed update can simply be rerun
+    os.replace(tmp_path, args.count_table)
+    for tag_path, tmp in pending_tags.items():
+        os.replace(tmp, tag_path)
+    if oligo_agg is not None:
+        oligo_agg.write(args.oligo_out)
+    print(f"Updated {args.count_table}: {len(updates)} sample(s), {len(added)} new column(s)", file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
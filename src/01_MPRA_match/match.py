@@ -1,10 +1,61 @@
 #!/usr/bin/env python3
 import argparse, subprocess, os, sys
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 def run(cmd):
     print(f">> {cmd}", file=sys.stderr)
     subprocess.run(cmd, shell=True, check=True)
 
+class Step:
+    def __init__(self, name, action, deps=(), threads=1, frees=()):
+        self.name = name
+        self.action = action
+        self.deps = list(deps)
+        self.threads = threads
+        self.frees = list(frees)   # intermediates to release once every step freeing them is done
+
+def execute(steps, budget, ws):
+    """Start every step whose deps are done and whose threads fit in the free budget.
+
+    After a failure no new step is started; the running ones are waited for and
+    the first error is raised.
+    """
+    names = {s.name for s in steps}
+    for s in steps:
+        s.deps = [d for d in s.deps if d in names]
+    users = Counter(f for s in steps for f in s.frees)
+    pending, running, done = list(steps), {}, set()
+    free, error = budget, None
+    with ThreadPoolExecutor(max_workers=len(steps)) as pool:
+        while pending or running:
+            if error is None:
+                for s in list(pending):
+                    need = min(s.threads, budget)
+                    if all(d in done for d in s.deps) and need <= free:
+                        print(f">> [{s.name}] start", file=sys.stderr)
+                        running[pool.submit(s.action)] = (s, need)
+                        free -= need
+                        pending.remove(s)
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                s, need = running.pop(fut)
+                free += need
+                if fut.exception() is not None:
+                    print(f"!! [{s.name}] failed: {fut.exception()}", file=sys.stderr)
+                    error = error or fut.exception()
+                    continue
+                done.add(s.name)
+                print(f"<< [{s.name}] done", file=sys.stderr)
+                for f in s.frees:
+                    users[f] -= 1
+                    if not users[f]:
+                        ws.release(f)
+    if error is not None:
+        raise error
+
 def main():
     p = argparse.ArgumentParser(description="MPRA barcode–oligo matching pipeline")
     p.add_argument("--read_a",         required=True,  help="R1 FASTQ")
@@ -25,98 +76,202 @@ def main():
     p.add_argument("--barcode_link",   default="TCTAGA")
     p.add_argument("--oligo_link",     default="AGTG")
     p.add_argument("--end_oligo_link", default="CGTC")
+    p.add_argument("--link_edits",     type=int, default=0,
+                   help="Substitutions allowed when locating the barcode linker (default 0 = exact match only)")
+    p.add_argument("--oligo_link_edits", type=int, default=0,
+                   help="Edits allowed when locating the oligo start/end linkers (default 0)")
     p.add_argument("--oligo_alnmismatchrate_cutoff", type=float, default=0.05,
                    help="Maximum allowed oligo alignment mismatch rate (default 0.05)")
     p.add_argument("--scripts_dir",    required=True, help="where pull_barcodes.py etc live")
     p.add_argument("--out_dir",        required=True, help="where to write all results")
     p.add_argument("--id_out",         required=True, help="output prefix (id_out)")
+    p.add_argument("--metrics",        default=None,
+                   help="Metrics JSONL stream shared by all helper scripts "
+                        "(default: <out_dir>/<id_out>.metrics.jsonl)")
+    p.add_argument("--preview",        default=None, metavar="FRACTION|N",
+                   help="Quick preview on a subsample of read pairs: a fraction (0-1) "
+                        "or a number of pairs. Results go to <out_dir>/preview/")
+    p.add_argument("--preview_method", choices=["head", "reservoir"], default="head",
+                   help="How to pick N read pairs for --preview: the first N (default) "
+                        "or a reservoir sample, which reads the whole FASTQ")
+    p.add_argument("--scratch",        nargs="?", const=os.environ.get("TMPDIR", "/tmp"), default=None,
+                   metavar="DIR",
+                   help="Run every step in node-local scratch (default $TMPDIR), delete intermediates "
+                        "as soon as they are consumed and copy only the final files to out_dir")
+    p.add_argument("--index_cache",    default=os.environ.get("MPRA_INDEX_CACHE", os.path.expanduser("~/.cache/mpra/minimap2")),
+                   help="Directory of prebuilt minimap2 indexes, keyed by reference content and "
+                        "index options ('none' to index the FASTA on every run)")
+    p.add_argument("--aligner",        choices=["minimap2", "mappy"], default="minimap2",
+                   help="'minimap2': command-line minimap2, SAM, samtools and sam2mpra_cs.py; "
+                        "'mappy': align in-process with the minimap2 Python binding and write the "
+                        "mapping table directly (no --end-bonus, see scripts/mappy_align.py)")
+    p.add_argument("--bam",            action="store_true",
+                   help="With --aligner mappy, also write the BAM (always written by minimap2)")
+    p.add_argument("--intern_ids",     action="store_true",
+                   help="Carry oligo IDs as integer codes (scripts/oligo_ids.py) through the per-read "
+                        ".mapped and sort intermediates; ct_seq writes the names back into the .ct file")
+    p.add_argument("--profile",        nargs="?", const="cprofile", default=os.environ.get("MPRA_PROFILE"),
+                   metavar="cprofile|sample[:MS]",
+                   help="Profile every helper step (default $MPRA_PROFILE); profiles are written "
+                        "next to the metrics stream, see scripts/mpra_metrics.py")
     args = p.parse_args()
 
+    if args.preview:
+        args.out_dir = os.path.join(args.out_dir, "preview")
+        args.id_out = f"{args.id_out}.preview"
+
     #  ─── prepare output ───────────────────────────────────────────────────────
-    os.makedirs(args.out_dir, exist_ok=True)
-    os.chdir(args.out_dir)
-
-    # 1) FLASH
-    prefix = f"{args.id_out}.merged"
-    run(f"flash2 -r {args.read_len} -f {args.frag_len} -s 25 -o {prefix} -t {args.threads} {args.read_a} {args.read_b}")
-    flash_out = f"{prefix}.extendedFrags.fastq"
-
-    # 2) Pull barcodes
-    run(
-        f"python3 {args.scripts_dir}/pull_barcodes.py "
-        f"{flash_out} {args.barcode_orientation} {args.id_out}.merged "
-        f"{args.barcode_link} {args.oligo_link} {args.end_oligo_link} "
-        f"{args.seq_min} {args.enh_min} {args.enh_max} "
-        f"{args.bc_len} {args.bc_link_size} {args.end_link_size}"
-    )
-    match_f = f"{args.id_out}.merged.match"
-    reject_f= f"{args.id_out}.merged.reject"
-
-    # 3) Rearrange → FASTA + gzip
-    fa = f"{args.id_out}.merged.match.enh.fa"
-    run(f"awk '{{print \">\"$1\"#\"$3\"\\n\"$4}}' {match_f} > {fa}")
-    run(f"gzip {fa}")
-    gz_fa = fa + ".gz"
-
-    # 4) Minimap2 + samtools
-    sam = f"{args.id_out}.merged.match.enh.sam"
-    log = f"{args.id_out}.merged.match.enh.log"
-    bam = f"{args.id_out}.merged.match.enh.bam"
-    run(
-        f"minimap2 --for-only -Y --secondary=no -m 10 -n 1 "
-        f"-t {args.threads} --end-bonus 12 -O 5 -E 1 -k 10 -2K50m --eqx --cs=short "
-        f"-c -a {args.reference_fasta} {gz_fa} > {sam} 2> {log}"
-    )
-    run(f"samtools view -S -b {sam} > {bam}")
-
-    # 5) SAM2MPRA
-    mapped = f"{args.id_out}.merged.match.enh.mapped"
-    run(
-        f"python3 {args.scripts_dir}/sam2mpra_cs.py -C {sam} -O {args.oligo_alnmismatchrate_cutoff} {mapped}"
-    )
-
-    # 6) Sort
-    sorted_f = f"{mapped}.barcode.sort"
-    run(f"sort -S{args.mem}G -k2 {mapped} > {sorted_f}")
-
-    # 7) Ct_Seq
-    ct          = f"{args.id_out}.merged.match.enh.mapped.barcode.ct"
-    run(f"python3 {args.scripts_dir}/ct_seq.py {sorted_f} 2 4 > {ct}")
-
-    # 8) Parse / Parse_sat_mut + histogram
-    parsed     = f"{args.id_out}.merged.match.enh.mapped.barcode.ct.parsed"
-    hist       = f"{args.id_out}.merged.match.enh.mapped.barcode.ct.plothist"
-    if args.attributes:
-        run(f"python3 {args.scripts_dir}/parse_map.py -S -A {args.attributes} {ct} > {parsed}")
-    else:
-        run(f"python3 {args.scripts_dir}/parse_map.py {ct} > {parsed}")
-    run(
-        f"awk '($5==0)' {ct} "
-        f"| awk '{{ct[$2]++;cov[$2]+=$4}} END {{for(i in ct) print i\"\\t\"ct[i]\"\\t\"cov[i]}}' > {hist}"
-    )
-
-    # 9) Preseq
-    hist_in  = f"{args.id_out}.merged.match.enh.mapped.barcode.ct.hist"
-    hist_out = f"{args.id_out}.merged.match.enh.mapped.barcode.ct.hist.preseq"
-    run(f"awk '{{ct[$4]++}} END {{for(i in ct) print i\"\\t\"ct[i]}}' {ct} | sort -k1n > {hist_in}")
-    run(f"preseq lc_extrap -H {hist_in} -o {hist_out} -s 25000000 -n 1000 -e 1000000000")
-
-    # 10) QC plots
-    run(
-        f"python3 {args.scripts_dir}/mapping_qc_plots.py "
-        f"{parsed} {hist} {hist_out} {hist_in} {args.reference_fasta} {args.id_out}"
-    )
-
-    # 11) relocate everything into out_dir
-    to_move = [
-        flash_out, match_f, reject_f, gz_fa,
-        sam, log, bam,
-        mapped, sorted_f, ct,
-        parsed, hist, hist_in, hist_out,
-        f"{args.id_out}_barcode_qc.pdf"
-    ]
-    for fn in to_move:
-        run(f"mv {fn} {args.out_dir}/")
+    sys.path.insert(0, os.path.abspath(args.scripts_dir))
+    from inprocess import call, capture_streams
+    capture_streams()
+    from scratch import Workspace
+    ws = Workspace(args.out_dir, args.scratch, args.id_out)
+    metrics_f = os.path.abspath(args.metrics or os.path.join(args.out_dir, f"{args.id_out}.metrics.jsonl"))
+    os.environ["MPRA_METRICS"] = metrics_f
+    from mpra_metrics import start_run
+    start_run()
+    if args.profile:
+        os.environ["MPRA_PROFILE"] = args.profile
+    for arg in ("read_a", "read_b", "reference_fasta", "attributes", "scripts_dir"):
+        if getattr(args, arg):
+            setattr(args, arg, os.path.abspath(getattr(args, arg)))
+    os.chdir(ws.dir)
+    try:
+
+        # 0) Preview: subsample read pairs, everything downstream runs on the sample
+        if args.preview:
+            sub_a = os.path.abspath(f"{args.id_out}_r1.fastq")
+            sub_b = os.path.abspath(f"{args.id_out}_r2.fastq")
+            call("subsample_fastq", "--method", args.preview_method, args.preview,
+                 f"{args.read_a},{args.read_b}", f"{sub_a},{sub_b}")
+            args.read_a, args.read_b = sub_a, sub_b
+            os.environ["MPRA_PREVIEW"] = f"PREVIEW: subsample of {args.preview} read pairs, counts not scaled to the full run"
+
+        # Steps 1-10 form a dependency graph: each one starts as soon as its inputs
+        # exist and its threads fit in --threads, so e.g. indexing overlaps FLASH,
+        # samtools overlaps sam2mpra_cs and the preseq steps overlap parse_map.
+        prefix   = f"{args.id_out}.merged"
+        flash_out= f"{prefix}.extendedFrags.fastq"
+        match_f  = f"{args.id_out}.merged.match"
+        reject_f = f"{args.id_out}.merged.reject"
+        fa       = f"{args.id_out}.merged.match.enh.fa"
+        gz_fa    = fa + ".gz"
+        sam      = f"{args.id_out}.merged.match.enh.sam"
+        log      = f"{args.id_out}.merged.match.enh.log"
+        bam      = f"{args.id_out}.merged.match.enh.bam"
+        mapped   = f"{args.id_out}.merged.match.enh.mapped"
+        sorted_f = f"{mapped}.barcode.sort"
+        ct       = f"{args.id_out}.merged.match.enh.mapped.barcode.ct"
+        parsed   = f"{args.id_out}.merged.match.enh.mapped.barcode.ct.parsed"
+        hist     = f"{args.id_out}.merged.match.enh.mapped.barcode.ct.plothist"
+        hist_in  = f"{args.id_out}.merged.match.enh.mapped.barcode.ct.hist"
+        hist_out = f"{args.id_out}.merged.match.enh.mapped.barcode.ct.hist.preseq"
+        ids_f    = f"{args.id_out}.oligo.ids"
+        ids_arg  = ["--ids", ids_f] if args.intern_ids else []
+        index_opts = "-k 10"
+        target = {"path": args.reference_fasta}
+        # indexing the oligo reference needs far fewer threads than FLASH; split
+        # the budget so the two can run side by side (with a cached index the
+        # index step finishes at once and FLASH is only short of these threads)
+        index_threads = max(1, args.threads // 4) if args.index_cache.lower() != "none" else 0
+        flash_threads = max(1, args.threads - index_threads)
+        steps = []
+
+        # 1) FLASH
+        steps.append(Step("flash", lambda: run(
+            f"flash2 -r {args.read_len} -f {args.frag_len} -s 25 -o {prefix} -t {flash_threads} {args.read_a} {args.read_b}"),
+            threads=flash_threads, frees=[args.read_a, args.read_b] if args.preview else []))
+
+        # 2) Pull barcodes
+        steps.append(Step("pull_barcodes", lambda: call(
+            "pull_barcodes", flash_out, args.barcode_orientation, f"{args.id_out}.merged",
+            args.barcode_link, args.oligo_link, args.end_oligo_link,
+            args.seq_min, args.enh_min, args.enh_max,
+            args.bc_len, args.bc_link_size, args.end_link_size,
+            "--link_edits", args.link_edits, "--oligo_link_edits", args.oligo_link_edits,
+        ), deps=["flash"], frees=[flash_out, f"{prefix}.notCombined_1.fastq", f"{prefix}.notCombined_2.fastq",
+                                   f"{prefix}.hist", f"{prefix}.histogram"]))
+
+        # 3) Rearrange → FASTA
+        steps.append(Step("fasta", lambda: run(f"awk '{{print \">\"$1\"#\"$3\"\\n\"$4}}' {match_f} > {fa}"),
+                          deps=["pull_barcodes"], frees=[match_f]))
+
+        # 3b) Oligo ID codes of the reference, for the per-read intermediates
+        if args.intern_ids:
+            steps.append(Step("ids", lambda: call("oligo_ids", args.reference_fasta, ids_f)))
+
+        # 4) Minimap2 (against the cached index of the reference, built while FLASH runs)
+        if args.index_cache.lower() != "none":
+            def index():
+                from mm2_index import cached_index
+                target["path"] = cached_index(args.reference_fasta, args.index_cache, index_opts, index_threads)
+            steps.append(Step("index", index, threads=index_threads))
+        if args.aligner == "mappy":
+            # 4+5) in-process alignment straight to the mapping table, no SAM
+            steps.append(Step("align", lambda: call(
+                "mappy_align", "-C", "-O", args.oligo_alnmismatchrate_cutoff, "--threads", args.threads,
+                *(["--bam", bam] if args.bam else []), *ids_arg, target["path"], fa, mapped, stderr=log),
+                deps=["fasta", "index", "ids"], threads=args.threads, frees=[fa]))
+            mapping = "align"
+        else:
+            steps.append(Step("gzip", lambda: run(f"gzip {fa}"), deps=["fasta"]))
+            steps.append(Step("align", lambda: run(
+                f"minimap2 --for-only -Y --secondary=no -m 10 -n 1 "
+                f"-t {args.threads} --end-bonus 12 -O 5 -E 1 {index_opts} -2K50m --eqx --cs=short "
+                f"-c -a {target['path']} {gz_fa} > {sam} 2> {log}"),
+                deps=["gzip", "index"], threads=args.threads, frees=[gz_fa]))
+            steps.append(Step("bam", lambda: run(f"samtools view -S -b {sam} > {bam}"), deps=["align"], frees=[sam]))
+
+            # 5) SAM2MPRA
+            steps.append(Step("sam2mpra", lambda: call("sam2mpra_cs", "-C", *ids_arg, sam, "-O", args.oligo_alnmismatchrate_cutoff, mapped),
+                              deps=["align", "ids"], frees=[sam]))
+            mapping = "sam2mpra"
+
+        # 6) Sort
+        steps.append(Step("sort", lambda: run(f"sort -S{args.mem}G -k2 {mapped} > {sorted_f}"),
+                          deps=[mapping], frees=[mapped]))
+
+        # 7) Ct_Seq
+        steps.append(Step("ct_seq", lambda: call("ct_seq", *ids_arg, sorted_f, 2, 4, stdout=ct),
+                          deps=["sort"], frees=[sorted_f, ids_f] if args.intern_ids else [sorted_f]))
+
+        # 8) Parse / Parse_sat_mut + histogram
+        if args.attributes:
+            steps.append(Step("parse_map", lambda: call("parse_map", "-S", "-A", args.attributes, ct, stdout=parsed),
+                              deps=["ct_seq"]))
+        else:
+            steps.append(Step("parse_map", lambda: call("parse_map", ct, stdout=parsed), deps=["ct_seq"]))
+        steps.append(Step("plothist", lambda: run(
+            f"awk '($5==0)' {ct} "
+            f"| awk '{{ct[$2]++;cov[$2]+=$4}} END {{for(i in ct) print i\"\\t\"ct[i]\"\\t\"cov[i]}}' > {hist}"),
+            deps=["ct_seq"]))
+
+        # 9) Preseq
+        steps.append(Step("preseq_hist", lambda: run(
+            f"awk '{{ct[$4]++}} END {{for(i in ct) print i\"\\t\"ct[i]}}' {ct} | sort -k1n > {hist_in}"),
+            deps=["ct_seq"]))
+        steps.append(Step("preseq", lambda: run(
+            f"preseq lc_extrap -H {hist_in} -o {hist_out} -s 25000000 -n 1000 -e 1000000000"),
+            deps=["preseq_hist"]))
+
+        # 10) QC plots
+        steps.append(Step("qc_plots", lambda: call(
+            "mapping_qc_plots", parsed, hist, hist_out, hist_in, args.reference_fasta, args.id_out,
+            "--metrics", metrics_f), deps=["parse_map", "plothist", "preseq"]))
+
+        execute(steps, args.threads, ws)
+
+        # 11) with --scratch, copy the final files back to out_dir (otherwise they are already there)
+        ws.finish(
+            keep=[log, parsed, hist, hist_in, hist_out, f"{args.id_out}_barcode_qc.pdf"]
+                 + ([bam] if os.path.exists(bam) else []),
+            compress=[ct] + [f for f in (reject_f, reject_f + ".sample") if os.path.exists(f)],
+        )
+
+        call("mpra_metrics", "summary", metrics_f)
+    finally:
+        # no-op after ws.finish(); removes the scratch workspace of a failed run
+        ws.close()
 
 if __name__ == "__main__":
     main()
@@ -46,6 +46,22 @@ for f in "$READ1" "$READ2" "$REF" "$SRC_DIR/01_MPRA_match/match.py"; do
   fi
 done
 
+# alignment backend
+ALIGNER_ARG="--aligner ${MATCH_ALIGNER:-minimap2}"
+if [ "${MATCH_BAM:-0}" = "1" ]; then
+  ALIGNER_ARG="$ALIGNER_ARG --bam"
+fi
+if [ "${MATCH_INTERN_IDS:-0}" = "1" ]; then
+  ALIGNER_ARG="$ALIGNER_ARG --intern_ids"
+fi
+
+# run in node-local scratch when configured
+if [ -n "${SCRATCH_DIR:-}" ]; then
+  SCRATCH_ARG="--scratch $SCRATCH_DIR"
+else
+  SCRATCH_ARG=""
+fi
+
 mkdir -p "$OUTDIR"
 
 python3 "$SRC_DIR/01_MPRA_match/match.py" \
@@ -56,6 +72,8 @@ python3 "$SRC_DIR/01_MPRA_match/match.py" \
   $OLISMATCH_ARG \
   --scripts_dir      "$SCRIPTS_DIR" \
   --out_dir          "$OUTDIR" \
-  --id_out           "$ID_OUT"
+  --id_out           "$ID_OUT" \
+  $ALIGNER_ARG \
+  $SCRATCH_ARG
 
 echo "MPRAmatch complete; results in $OUTDIR/"
\ No newline at end of file
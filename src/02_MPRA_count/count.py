@@ -1,9 +1,33 @@
 #!/usr/bin/env python3
-import argparse, subprocess, os, sys
+import argparse, multiprocessing, os, sys
+from concurrent.futures import ProcessPoolExecutor
 
-def run(cmd, stdout=None):
-    print(f">> {cmd}", file=sys.stderr)
-    subprocess.run(cmd, shell=True, check=True, stdout=stdout)
+# parsed mapping for count_replicate: the file path, or the loaded dict shared
+# with forked workers when replicates are counted in parallel; LIBRARY is the
+# barcode set built from it for --whitelist / --rescue
+PARSED = None
+LIBRARY = None
+WHITELIST = RESCUE = False
+
+def granted_cores():
+    """Cores granted to this job: $NSLOTS under SGE, else the CPUs this process may run on."""
+    slots = os.environ.get("NSLOTS", "")
+    if slots.isdigit() and int(slots) > 0:
+        return int(slots)
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def count_replicate(fastq, out_id, orientation, bc_len):
+    """make_counts + associate_tags for one replicate → <out_id>.match, <out_id>.tag"""
+    from make_counts import make_counts
+    from associate_tags import associate_tags
+    from mpra_metrics import profile
+    print(f">> make_counts + associate_tags {fastq} -> {out_id}.tag", file=sys.stderr)
+    with profile("count_replicate", out_id):
+        barcodes = make_counts(fastq, out_id, orientation, bc_len,
+                               LIBRARY if WHITELIST else None, RESCUE)
+        associate_tags(barcodes, PARSED, f"{out_id}.tag", LIBRARY if RESCUE else None)
 
 def main():
     p = argparse.ArgumentParser(description="MPRA replicate‐counting pipeline")
@@ -19,6 +43,20 @@ def main():
                    help="2 if match used read_a=R1, else 1")
     p.add_argument("--bc_len",           type=int, default=20,
                    help="Barcode length")
+    p.add_argument("--whitelist",        action="store_true",
+                   help="Drop barcodes that are not in the --parsed map while reading the FASTQs "
+                        "(counted as not_in_library rejects)")
+    p.add_argument("--rescue",           action="store_true",
+                   help="Count barcodes one mismatch away from exactly one barcode of the --parsed "
+                        "map under that barcode (rescued reads are reported per replicate)")
+    p.add_argument("--store",            action="store_true",
+                   help="Build <id_out>.db, an indexed SQLite store of the count table and the "
+                        "--parsed map for scripts/mpra_store.py query")
+    p.add_argument("--projects",         default=None,
+                   help="tile_proj_map.tsv (ID, project) to add project lookups to --store")
+    p.add_argument("--qc_pdf",           action="store_true",
+                   help="Write the count QC plots as pages of one <id_out>_count_QC.pdf "
+                        "instead of one PDF per plot")
     p.add_argument("--flags",            default="-ECSM -A 0.05",
                    help="Flags for compile_bc_cs")
     p.add_argument("--scripts_dir",      required=True,
@@ -27,135 +65,233 @@ def main():
                    help="Directory to write outputs")
     p.add_argument("--id_out",           required=True,
                    help="Project identifier prefix")
+    p.add_argument("--incremental",      action="store_true",
+                   help="Only process the given FASTQs and merge them into the existing "
+                        "<id_out>.count (top-up of an existing replicate or a new replicate)")
+    p.add_argument("--preview",          default=None, metavar="FRACTION|N",
+                   help="Quick preview on a subsample of each replicate: a fraction (0-1) "
+                        "or a number of reads. Results go to <out_dir>/preview/")
+    p.add_argument("--preview_method",   choices=["head", "reservoir"], default="head",
+                   help="How to pick N reads for --preview: the first N (default) "
+                        "or a reservoir sample, which reads the whole FASTQ")
+    p.add_argument("--metrics",          default=None,
+                   help="Metrics JSONL stream shared by all helper scripts "
+                        "(default: <out_dir>/<id_out>.metrics.jsonl)")
+    p.add_argument("--phase",            choices=["all", "replicates", "gather"], default="all",
+                   help="'replicates': only make_counts + associate_tags for the given replicates; "
+                        "'gather': only build the count table from existing <sid>.tag files "
+                        "(lets an executor run replicates as separate tasks)")
+    p.add_argument("--scratch",          nargs="?", const=os.environ.get("TMPDIR", "/tmp"), default=None,
+                   metavar="DIR",
+                   help="Run in node-local scratch (default $TMPDIR), delete intermediates as soon as "
+                        "they are consumed and copy only the final files to out_dir")
+    p.add_argument("--workers",          type=int, default=1,
+                   help="Forked worker processes: replicates counted concurrently, barcode shards "
+                        "compiled in parallel by compile_bc_cs and QC plots rendered by count_qc "
+                        "(default 1; 0 = one per granted core, $NSLOTS under SGE)")
+    p.add_argument("--profile",          nargs="?", const="cprofile", default=os.environ.get("MPRA_PROFILE"),
+                   metavar="cprofile|sample[:MS]",
+                   help="Profile every helper step (default $MPRA_PROFILE); profiles are written "
+                        "next to the metrics stream, see scripts/mpra_metrics.py")
     args = p.parse_args()
+    if not args.workers:
+        args.workers = granted_cores()
+    if args.phase != "all" and args.incremental:
+        raise ValueError("--phase and --incremental cannot be combined")
 
-    # prepare workspace
-    os.makedirs(args.out_dir, exist_ok=True)
-    os.chdir(args.out_dir)
+    if args.preview:
+        if args.incremental:
+            raise ValueError("--preview and --incremental cannot be combined")
+        args.out_dir = os.path.join(args.out_dir, "preview")
+        args.id_out = f"{args.id_out}.preview"
 
-    fastqs = args.replicate_fastq.split(",")
-    ids    = args.replicate_id.split(",")
-    if len(fastqs) != len(ids):
-        raise ValueError(f"replicate_fastq and replicate_id must have same length (got {len(fastqs)} fastqs, {len(ids)} ids)")
+    # prepare workspace
+    sys.path.insert(0, args.scripts_dir)
+    from inprocess import call
+    from scratch import Workspace
+    ws = Workspace(args.out_dir, args.scratch, args.id_out)
+    args.out_dir = ws.out_dir
+    metrics_f = os.path.abspath(args.metrics or os.path.join(args.out_dir, f"{args.id_out}.metrics.jsonl"))
+    os.environ["MPRA_METRICS"] = metrics_f
+    from mpra_metrics import start_run
+    start_run()
+    if args.profile:
+        os.environ["MPRA_PROFILE"] = args.profile
+    args.parsed, args.acc_id = os.path.abspath(args.parsed), os.path.abspath(args.acc_id)
+    if args.projects:
+        args.projects = os.path.abspath(args.projects)
+    args.scripts_dir = os.path.abspath(args.scripts_dir)
+    args.replicate_fastq = ",".join(os.path.abspath(fq) for fq in args.replicate_fastq.split(","))
+    os.chdir(ws.dir)
+    try:
 
-    tag_files = []
-    tag_ids   = []
+        fastqs = args.replicate_fastq.split(",")
+        ids    = args.replicate_id.split(",")
+        if len(fastqs) != len(ids):
+            raise ValueError(f"replicate_fastq and replicate_id must have same length (got {len(fastqs)} fastqs, {len(ids)} ids)")
 
-    # ── scatter: prep_counts & associate ──────────────────────────────────────
+        tag_files = []
+        tag_ids   = []
 
-    for fq, sid in zip(fastqs, ids):
-        # 1) prep_counts → {sid}.match
-        
-        run(
-            f"python3 {args.scripts_dir}/make_counts.py "
-            f"{fq} {sid} {args.barcode_orientation} {args.bc_len}"
-        )
-        match_f = f"{sid}.match"
+        # ── preview: subsample each replicate, everything downstream runs on it ──
+        if args.preview and args.phase != "gather":
+            sub_fastqs = []
+            for fq, sid in zip(fastqs, ids):
+                sub = os.path.abspath(f"{sid}.preview.fastq")
+                call("subsample_fastq", "--method", args.preview_method, args.preview, fq, sub)
+                sub_fastqs.append(sub)
+            fastqs = sub_fastqs
+        if args.preview:
+            os.environ["MPRA_PREVIEW"] = f"PREVIEW: subsample of {args.preview} reads per replicate, counts not scaled to the full run"
 
+        # ── scatter: prep_counts & associate ──────────────────────────────────────
 
-        # 2) associate → {sid}.tag
+        count_f = f"{args.id_out}.count"
+        samples_txt = f"{args.id_out}_samples.txt"
+        if args.incremental:
+            # with --scratch, bring the table being updated into the workspace:
+            # files update_count replaces whole are linked, files appended to are copied
+            for name in [count_f] + [f"{sid}.tag" for sid in ids]:
+                if os.path.exists(os.path.join(args.out_dir, name)):
+                    ws.link_in(name)
+            for name in (samples_txt, f"{count_f}.update.log"):
+                ws.copy_in(name)
+        if args.incremental and not os.path.exists(count_f):
+            raise FileNotFoundError(
+                f"--incremental needs an existing count table {count_f} in {args.out_dir}"
+            )
+        # incremental runs keep the new reads apart until they are merged
+        suffix = ".topup" if args.incremental else ""
 
-        run(
-            f"python3 {args.scripts_dir}/associate_tags.py "
-            f"{match_f} {args.parsed} {sid}.tag {args.barcode_orientation}"
-        )
-        tag_files.append(f"{sid}.tag")
-        tag_ids.append(sid)
+        jobs = [(fq, f"{sid}{suffix}") for fq, sid in zip(fastqs, ids)]
+        if args.phase == "gather":
+            for sid in ids:
+                ws.link_in(f"{sid}.tag")
+        else:
+            # 1) make_counts → {sid}.match, 2) associate → {sid}.tag
+            global PARSED, LIBRARY, WHITELIST, RESCUE
+            PARSED = args.parsed
+            workers = min(args.workers, len(jobs))
+            if workers > 1:
+                # replicates counted in parallel: parse the mapping once and share
+                # it with the forked workers instead of once per worker (one after
+                # the other, each replicate streams only its own tags from the file)
+                from associate_tags import load_parsed
+                print(f">> load {args.parsed}", file=sys.stderr)
+                PARSED = load_parsed(args.parsed)
+            WHITELIST, RESCUE = args.whitelist, args.rescue
+            if args.whitelist or args.rescue:
+                from barcode_whitelist import BarcodeWhitelist
+                print(f">> whitelist {args.parsed}", file=sys.stderr)
+                LIBRARY = (BarcodeWhitelist.from_barcodes(PARSED) if isinstance(PARSED, dict)
+                           else BarcodeWhitelist.from_parsed(args.parsed))
+            if workers > 1:
+                with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("fork")) as pool:
+                    futures = [pool.submit(count_replicate, fq, out_id, args.barcode_orientation, args.bc_len)
+                               for fq, out_id in jobs]
+                    for fut in futures:
+                        fut.result()
+            else:
+                for fq, out_id in jobs:
+                    count_replicate(fq, out_id, args.barcode_orientation, args.bc_len)
+            PARSED = LIBRARY = None
+        for (fq, out_id), sid in zip(jobs, ids):
+            tag_files.append(f"{out_id}.tag")
+            tag_ids.append(sid)
+            if args.phase != "gather":
+                ws.release(f"{out_id}.match", f"{out_id}.reject.bc", f"{out_id}.reject.bc.sample")
+                if args.preview:
+                    ws.release(fq)
 
+        if args.phase == "replicates":
+            ws.finish(keep=tag_files)
+            return
 
-        
-    # ── make_infile ──────────────────────────────────────────────────────────
+        # ── make_infile ──────────────────────────────────────────────────────────
 
-    run(
-        f"python3 {args.scripts_dir}/make_infile.py "
-        f"{','.join(tag_ids)} {','.join(tag_files)} {args.id_out}"
-    )
+        call("make_infile", ",".join(tag_ids), ",".join(tag_files), f"{args.id_out}{suffix}")
 
-    
-    samples_txt = f"{args.id_out}_samples.txt"
 
-    # Check existence of samples file
-    if not os.path.exists(samples_txt):
-        raise FileNotFoundError(
-            f"Expected samples file {samples_txt} not found. Please regenerate or uncomment the make_infile step."
-        )
+        if args.incremental:
+            # ── merge new tags into the existing count table ─────────────────────
+            call("update_count", *args.flags.split(), "-O", args.id_out,
+                 f"{args.id_out}{suffix}_samples.txt", count_f)
+            known = set()
+            if os.path.exists(samples_txt):
+                with open(samples_txt) as fh:
+                    known = {line.split()[0] for line in fh if line.strip()}
+            with open(samples_txt, "a") as fh:
+                for sid in ids:
+                    if sid not in known:
+                        fh.write(f"{sid}\t{sid}.tag\n")
+            for sid in ids:
+                for fn in (f"{sid}{suffix}.match", f"{sid}{suffix}.tag",
+                           f"{sid}{suffix}.reject.bc", f"{sid}{suffix}.reject.bc.sample"):
+                    if os.path.exists(fn):
+                        os.remove(fn)
+            os.remove(f"{args.id_out}{suffix}_samples.txt")
 
-    # Check all tag files exist
-    for sid in ids:
-        tag_file = f"{sid}.tag"
-        if not os.path.exists(tag_file):
+        # Check existence of samples file
+        if not os.path.exists(samples_txt):
             raise FileNotFoundError(
-                f"Expected tag file {tag_file} not found. Please regenerate or uncomment associate_tags step."
+                f"Expected samples file {samples_txt} not found. Please regenerate or uncomment the make_infile step."
             )
 
-    # ── make_count_table ─────────────────────────────────────────────────────
-    count_f = f"{args.id_out}.count"
-    stats_f = f"{args.id_out}.stats"
-
-
-    # compile barcodes + cs into count file
-    flag_list = args.flags.strip().split()
-    compile_cmd = (
-        f"python3 {args.scripts_dir}/compile_bc_cs.py "
-        + " ".join(flag_list)
-        + f" {samples_txt} {count_f}"
-    )
-    run(compile_cmd)
-
-    # AWK step to create stats file with header
-    awk_cmd = (
-        "awk 'BEGIN { print \"Sample\\tKey\\tCount\\tSum\" } "
-        "/Summary for sample=/ {"
-        " match($0, /sample=([^,]+)/, a);"
-        " match($0, /key=([^:]+)/, b);"
-        " match($0, /count=([0-9]+)/, c);"
-        " match($0, /sum=([0-9]+)/, d);"
-        " if (a[1] != \"\" && b[1] != \"\" && c[1] != \"\" && d[1] != \"\") {"
-        " printf \"%s\\t%s\\t%s\\t%s\\n\", a[1], b[1], c[1], d[1];"
-        " }"
-        " }' "
-        + count_f + ".log > " + stats_f
-    )
-    run(awk_cmd)
-
-
-
-    # 4) read_stats.py (replaces Rscript read_stats.R)
-    run(
-        f"python3 {args.scripts_dir}/read_stats.py "
-        f"{stats_f} {args.acc_id} {args.id_out} {args.out_dir}"
-    )
-
-    # 5) count_QC → {id_out}_condition.txt
-    cond_f = f"{args.id_out}_condition.txt"
-    run(
-        f"python3 {args.scripts_dir}/count_qc.py "
-        f"{args.acc_id} {count_f} {args.id_out} {args.out_dir}"
-    )
-
-    # 6) countRaw → cell‐type specific counts
-    run(
-        f"python3 {args.scripts_dir}/bc_raw.py "
-        f"{cond_f} {count_f} {args.id_out} {args.out_dir}"
-    )
-
-    # 7) relocate all artifacts
-    to_move = []
-    # prep_counts outputs
-    for sid in ids:
-        to_move.append(f"{sid}.match")
-    # associate outputs
-    for sid in ids:
-        to_move.append(f"{sid}.tag")
-    # count      
-    to_move += [count_f, stats_f, cond_f]
-    for fn in to_move:
-        src = os.path.abspath(fn)
-        dst = os.path.abspath(os.path.join(args.out_dir, os.path.basename(fn)))
-        if src != dst:
-            run(f"mv {fn} {args.out_dir}/")
-        else:
-            print(f"Skipping move for {fn}, already in {args.out_dir}/", file=sys.stderr)
+        # Check all tag files exist
+        for sid in ids:
+            tag_file = f"{sid}.tag"
+            if not os.path.exists(tag_file):
+                raise FileNotFoundError(
+                    f"Expected tag file {tag_file} not found. Please regenerate or uncomment associate_tags step."
+                )
+
+        # ── make_count_table ─────────────────────────────────────────────────────
+        stats_f = f"{args.id_out}.stats"
+
+
+        # compile barcodes + cs into count file
+        if not args.incremental:
+            call("compile_bc_cs", *args.flags.split(), "-O", args.id_out,
+                 "-P", args.workers, samples_txt, count_f)
+
+        # per-sample barcode/read totals come from compile_bc_cs metrics records
+        call("mpra_metrics", "stats", metrics_f, stdout=stats_f)
+
+
+
+        # per-replicate barcode rarefaction (saturation) curves
+        rare_f = os.path.join(args.out_dir, f"{args.id_out}_rarefaction.tsv")
+        call("rarefaction", count_f, args.id_out, args.out_dir)
+
+        # 4) read_stats.py (replaces Rscript read_stats.R)
+        call("read_stats", metrics_f, args.acc_id, args.id_out, args.out_dir, "--rarefaction", rare_f)
+
+        # 5) count_QC → {id_out}_condition.txt
+        cond_f = os.path.join(args.out_dir, f"{args.id_out}_condition.txt")
+        call("count_qc", args.acc_id, count_f, args.id_out, args.out_dir,
+             f"{args.id_out}.oligo_counts", f"{args.id_out}.oligo_barcodes",
+             "--workers", args.workers,
+             *(["--pdf", os.path.join(args.out_dir, f"{args.id_out}_count_QC.pdf")] if args.qc_pdf else []))
+
+        # 6) countRaw → cell‐type specific counts
+        call("bc_raw", cond_f, count_f, args.id_out, args.out_dir)
+
+        # 7) indexed store of the count table and mapping for point lookups
+        store_f = f"{args.id_out}.db"
+        if args.store:
+            call("mpra_store", "build", "--count", count_f, "--parsed", args.parsed,
+                 *(["--projects", args.projects] if args.projects else []), store_f)
+
+        # 8) with --scratch, copy the final files back to out_dir (otherwise they are already there)
+        log_f = f"{count_f}.update.log" if args.incremental else f"{count_f}.log"
+        ws.finish(keep=[f"{sid}.tag" for sid in ids] + [count_f, stats_f, samples_txt, log_f,
+                                    f"{args.id_out}.oligo_counts", f"{args.id_out}.oligo_barcodes"]
+                       + ([store_f] if args.store else []))
+
+        call("mpra_metrics", "summary", metrics_f)
+    finally:
+        # no-op after ws.finish(); removes the scratch workspace of a failed run
+        ws.close()
 
 if __name__ == "__main__":
     main()
@@ -3,7 +3,9 @@ set -euo pipefail
 
 # -----------------------------------------------------------------------------
 # USAGE:
-#   ./run_model.sh
+#   ./run_count.sh                      # whole count stage
+#   ./run_count.sh replicate <rep_id>   # make_counts + associate_tags for one replicate
+#   ./run_count.sh gather               # count table and QC from existing .tag files
 # -----------------------------------------------------------------------------
 
 # load project-wide settings
@@ -30,9 +32,55 @@ for f in "$ACC_FILE" "$PARSED" "$SRC_DIR/02_MPRA_count/count.py"; do
   fi
 done
 
-# Build comma-separated lists of FASTQs with full path & replicate IDs from acc_id
-FASTQS=$(awk -v dir="$RAW_DIR" '{print dir "/" $1}' "$ACC_FILE" | paste -sd, -)
-IDS=$(awk '{print $2}' "$ACC_FILE" | paste -sd, -)
+PHASE="${1:-all}"
+if [ "$PHASE" = "replicate" ]; then
+  REP="${2:?usage: run_count.sh replicate <rep_id>}"
+  FASTQS=$(awk -v dir="$RAW_DIR" -v rep="$REP" '$2==rep {print dir "/" $1}' "$ACC_FILE" | paste -sd, -)
+  IDS="$REP"
+  PHASE="replicates"
+  if [ -z "$FASTQS" ]; then
+    echo "ERROR: replicate $REP not found in $ACC_FILE" >&2
+    exit 1
+  fi
+else
+  # Build comma-separated lists of FASTQs with full path & replicate IDs from acc_id
+  FASTQS=$(awk -v dir="$RAW_DIR" '{print dir "/" $1}' "$ACC_FILE" | paste -sd, -)
+  IDS=$(awk '{print $2}' "$ACC_FILE" | paste -sd, -)
+fi
+
+# run in node-local scratch when configured
+if [ -n "${SCRATCH_DIR:-}" ]; then
+  SCRATCH_ARG="--scratch $SCRATCH_DIR"
+else
+  SCRATCH_ARG=""
+fi
+
+# keep only library barcodes (those in the .parsed map) when configured
+if [ "${COUNT_WHITELIST:-0}" = "1" ]; then
+  WHITELIST_ARG="--whitelist"
+else
+  WHITELIST_ARG=""
+fi
+if [ "${COUNT_RESCUE:-0}" = "1" ]; then
+  WHITELIST_ARG="$WHITELIST_ARG --rescue"
+fi
+
+# indexed lookup store of the count table and mapping when configured
+if [ "${COUNT_STORE:-0}" = "1" ]; then
+  STORE_ARG="--store"
+  if [ -f "${LIBRARY_DIR}/tile_proj_map.tsv" ]; then
+    STORE_ARG="$STORE_ARG --projects ${LIBRARY_DIR}/tile_proj_map.tsv"
+  fi
+else
+  STORE_ARG=""
+fi
+
+# count QC plots in one multi-page PDF when configured
+if [ "${COUNT_QC_PDF:-0}" = "1" ]; then
+  QC_ARG="--qc_pdf"
+else
+  QC_ARG=""
+fi
 
 mkdir -p "$OUTDIR"
 
@@ -43,6 +91,9 @@ python3 "$SRC_DIR/02_MPRA_count/count.py" \
   --acc_id           "$ACC_FILE" \
   --scripts_dir      "$SCRIPTS_DIR" \
   --out_dir          "$OUTDIR" \
-  --id_out           "$ID_OUT"
+  --id_out           "$ID_OUT" \
+  --phase            "$PHASE" \
+  --workers          "${COUNT_WORKERS:-1}" \
+  $SCRATCH_ARG $WHITELIST_ARG $QC_ARG $STORE_ARG
 
-echo "MPRAcount complete; results in $OUTDIR/"
\ No newline at end of file
+echo "MPRAcount ($PHASE) complete; results in $OUTDIR/"
\ No newline at end of file
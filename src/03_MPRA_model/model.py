@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""
+model.py
+
+Run MPRAmodel as one worker per cell type instead of one R process over every
+cell type. Each shard sees the DNA replicates plus the replicates of a single
+cell type; shards run in a local process pool or as tasks of one SGE array
+job. Their results/ and plots/ are then gathered into <out_dir> under the same
+file names a single run writes, the all-sample tables (normalized counts,
+counts) are merged column-wise, and the correlation plots are drawn once on
+the merged normalized counts.
+
+Sharded results equal separate per-cell-type MPRAmodel fits; they are NOT
+numerically identical to the old joint run over every cell type. Each shard
+estimates its RNA size factors (median-of-ratios against its own
+pseudo-reference, see processAnalysis in model.r), its summit shift and its
+DESeq2 dispersions from DNA plus one cell type only. So p-values differ from
+the joint fit, and the merged _normalized_counts.tsv holds RNA columns
+normalized in different fits, which matters for cross-cell-type comparisons
+in compare.r (sizeFactors = 1).
+"""
+import argparse, subprocess, os, re, shutil, sys
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+SHARD_R = """proj <- "{proj}"
+prefix <- "{prefix}"
+negCtrl <- "{neg_ctrl}"
+posCtrl <- "{pos_ctrl}"
+attr_proj <- read.delim("{attributes}", stringsAsFactors=FALSE)
+count_proj <- read.delim("{counts}", stringsAsFactors=FALSE)
+bc_proj <- NULL
+if (file.exists("{barcodes}")) bc_proj <- read.delim("{barcodes}", stringsAsFactors=FALSE)
+cond_proj <- read.delim("{condition}", stringsAsFactors=FALSE, row.names=1, header=FALSE)
+colnames(cond_proj) <- "condition"
+source("{model_r}")
+proj_out <- MPRAmodel(count_proj, attr_proj, cond_proj, filePrefix=paste0(proj, "_", prefix), negCtrlName=negCtrl, posCtrlName=posCtrl, projectName=proj, prior=FALSE, method='ssn', anchorDNA=TRUE, runAllelic=FALSE, writeBed=FALSE, barcodeData=bc_proj, corPlots=FALSE)
+writeLines(capture.output(sessionInfo()), "sessionInfo.txt")
+"""
+
+GATHER_R = """cond_proj <- read.delim("{condition}", stringsAsFactors=FALSE, row.names=1, header=FALSE)
+colnames(cond_proj) <- "condition"
+source("{model_r}")
+counts_out <- as.matrix(read.delim("{norm_counts}", check.names=FALSE))
+MPRAcorPlots(counts_out, cond_proj, "{file_prefix}")
+"""
+
+SGE_JOB = """#!/bin/bash
+#$ -N {name}
+#$ -cwd
+#$ -t 1-{n}
+#$ -o {log_dir}/{name}.$TASK_ID.out
+#$ -e {log_dir}/{name}.$TASK_ID.err
+{env}
+SHARD=$(sed -n "${{SGE_TASK_ID}}p" {shard_list})
+cd "$SHARD" && {cmd}
+"""
+
+WORKER_CMD = "Rscript custom.r > model.log 2>&1 && touch model.done"
+
+def run(cmd, cwd=None):
+    print(f">> {cmd}", file=sys.stderr)
+    subprocess.run(cmd, shell=True, check=True, cwd=cwd)
+
+def load_conditions(path):
+    """OrderedDict replicate -> celltype, in file order (the column order of every output table)."""
+    cond = OrderedDict()
+    with open(path) as fin:
+        for line in fin:
+            if line.strip():
+                rep, cell = line.rstrip('\n').split('\t')[:2]
+                cond[rep] = cell
+    return cond
+
+def project_columns(in_path, out_path, drop):
+    """Copy a tab-separated table without the columns named in `drop`."""
+    with open(in_path) as fin, open(out_path, 'w') as out:
+        header = fin.readline().rstrip('\n').split('\t')
+        keep = [i for i, c in enumerate(header) if c not in drop]
+        out.write('\t'.join(header[i] for i in keep) + '\n')
+        for line in fin:
+            row = line.rstrip('\n').split('\t')
+            out.write('\t'.join(row[i] for i in keep) + '\n')
+
+def merge_tables(paths, out_path, samples, id_col):
+    """
+    Merge per-shard tables with identical rows side by side. Shared (DNA)
+    columns come from the first shard; columns are written in `samples` order.
+    id_col=False for R write.table output, whose header has no row-name field.
+    """
+    handles = [open(p) for p in paths]
+    try:
+        headers = [h.readline().rstrip('\n').split('\t') for h in handles]
+        offset = 1 if id_col else 0
+        source = {}
+        for s, header in enumerate(headers):
+            for i, col in enumerate(header[offset:]):
+                source.setdefault(col, (s, i + 1))
+        cols = [c for c in samples if c in source]
+        cols += [c for c in source if c not in cols]
+        with open(out_path, 'w') as out:
+            out.write('\t'.join((['ID'] if id_col else []) + cols) + '\n')
+            for n, lines in enumerate(zip(*handles), start=2):
+                rows = [l.rstrip('\n').split('\t') for l in lines]
+                if any(r[0] != rows[0][0] for r in rows):
+                    raise ValueError(f"{out_path}: shards disagree on row {n} ({rows[0][0]})")
+                out.write('\t'.join([rows[0][0]] + [rows[s][i] for s, i in (source[c] for c in cols)]) + '\n')
+    finally:
+        for h in handles:
+            h.close()
+
+def main():
+    p = argparse.ArgumentParser(description="MPRAmodel sharded by cell type")
+    p.add_argument("--counts",       required=True,
+                   help="Count table (<id>.oligo_counts or <id>.count)")
+    p.add_argument("--barcodes",     default="",
+                   help="Optional <id>.oligo_barcodes matrix")
+    p.add_argument("--attributes",   required=True,
+                   help="Attributes table from build_attributes.py")
+    p.add_argument("--condition",    required=True,
+                   help="<id>_condition.txt from the count stage")
+    p.add_argument("--model_r",      required=True,
+                   help="Path to model.r")
+    p.add_argument("--out_dir",      required=True,
+                   help="Directory to write results/ and plots/")
+    p.add_argument("--proj",         required=True,
+                   help="Project name")
+    p.add_argument("--prefix",       required=True,
+                   help="Run suffix; outputs are prefixed <proj>_<prefix>")
+    p.add_argument("--neg_ctrl",     default="negCtrl",
+                   help="Negative control project name")
+    p.add_argument("--pos_ctrl",     default="posCtrl",
+                   help="Positive control project name")
+    p.add_argument("--executor",     choices=["local", "sge"], default="local",
+                   help="Run shards in a local process pool or as one SGE array job")
+    p.add_argument("--workers",      type=int, default=0,
+                   help="Concurrent local shards (default: one per cell type)")
+    p.add_argument("--sge_opts",     default="",
+                   help="Extra qsub options for the array job (project, memory, runtime)")
+    p.add_argument("--keep_shards",  action="store_true",
+                   help="Keep <out_dir>/shards/ after gathering")
+    p.add_argument("--phase",        choices=["all", "split", "shard", "gather"], default="all",
+                   help="Run one phase only, for an external executor: 'split' writes the shards, "
+                        "'shard' runs the --cell shard, 'gather' collects finished shards")
+    p.add_argument("--cell",         default=None,
+                   help="Cell type to run with --phase shard")
+    args = p.parse_args()
+
+    out_dir = os.path.abspath(args.out_dir)
+    shard_root = os.path.join(out_dir, "shards")
+    file_prefix = f"{args.proj}_{args.prefix}"
+    model_r = os.path.abspath(args.model_r)
+
+    cond = load_conditions(args.condition)
+    cells = [c for c in OrderedDict.fromkeys(cond.values()) if c != "DNA"]
+    if not cells:
+        raise ValueError(f"{args.condition}: no RNA cell types")
+
+    shards = OrderedDict((cell, os.path.join(shard_root, cell)) for cell in cells)
+    if args.phase == "shard":
+        if args.cell not in shards:
+            raise ValueError(f"--phase shard needs --cell, one of: {', '.join(cells)}")
+        run(WORKER_CMD, cwd=shards[args.cell])
+        return
+
+    # ── split: per-cell condition file and count tables sharing the DNA columns ──
+    if args.phase in ("all", "split"):
+        for cell, sd in shards.items():
+            os.makedirs(sd, exist_ok=True)
+            if os.path.exists(os.path.join(sd, "model.done")):
+                os.remove(os.path.join(sd, "model.done"))
+            others = {r for r, c in cond.items() if c not in ("DNA", cell)}
+            with open(os.path.join(sd, "condition.txt"), "w") as out:
+                for rep, c in cond.items():
+                    if c in ("DNA", cell):
+                        out.write(f"{rep}\t{c}\n")
+            project_columns(args.counts, os.path.join(sd, "counts.tsv"), others)
+            barcodes = ""
+            if args.barcodes and os.path.exists(args.barcodes):
+                barcodes = os.path.join(sd, "barcodes.tsv")
+                project_columns(args.barcodes, barcodes, others)
+            with open(os.path.join(sd, "custom.r"), "w") as out:
+                out.write(SHARD_R.format(proj=args.proj, prefix=args.prefix,
+                                         neg_ctrl=args.neg_ctrl, pos_ctrl=args.pos_ctrl,
+                                         attributes=os.path.abspath(args.attributes),
+                                         counts=os.path.join(sd, "counts.tsv"), barcodes=barcodes,
+                                         condition=os.path.join(sd, "condition.txt"), model_r=model_r))
+    if args.phase == "split":
+        return
+
+    # ── scatter: one MPRAmodel run per cell type ──────────────────────────────
+    # (with --phase gather the caller has already run them)
+    if args.phase == "all" and args.executor == "sge":
+        shard_list = os.path.join(shard_root, "shards.txt")
+        with open(shard_list, "w") as out:
+            out.write("\n".join(shards.values()) + "\n")
+        env = ""
+        if os.environ.get("CONDA_INIT") and os.environ.get("ENV_NAME"):
+            env = f"source {os.environ['CONDA_INIT']}\nconda activate {os.environ['ENV_NAME']}\n"
+        job_f = os.path.join(shard_root, "model_shards.qsub")
+        with open(job_f, "w") as out:
+            out.write(SGE_JOB.format(name="MPRAmodel_shard", n=len(shards), log_dir=shard_root,
+                                     env=env, shard_list=shard_list, cmd=WORKER_CMD))
+        # -sync y: block until every task of the array has finished
+        run(f"qsub -sync y {args.sge_opts} {job_f}", cwd=shard_root)
+    elif args.phase == "all":
+        def worker(sd):
+            print(f">> [{os.path.basename(sd)}] {WORKER_CMD}", file=sys.stderr)
+            return subprocess.run(WORKER_CMD, shell=True, cwd=sd).returncode
+        with ThreadPoolExecutor(max_workers=args.workers or len(shards)) as pool:
+            list(pool.map(worker, shards.values()))
+
+    failed = [c for c, sd in shards.items() if not os.path.exists(os.path.join(sd, "model.done"))]
+    if failed:
+        logs = ", ".join(os.path.join(shards[c], "model.log") for c in failed)
+        raise RuntimeError(f"MPRAmodel failed for cell type(s) {', '.join(failed)}; see {logs}")
+
+    # ── gather: merge the all-sample tables, move everything else as is ────────
+    merged = {
+        re.compile(rf"^{re.escape(file_prefix)}_\d{{8}}_normalized_counts\.out$"): False,
+        re.compile(rf"^{re.escape(file_prefix)}_\d{{8}}_counts\.out$"): False,
+        re.compile(rf"^{re.escape(file_prefix)}_normalized_counts\.tsv$"): True,
+    }
+    for sub in ("results", "plots"):
+        os.makedirs(os.path.join(out_dir, sub), exist_ok=True)
+    norm_counts = None
+    first = next(iter(shards.values()))
+    for fn in sorted(os.listdir(os.path.join(first, "results"))):
+        for pat, id_col in merged.items():
+            if pat.match(fn):
+                dest = os.path.join(out_dir, "results", fn)
+                merge_tables([os.path.join(sd, "results", fn) for sd in shards.values()],
+                             dest, list(cond), id_col)
+                if fn.endswith("_normalized_counts.out"):
+                    norm_counts = dest
+    copied = set()
+    for sd in shards.values():
+        for sub in ("results", "plots"):
+            for fn in sorted(os.listdir(os.path.join(sd, sub))):
+                # the DNA-only plots are identical in every shard; keep the first
+                if (sub, fn) in copied or any(pat.match(fn) for pat in merged):
+                    continue
+                shutil.copy2(os.path.join(sd, sub, fn), os.path.join(out_dir, sub, fn))
+                copied.add((sub, fn))
+    shutil.copy2(os.path.join(first, "sessionInfo.txt"), os.path.join(out_dir, "sessionInfo.txt"))
+
+    # correlation plots span every sample, so they are drawn once on the merged counts
+    if norm_counts:
+        gather_r = os.path.join(out_dir, "gather.r")
+        with open(gather_r, "w") as out:
+            out.write(GATHER_R.format(condition=os.path.abspath(args.condition), model_r=model_r,
+                                      norm_counts=norm_counts, file_prefix=file_prefix))
+        run(f"Rscript {gather_r}", cwd=out_dir)
+
+    if not args.keep_shards:
+        shutil.rmtree(shard_root)
+    print(f"MPRAmodel complete for {len(shards)} cell type(s); results in {out_dir}/", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
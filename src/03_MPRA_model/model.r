@@ -84,15 +84,22 @@ addHaplo <- function(attributesData,negCtrlName="negCtrl", posCtrlName="expCtrl"
 ### Remove Error, CIGAR, MD and position columns if necessary; aggregrate cound data with relation to the oligo
 ## INPUT:
   # countsData      : table of tag counts, columns should include: Barcode, Oligo, Sample names
+  #                   or the pre-aggregated <id>.oligo_counts matrix from MPRAcount (Oligo, Sample names)
 ## OUTPUT:
   # oligo count data with the oligo as row names and the aggregate count data
 oligoIsolate <- function(countsData, file_prefix){
-  if("Error" %in% colnames(countsData)){
-    countsData <- countsData[,c(1,2,7:dim(countsData)[2])]
+  if(!("Barcode" %in% colnames(countsData))){
+    # already collapsed to one row per oligo by the count stage
+    counts_oligo <- countsData[, colnames(countsData) != "Oligo", drop=FALSE]
+    rownames(counts_oligo) <- countsData$Oligo
+  } else {
+    if("Error" %in% colnames(countsData)){
+      countsData <- countsData[,c(1,2,7:dim(countsData)[2])]
+    }
+    tag_counts <- aggregate(. ~Oligo, data=countsData[,-1], FUN = sum)
+    counts_oligo <- tag_counts[,-1]
+    rownames(counts_oligo) <- tag_counts[,1]
   }
-  tag_counts <- aggregate(. ~Oligo, data=countsData[,-1], FUN = sum)
-  counts_oligo <- tag_counts[,-1]
-  rownames(counts_oligo) <- tag_counts[,1]
   write.table(counts_oligo, paste0("results/", file_prefix, "_", fileDate(), "_counts.out"), quote = F, sep="\t")
   return(counts_oligo)
 }
@@ -311,8 +318,13 @@ tagSig <- function(dds_results, dds_rna, cond_data, exclList=c(), prior=F){
 ## OUTPUT: writes duplicate output and ttest files for each celltype
 dataOut <- function(countsData, attributesData, conditionData, exclList = c(), altRef = T, file_prefix, method = 'ss', anchorDNA=TRUE, 
                     negCtrlName = "negCtrl", tTest = T, DEase = T, cSkew = T, correction = "BH", cutoff = 0.01, 
-                    upDisp = T, prior = F, paired = F, runAllelic = TRUE, writeBed=TRUE) {
-  counts_data <- countsData[,c("Barcode","Oligo",rownames(conditionData))]
+                    upDisp = T, prior = F, paired = F, runAllelic = TRUE, writeBed=TRUE, barcodeData=NULL) {
+  counts_data <- countsData[,c(intersect(c("Barcode","Oligo"), colnames(countsData)),rownames(conditionData))]
+  # barcodes seen per replicate; from the barcodes-per-oligo matrix when counts are oligo-level
+  bcCount <- function(id){
+    if("Barcode" %in% colnames(counts_data) | is.null(barcodeData)) return(sum(counts_data[,id] > 0))
+    return(sum(barcodeData[,id]))
+  }
   message(paste0(colnames(counts_data), collapse = "\t"))
   count_data <- oligoIsolate(counts_data, file_prefix)
   # Ensure all tiles from attributesData are present in count_data
@@ -579,7 +591,7 @@ dataOut <- function(countsData, attributesData, conditionData, exclList = c(), a
                 # message(id)
                 # message(sum(counts_data[,id] > 0))
                 
-                plas_ids[plas_ids$rep==id,"bc_count"] <- sum(counts_data[,id] > 0)
+                plas_ids[plas_ids$rep==id,"bc_count"] <- bcCount(id)
               }
               plas_ids <- plas_ids[order(plas_ids$bc_count),]
               
@@ -600,7 +612,7 @@ dataOut <- function(countsData, attributesData, conditionData, exclList = c(), a
               
               for(id in cell_ids$rep){
               
-                cell_ids[cell_ids$rep==id,"bc_count"] <- sum(counts_data[,id] > 0)
+                cell_ids[cell_ids$rep==id,"bc_count"] <- bcCount(id)
               }
               cell_ids <- cell_ids[order(cell_ids$bc_count),]
               
@@ -1144,39 +1156,16 @@ plot_logFC <- function(full_output, sample, negCtrlName="negCtrl", posCtrlName="
   return(list(tmp_plotA,tmp_plotB))
 }
 
-### Function which runs EVERYTHING
-# countsData      : table of tag counts, columns should include: Barcode, Oligo, Sample names
-# runAllelic     : Logical, default TRUE. Whether to run allelic skew tests (tTest and DEase).
-# attributesData  : table of full attributes, columns should include: ID, SNP, Project, Window, Strand, Allele,
-  # Haplotype, Bash
-# conditionData   : table of conditions, 2 columns no header align to the variable column headers of countsData
-  # and celltype
-# exclList        : List of cell types to be excluded, default empty list
-# filePrefix      : Name of project, it is suggested if normalization methods are being compared to include the normalization method in filePrefix
+### Correlation matrices and replicate scatter plots of normalized counts
+## Run by MPRAmodel; also run on its own to plot counts merged from per-celltype model runs (model.py)
+# counts_out      : normalized count matrix, samples as columns
+# conditionData   : table of conditions, samples as row names
+# file_prefix     : prefix for the plot file names
 # plotSave        : Logical, default T indicating that plots will be saved automatically
-# altRef          : Logical, default T indicating sorting by alt/ref, if sorting ref/alt set to F
-# method          : Method to be used to normalize the data. 4 options - summit shift normalization 'ss', remove the outliers before DESeq normalization 'ro'
-  # perform normalization for negative controls only 'nc', median of ratios method used by DESeq 'mn'
-MPRAmodel <- function(countsData, attributesData, conditionData, filePrefix, negCtrlName="negCtrl", posCtrlName="expCtrl", 
-                      projectName="MPRA_PROJ", exclList=c(), plotSave=T, altRef=T, method = 'ss', anchorDNA=TRUE, tTest=T, DEase=T, 
-                      cSkew=T, correction="BH", cutoff=0.01, upDisp=T, prior=F, raw=T, paired=F, color_table, runAllelic=TRUE, writeBed=TRUE, ...) {
-  file_prefix <- filePrefix
-  # Make sure that the plots and results directories are present in the current directory
-  mainDir <- getwd()
-  dir.create(file.path(mainDir, "plots"), showWarnings = FALSE)
-  dir.create(file.path(mainDir, "results"), showWarnings = FALSE)
-  # Resolve any multi-project conflicts, run normalization, and write celltype specific results files
-  attributesData <- addHaplo(attributesData, negCtrlName, posCtrlName, projectName)
-  message("running DESeq")
-  analysis_out <- dataOut(countsData, attributesData, conditionData, anchorDNA=anchorDNA, altRef=altRef, exclList, file_prefix, method, negCtrlName, tTest, DEase, cSkew, correction, cutoff, upDisp, prior, paired, runAllelic = runAllelic, writeBed=writeBed)
+MPRAcorPlots <- function(counts_out, conditionData, file_prefix, plotSave=T){
   cond_data <- conditionStandard(conditionData)
-  n <- length(levels(cond_data$condition))
-  full_output <- analysis_out[1:(n-1)]
-  dds_results <- analysis_out[[n]]
-
   # Plot correlation tables using the functions initialized above.
   message("Plotting correlation tables")
-  counts_out <- counts(dds_results, normalized=T)
   if(plotSave==F){
     cor_mat_log <- pairs(counts_out, upper.panel = panel.cor2, lower.panel = panel.lm, log = "xy", pch = 16)
     cor_mat1 <- pairs(counts_out, upper.panel = panel.cor, lower.panel = panel.lm, pch = 16)
@@ -1241,6 +1230,46 @@ MPRAmodel <- function(countsData, attributesData, conditionData, filePrefix, neg
     sampleY <- cell_combinations[2,combo]
     mpraScatter(conditionData = cond_data, countsOut = counts_out, sampleX, sampleY, xmax = xmax, ymax = ymax, plotSave, file_prefix)
   }
+}
+
+### Function which runs EVERYTHING
+# countsData      : table of tag counts, columns should include: Barcode, Oligo, Sample names
+  # or the oligo-level <id>.oligo_counts matrix from MPRAcount (Oligo, Sample names)
+# barcodeData     : optional <id>.oligo_barcodes matrix (barcodes per oligo per sample), used with oligo-level countsData
+# runAllelic     : Logical, default TRUE. Whether to run allelic skew tests (tTest and DEase).
+# corPlots        : Logical, default TRUE. Plot correlations across all samples (off for per-celltype shards)
+# attributesData  : table of full attributes, columns should include: ID, SNP, Project, Window, Strand, Allele,
+  # Haplotype, Bash
+# conditionData   : table of conditions, 2 columns no header align to the variable column headers of countsData
+  # and celltype
+# exclList        : List of cell types to be excluded, default empty list
+# filePrefix      : Name of project, it is suggested if normalization methods are being compared to include the normalization method in filePrefix
+# plotSave        : Logical, default T indicating that plots will be saved automatically
+# altRef          : Logical, default T indicating sorting by alt/ref, if sorting ref/alt set to F
+# method          : Method to be used to normalize the data. 4 options - summit shift normalization 'ss', remove the outliers before DESeq normalization 'ro'
+  # perform normalization for negative controls only 'nc', median of ratios method used by DESeq 'mn'
+MPRAmodel <- function(countsData, attributesData, conditionData, filePrefix, negCtrlName="negCtrl", posCtrlName="expCtrl", 
+                      projectName="MPRA_PROJ", exclList=c(), plotSave=T, altRef=T, method = 'ss', anchorDNA=TRUE, tTest=T, DEase=T, 
+                      cSkew=T, correction="BH", cutoff=0.01, upDisp=T, prior=F, raw=T, paired=F, color_table, runAllelic=TRUE, writeBed=TRUE, barcodeData=NULL, corPlots=TRUE, ...) {
+  file_prefix <- filePrefix
+  # Make sure that the plots and results directories are present in the current directory
+  mainDir <- getwd()
+  dir.create(file.path(mainDir, "plots"), showWarnings = FALSE)
+  dir.create(file.path(mainDir, "results"), showWarnings = FALSE)
+  # Resolve any multi-project conflicts, run normalization, and write celltype specific results files
+  attributesData <- addHaplo(attributesData, negCtrlName, posCtrlName, projectName)
+  message("running DESeq")
+  analysis_out <- dataOut(countsData, attributesData, conditionData, anchorDNA=anchorDNA, altRef=altRef, exclList, file_prefix, method, negCtrlName, tTest, DEase, cSkew, correction, cutoff, upDisp, prior, paired, runAllelic = runAllelic, writeBed=writeBed, barcodeData=barcodeData)
+  cond_data <- conditionStandard(conditionData)
+  n <- length(levels(cond_data$condition))
+  full_output <- analysis_out[1:(n-1)]
+  dds_results <- analysis_out[[n]]
+
+  counts_out <- counts(dds_results, normalized=T)
+  # Plot correlation tables and replicate scatter plots across all samples
+  if(corPlots==T){
+    MPRAcorPlots(counts_out, conditionData, file_prefix, plotSave)
+  }
 
   #Prepare for plot_logFC
   message("Plotting log Fold Change plots")
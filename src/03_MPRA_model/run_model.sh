@@ -4,7 +4,10 @@ set -euo pipefail
 
 # -----------------------------------------------------------------------------
 # USAGE:
-#   ./run_model.sh
+#   ./run_model.sh                # whole model stage
+#   ./run_model.sh split          # attributes + per-cell-type shard inputs
+#   ./run_model.sh shard <cell>   # MPRAmodel for one cell type
+#   ./run_model.sh gather         # collect finished shards into $MODEL_OUT
 # -----------------------------------------------------------------------------
 
 # load project-wide settings
@@ -29,8 +32,14 @@ ID_OUT="$ID_OUT"
 # NO NEED TO EDIT BELOW THIS LINE
 # -----------------------------------------------------------------------------
 
+PHASE="${1:-all}"
+CELL_ARG=""
+if [ "$PHASE" = "shard" ]; then
+  CELL_ARG="--cell ${2:?usage: run_model.sh shard <cell>}"
+fi
+
 # Sanity check for required files and scripts
-for f in "$SCRIPTS_DIR/make_project_list.py" "$SCRIPTS_DIR/make_attributes_oligo.py"; do
+for f in "$SCRIPTS_DIR/build_attributes.py" "$SCRIPTS_DIR/make_project_list.py" "$SCRIPTS_DIR/make_attributes_oligo.py"; do
   if [ ! -e "$f" ]; then
     echo "ERROR: cannot find required script: $f" >&2
     exit 1
@@ -42,52 +51,39 @@ mkdir -p "$MODEL_OUT"
 
 cd "$MODEL_IN"
 
-# Remove existing combined proj_list if exists
-rm -f "${ID_OUT}.proj_list"
-
-# Split reference FASTA into per-project FASTAs
-echo "Splitting reference FASTA by project..."
-python3 "$SCRIPTS_DIR/map_oligos_proj.py" \
-  --map "$LIBRARY/tile_proj_map.tsv" \
-  --fasta "$LIBRARY/OL49_reference.fasta.gz" \
-  --outdir "$MODEL_IN"
-
-# Loop over expected project FASTAs to build combined proj_list
-while read fasta_file; do
-  proj=$(basename "$fasta_file" .fasta.gz)
-  echo "Creating project list for $proj..."
-  python3 "$SCRIPTS_DIR/make_project_list.py" "$MODEL_IN/$fasta_file" "$proj"
-  cat "${proj}.proj_list" >> "${ID_OUT}.proj_list"
-done < "$MODEL_IN/expected_fastas.txt"
-
-# Clean up individual proj_list files, except the combined list
-for f in *.proj_list; do
-  if [ "$f" != "${ID_OUT}.proj_list" ]; then
-    rm -f "$f"
-  fi
-done
-
-# Create attributes file from merged proj_list
-echo "Creating attributes file..."
-python3 "$SCRIPTS_DIR/make_attributes_oligo.py" "${ID_OUT}.proj_list" "$ID_OUT" 2> make_attributes_warnings.txt
-
-# Create custom R script
-echo "Generating custom.r..."
-
-cat << EOF > "$MODEL_OUT/custom.r"
-proj <- "$PROJ"
-prefix <- "$PREFIX"
-negCtrl <- "$NEG_CTRL"
-posCtrl <- "$POS_CTRL"
-attr_proj <- read.delim("${MODEL_IN}/${ID_OUT}.attributes", stringsAsFactors=FALSE)
-count_proj <- read.delim("${COUNT_DIR}/${ID_OUT}.count", stringsAsFactors=FALSE)
-cond_proj <- read.delim("${COUNT_DIR}/${ID_OUT}_condition.txt", stringsAsFactors=FALSE, row.names=1, header=FALSE)
-colnames(cond_proj) <- "condition"
-source("${SRC_DIR}/03_MPRA_model/model.r")
-proj_out <- MPRAmodel(count_proj, attr_proj, cond_proj, filePrefix=paste0(proj, "_", prefix), negCtrlName=negCtrl, posCtrlName=posCtrl, projectName=proj, prior=FALSE, method='ssn', anchorDNA=TRUE, runAllelic=FALSE, writeBed=FALSE)
-writeLines(capture.output(sessionInfo()), "sessionInfo.txt")
-EOF
-
-cd "$MODEL_OUT"
-Rscript "$MODEL_OUT/custom.r"
-echo "R model run complete!"
\ No newline at end of file
+if [ "$PHASE" = "all" ] || [ "$PHASE" = "split" ]; then
+  # Build the combined proj_list and attributes file in one pass over the reference
+  echo "Creating project list and attributes file..."
+  python3 "$SCRIPTS_DIR/build_attributes.py" \
+    --map "$LIBRARY/tile_proj_map.tsv" \
+    --fasta "$LIBRARY/OL49_reference.fasta.gz" \
+    --outdir "$MODEL_IN" \
+    --id_out "$ID_OUT" 2> make_attributes_warnings.txt
+fi
+
+# Prefer the oligo-level matrix written by the count stage over the barcode-level table
+if [ -f "${COUNT_DIR}/${ID_OUT}.oligo_counts" ]; then
+  COUNT_FILE="${COUNT_DIR}/${ID_OUT}.oligo_counts"
+else
+  COUNT_FILE="${COUNT_DIR}/${ID_OUT}.count"
+fi
+BC_FILE="${COUNT_DIR}/${ID_OUT}.oligo_barcodes"
+
+# One MPRAmodel worker per cell type (DNA replicates shared), gathered into $MODEL_OUT
+echo "Running MPRAmodel per cell type (${MODEL_EXECUTOR:-local}, phase $PHASE)..."
+python3 "$SRC_DIR/03_MPRA_model/model.py" \
+  --counts     "$COUNT_FILE" \
+  --barcodes   "$BC_FILE" \
+  --attributes "${MODEL_IN}/${ID_OUT}.attributes" \
+  --condition  "${COUNT_DIR}/${ID_OUT}_condition.txt" \
+  --model_r    "$SRC_DIR/03_MPRA_model/model.r" \
+  --out_dir    "$MODEL_OUT" \
+  --proj       "$PROJ" \
+  --prefix     "$PREFIX" \
+  --neg_ctrl   "$NEG_CTRL" \
+  --pos_ctrl   "$POS_CTRL" \
+  --executor   "${MODEL_EXECUTOR:-local}" \
+  --workers    "${MODEL_WORKERS:-0}" \
+  --sge_opts   "-P $SCC_PROJ -l h_vmem=$MEM -l h_rt=$RUNTIME" \
+  --phase      "$PHASE" $CELL_ARG
+echo "R model run ($PHASE) complete!"
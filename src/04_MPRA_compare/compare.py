@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+compare.py
+
+Run the rows of comparisons.tsv as independent compare.r workers.
+
+The normalized count matrix is parsed once and cached next to the outputs as
+a .npz file (reused while the source TSV is unchanged). The split phase writes
+the cached arrays once for all workers as a raw column-major float64 matrix
+(workers/counts.f64, with counts.ids and counts.columns); each comparison gets
+its own worker directory holding a one-row comparison file, and its compare.r
+seeks to the Plasmid columns and the samples of its two groups in the matrix,
+so no worker parses a TSV or holds the full matrix. Per-comparison TSVs land
+in <out_dir> under the names compare.r always used, plus comparison_summary.tsv.
+
+Usage:
+    compare.py [--workers N] [--padj 0.05] <normalized_counts.tsv> <comparisons.tsv> <out_dir>
+"""
+import argparse, subprocess, os, shutil, sys, time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+def load_counts(norm_file, out_dir):
+    """Return (ids, columns, matrix), from the .npz cache when it is newer than norm_file."""
+    cache = os.path.join(out_dir, os.path.basename(norm_file) + ".npz")
+    st = os.stat(norm_file)
+    if os.path.exists(cache):
+        z = np.load(cache, allow_pickle=False)
+        if int(z["size"]) == st.st_size and int(z["mtime_ns"]) == st.st_mtime_ns:
+            return z["ids"], list(z["columns"]), z["counts"]
+    df = pd.read_csv(norm_file, sep="\t", dtype={"ID": str}, keep_default_na=False, na_values=["NA"])
+    if "ID" not in df.columns:
+        raise ValueError(f"{norm_file}: normalized counts TSV must contain an 'ID' column")
+    columns = [c for c in df.columns if c != "ID"]
+    ids = df["ID"].to_numpy(dtype=str)
+    counts = df[columns].to_numpy(dtype=np.float64)
+    np.savez(cache, ids=ids, columns=np.array(columns, dtype=str), counts=counts,
+             size=st.st_size, mtime_ns=st.st_mtime_ns)
+    print(f"Cached normalized counts to {cache}", file=sys.stderr)
+    return ids, columns, counts
+
+def split_group(value):
+    return [s.strip() for s in str(value).split(",") if s.strip()]
+
+def summarize(core_tsv, padj_cutoff):
+    res = pd.read_csv(core_tsv, sep="\t", usecols=["log2FoldChange", "padj"])
+    sig = res["padj"] < padj_cutoff
+    return {
+        "features": len(res),
+        "tested":   int(res["padj"].notna().sum()),
+        "sig":      int(sig.sum()),
+        "sig_up":   int((sig & (res["log2FoldChange"] > 0)).sum()),
+        "sig_down": int((sig & (res["log2FoldChange"] < 0)).sum()),
+    }
+
+def main():
+    p = argparse.ArgumentParser(description="Run comparisons.tsv rows as parallel compare.r workers")
+    p.add_argument("norm_file", help="Normalized counts TSV (ID column + samples)")
+    p.add_argument("comp_file", help="Comparison design (Comparison, Group1, Group2)")
+    p.add_argument("out_dir",   help="Output directory")
+    p.add_argument("--compare_r", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "compare.r"),
+                   help="Path to compare.r (default: next to this script)")
+    p.add_argument("--workers", type=int, default=0,
+                   help="Concurrent comparisons (default: number of CPUs)")
+    p.add_argument("--padj",    type=float, default=0.05,
+                   help="padj cutoff for the summary counts (default 0.05)")
+    p.add_argument("--phase",   choices=["all", "split", "run", "gather"], default="all",
+                   help="Run one phase only, for an external executor: 'split' writes the worker "
+                        "inputs, 'run' runs the --comparison worker, 'gather' writes the summary")
+    p.add_argument("--comparison", default=None,
+                   help="Comparison to run with --phase run")
+    args = p.parse_args()
+
+    out_dir = os.path.abspath(args.out_dir)
+    compare_r = os.path.abspath(args.compare_r)
+    work_root = os.path.join(out_dir, "workers")
+    os.makedirs(work_root, exist_ok=True)
+
+    comp = pd.read_csv(args.comp_file, sep="\t", dtype=str)
+    missing_cols = {"Comparison", "Group1", "Group2"} - set(comp.columns)
+    if missing_cols:
+        raise ValueError("Comparison file must contain columns: Comparison, Group1, Group2")
+
+    jobs = [(row["Comparison"], split_group(row["Group1"]), split_group(row["Group2"]),
+             os.path.join(work_root, row["Comparison"])) for _, row in comp.iterrows()]
+    matrix = os.path.join(work_root, "counts.f64")
+
+    # ── split: the cached matrix for every worker, one worker dir per comparison ──
+    if args.phase in ("all", "split"):
+        ids, columns, counts = load_counts(args.norm_file, out_dir)
+        known = set(columns)
+        for (name, grp1, grp2, wd), (_, row) in zip(jobs, comp.iterrows()):
+            unknown = [s for s in grp1 + grp2 if s not in known]
+            if unknown:
+                raise ValueError(f"{name}: unknown samples: {', '.join(unknown)}")
+            os.makedirs(wd, exist_ok=True)
+            if os.path.exists(os.path.join(wd, "compare.done")):
+                os.remove(os.path.join(wd, "compare.done"))
+            row.to_frame().T.to_csv(os.path.join(wd, "comparison.tsv"), sep="\t", index=False)
+        # column-major, so a worker reads each of its columns as one contiguous block
+        np.ascontiguousarray(counts.T, dtype="<f8").tofile(matrix)
+        for suffix, names in (("ids", ids), ("columns", columns)):
+            with open(os.path.join(work_root, f"counts.{suffix}"), "w") as out:
+                out.writelines(f"{n}\n" for n in names)
+    if args.phase == "split":
+        return
+
+    # ── scatter: compare.r per comparison ─────────────────────────────────────
+    def worker(job):
+        name, _, _, wd = job
+        cmd = f"Rscript {compare_r} {matrix} comparison.tsv {out_dir} > compare.log 2>&1"
+        print(f">> [{name}] {cmd}", file=sys.stderr)
+        t0 = time.time()
+        rc = subprocess.run(cmd, shell=True, cwd=wd).returncode
+        if rc == 0:
+            # elapsed seconds, read back by the gather phase
+            with open(os.path.join(wd, "compare.done"), "w") as out:
+                out.write(f"{time.time() - t0:.1f}\n")
+        return rc
+
+    if args.phase == "run":
+        job = [j for j in jobs if j[0] == args.comparison]
+        if not job:
+            raise ValueError(f"--phase run needs --comparison, one of: {', '.join(j[0] for j in jobs)}")
+        sys.exit(worker(job[0]))
+    if args.phase == "all":
+        with ThreadPoolExecutor(max_workers=args.workers or os.cpu_count() or 1) as pool:
+            list(pool.map(worker, jobs))
+
+    # ── gather: summary across comparisons ───────────────────────────────────
+    rows, failed = [], []
+    for name, grp1, grp2, wd in jobs:
+        done = os.path.join(wd, "compare.done")
+        ok = os.path.exists(done)
+        row = {"Comparison": name, "n_group1": len(grp1), "n_group2": len(grp2),
+               "status": "ok" if ok else "failed"}
+        if ok:
+            with open(done) as fh:
+                row["seconds"] = float(fh.read())
+            row.update(summarize(os.path.join(out_dir, f"comparison_{name}.tsv"), args.padj))
+        else:
+            failed.append(name)
+        rows.append(row)
+    summary = os.path.join(out_dir, "comparison_summary.tsv")
+    cols = ["Comparison", "n_group1", "n_group2", "features", "tested", "sig", "sig_up", "sig_down",
+            "status", "seconds"]
+    pd.DataFrame(rows, columns=cols).to_csv(summary, sep="\t", index=False, na_rep="NA")
+    print(f"Wrote {summary}", file=sys.stderr)
+
+    if failed:
+        logs = ", ".join(os.path.join(work_root, n, "compare.log") for n in failed)
+        sys.exit(f"ERROR: comparison(s) failed: {', '.join(failed)}; see {logs}")
+    shutil.rmtree(work_root)
+
+if __name__ == "__main__":
+    main()
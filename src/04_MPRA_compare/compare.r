@@ -6,7 +6,7 @@ library(DESeq2)
 # 0. Read comparison file (requires Sample and Group columns)
 args <- commandArgs(trailingOnly=TRUE)
 if (length(args) < 3) {
-  stop("Usage: Rscript compare.r <normalized_counts_file.tsv> <comparison_file.tsv> <output_dir>")
+  stop("Usage: Rscript compare.r <normalized_counts_file.tsv|counts.f64> <comparison_file.tsv> <output_dir>")
 }
 norm_file <- args[1]
 comp_file <- args[2]
@@ -23,17 +23,41 @@ if (!all(required_cols %in% colnames(comp))) {
   stop("Comparison file must contain columns: Comparison, Group1, Group2")
 }
 
-# 1. Read resolved normalized counts TSV with explicit ID column
-df <- read.delim(norm_file,
-                 header=TRUE,
-                 stringsAsFactors=FALSE,
-                 check.names=FALSE)
-if (!"ID" %in% colnames(df)) {
-  stop("Normalized counts TSV must contain an 'ID' column")
+# Plasmid columns and the given samples of a column-major float64 matrix
+# written by compare.py (<prefix>.f64 with <prefix>.ids and <prefix>.columns)
+read_counts_f64 <- function(path, samples) {
+  prefix <- sub("\\.f64$", "", path)
+  ids  <- readLines(paste0(prefix, ".ids"))
+  cols <- readLines(paste0(prefix, ".columns"))
+  keep <- which(cols %in% samples | grepl("^Plasmid", cols))
+  n <- length(ids)
+  mat <- matrix(NA_real_, nrow=n, ncol=length(keep), dimnames=list(ids, cols[keep]))
+  con <- file(path, "rb")
+  on.exit(close(con))
+  for (j in seq_along(keep)) {
+    seek(con, (keep[j] - 1) * n * 8)
+    mat[, j] <- readBin(con, "double", n=n, size=8, endian="little")
+  }
+  mat[is.nan(mat)] <- NA
+  mat
+}
+
+# 1. Read normalized counts: compare.py's matrix, or a TSV with explicit ID column
+if (grepl("\\.f64$", norm_file)) {
+  samples <- trimws(unlist(strsplit(c(comp$Group1, comp$Group2), ",")))
+  counts_mat <- read_counts_f64(norm_file, samples)
+} else {
+  df <- read.delim(norm_file,
+                   header=TRUE,
+                   stringsAsFactors=FALSE,
+                   check.names=FALSE)
+  if (!"ID" %in% colnames(df)) {
+    stop("Normalized counts TSV must contain an 'ID' column")
+  }
+  # Build count matrix from all columns except ID, preserving order
+  counts_mat <- as.matrix(df[, setdiff(colnames(df), "ID")])
+  rownames(counts_mat) <- df$ID
 }
-# Build count matrix from all columns except ID, preserving order
-counts_mat <- as.matrix(df[, setdiff(colnames(df), "ID")])
-rownames(counts_mat) <- df$ID
 
 # 2. Loop over provided comparisons
 for(i in seq_len(nrow(comp))) {
@@ -3,7 +3,10 @@ set -euo pipefail
 
 # -----------------------------------------------------------------------------
 # USAGE:
-#   ./run_compare.sh
+#   ./run_compare.sh               # all comparisons
+#   ./run_compare.sh split         # per-comparison worker inputs
+#   ./run_compare.sh run <name>    # one comparison
+#   ./run_compare.sh gather        # comparison_summary.tsv
 #   (uses built-in COMP_FILE, NORM_COUNTS, OUTDIR variables)
 # -----------------------------------------------------------------------------
 
@@ -22,14 +25,25 @@ OUTDIR="$RESULTS_COMPARE"
 # Resolve script directory and compare.R path
 SCRIPT_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
 COMPARE_R="${SCRIPT_DIR}/compare.r"
+COMPARE_PY="${SCRIPT_DIR}/compare.py"
 
 # Check files exist
-for f in "$NORM_COUNTS" "$COMP_FILE" "$COMPARE_R"; do
+for f in "$NORM_COUNTS" "$COMP_FILE" "$COMPARE_R" "$COMPARE_PY"; do
   if [ ! -e "$f" ]; then
     echo "ERROR: cannot find file: $f" >&2
     exit 1
   fi
 done
 
-# Run the comparison
-Rscript "$COMPARE_R" "$NORM_COUNTS" "$COMP_FILE" "$OUTDIR"
\ No newline at end of file
+PHASE="${1:-all}"
+COMP_ARG=""
+if [ "$PHASE" = "run" ]; then
+  COMP_ARG="--comparison ${2:?usage: run_compare.sh run <comparison>}"
+fi
+
+# Run the comparisons, one compare.r worker per row of COMP_FILE
+python3 "$COMPARE_PY" \
+  --compare_r "$COMPARE_R" \
+  --workers   "${COMPARE_WORKERS:-$CORES}" \
+  --phase     "$PHASE" $COMP_ARG \
+  "$NORM_COUNTS" "$COMP_FILE" "$OUTDIR"
\ No newline at end of file